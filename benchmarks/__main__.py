@@ -0,0 +1,59 @@
+"""
+Runs the benchmarks:
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --baseline results.json --threshold 0.2
+
+With --baseline, the exit status is 1 if a benchmark is slower than the baseline by more than the threshold.
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.suite import BENCHMARKS, compare, run
+
+
+def main(arguments=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="benchmarks whose name starts with one of these, all by default")
+    parser.add_argument("--output", help="JSON file where the results are written")
+    parser.add_argument("--baseline", help="JSON file of previous results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown flagged as a regression")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic inputs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--minimum-time", type=float, default=0.05, help="minimum duration of a repeat, in seconds")
+    parser.add_argument("--list", action="store_true", help="lists the benchmarks and exits")
+    options = parser.parse_args(arguments)
+
+    if options.list:
+        for benchmark in BENCHMARKS:
+            print(f"{benchmark.name:<26}{benchmark.parameter:<20}{benchmark.sizes}")
+        return 0
+
+    results = run(options.names, options.quick, options.seed, options.repeat, options.minimum_time, log=print)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not options.baseline:
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, options.threshold)
+    print()
+    print(f"{'benchmark':<26}{'size':>8}{'baseline ms':>14}{'ms':>10}{'ratio':>8}")
+    for row in rows:
+        print(f"{row['name']:<26}{row['size']:>8}{1e3 * row['baseline']:>14.3f}{1e3 * row['median']:>10.3f}"
+              f"{row['ratio']:>8.2f}{'  REGRESSION' if row['regression'] else ''}")
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) above {100 * options.threshold:.0f}%")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
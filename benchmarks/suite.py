@@ -0,0 +1,221 @@
+"""
+Micro-benchmarks of the core algorithms, each one measured over a range of input sizes.
+
+A benchmark is a setup function which builds its inputs for one size and returns the function to time. Timings are
+the median over several repeats of the time of one call, the number of calls of a repeat being chosen so that it lasts
+at least {minimum_time}, like timeit does.
+"""
+
+import math
+import platform
+import statistics
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from benchmarks.synthetic import generate_arcs, generate_robot, generate_world
+from slam_robot.methods.circle_fitting import fit_circles
+from slam_robot.methods.hough_transform import hough_transform
+from slam_robot.methods.kalman_filter import MultiTargetEKF, ekf
+from slam_robot.utils import constants
+
+
+class Benchmark:
+    def __init__(self, name: str, parameter: str, sizes: Sequence[int], quick_sizes: Sequence[int],
+                 setup: Callable[[int, int], Callable[[], object]]):
+        """
+
+        :param name:
+        :param parameter: what the sizes are, like "number_of_items"
+        :param sizes: sizes measured by default
+        :param quick_sizes: sizes measured with --quick
+        :param setup: (size, seed) -> function to time
+        """
+        self.name = name
+        self.parameter = parameter
+        self.sizes = list(sizes)
+        self.quick_sizes = list(quick_sizes)
+        self.setup = setup
+
+
+def measure(function: Callable[[], object], repeat: int = 5, minimum_time: float = 0.05) -> Dict[str, float]:
+    """
+    :param function: called without arguments
+    :param repeat: number of repeats
+    :param minimum_time: minimum duration of a repeat, in seconds
+    :return: median and minimum time of one call, in seconds, and the number of calls per repeat
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        duration = time.perf_counter() - start
+        if duration >= minimum_time:
+            break
+        number = max(number * 2, int(math.ceil(number * minimum_time / max(duration, 1e-9))))
+    timings = [duration / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return {"median": statistics.median(timings), "minimum": min(timings), "number": number}
+
+
+# region benchmarks
+def _see_obstacles(number_of_items: int, seed: int):
+    world = generate_world(number_of_items, seed)
+    robot = generate_robot(world, seed)
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False).tolist()
+    # the grid is built before timing, only the queries are measured
+    world.build_grid()
+
+    def run():
+        for angle in angles:
+            world.see_obstacles(robot.position, angle)
+    return run
+
+
+def _sense_resolution(angle_measures: int, seed: int):
+    world = generate_world(64, seed)
+    robot = generate_robot(world, seed, angle_measures=angle_measures)
+
+    def run():
+        robot.sense(world)
+        robot.measures.clear()
+    return run
+
+
+def _sense_items(number_of_items: int, seed: int):
+    world = generate_world(number_of_items, seed)
+    robot = generate_robot(world, seed, angle_measures=360)
+
+    def run():
+        robot.sense(world)
+        robot.measures.clear()
+    return run
+
+
+def _perception(angle_measures: int, seed: int):
+    world = generate_world(64, seed)
+    robot = generate_robot(world, seed, angle_measures=angle_measures)
+    robot.sense(world)
+    return robot.measures[-1]
+
+
+def _clusterize(angle_measures: int, seed: int):
+    perception = _perception(angle_measures, seed)
+    return perception.clusterize
+
+
+def _hough_transform(angle_measures: int, seed: int):
+    points = _perception(angle_measures, seed).obstacles.xy
+    return lambda: hough_transform(points)
+
+
+def _fit_circles_cluster_size(cluster_size: int, seed: int):
+    points, lengths = generate_arcs(16, cluster_size, seed)
+    return lambda: fit_circles(points, lengths, constants.FIX_BEACON_RADIUS)
+
+
+def _fit_circles_clusters(number_of_clusters: int, seed: int):
+    points, lengths = generate_arcs(number_of_clusters, 16, seed)
+    return lambda: fit_circles(points, lengths, constants.FIX_BEACON_RADIUS)
+
+
+def _targets(number_of_targets: int, seed: int):
+    rng = np.random.default_rng(seed)
+    states = np.column_stack([rng.uniform(0, 3000, number_of_targets), np.zeros(number_of_targets),
+                              rng.uniform(0, 2000, number_of_targets), np.zeros(number_of_targets)])
+    measures = np.column_stack([np.arctan2(states[:, 2], states[:, 0]), np.hypot(states[:, 0], states[:, 2])])
+    return states, measures
+
+
+def _ekf(number_of_targets: int, seed: int):
+    states, measures = _targets(number_of_targets, seed)
+    covariance = np.eye(4)
+
+    def run():
+        for state, measure in zip(states, measures):
+            ekf(1., measure, state, covariance, 0.1, constants.sigma_q, constants.sigma_angle,
+                constants.sigma_distance)
+    return run
+
+
+def _multi_target_ekf(number_of_targets: int, seed: int):
+    states, measures = _targets(number_of_targets, seed)
+    tracker = MultiTargetEKF(states, None, 0.1, constants.sigma_q, constants.sigma_angle, constants.sigma_distance)
+    return lambda: tracker.step(1., measures)
+
+
+BENCHMARKS = [
+    Benchmark("see_obstacles", "number_of_items", [16, 64, 256, 1024], [16, 256], _see_obstacles),
+    Benchmark("sense.resolution", "angle_measures", [90, 360, 1440, 5760], [90, 1440], _sense_resolution),
+    Benchmark("sense.items", "number_of_items", [16, 64, 256, 1024], [16, 256], _sense_items),
+    Benchmark("clusterize", "angle_measures", [90, 360, 1440, 5760], [90, 1440], _clusterize),
+    Benchmark("hough_transform", "angle_measures", [90, 360, 1440], [90, 360], _hough_transform),
+    Benchmark("fit_circles.cluster_size", "cluster_size", [8, 32, 128, 512], [8, 128], _fit_circles_cluster_size),
+    Benchmark("fit_circles.clusters", "number_of_clusters", [4, 16, 64, 256], [4, 64], _fit_circles_clusters),
+    Benchmark("ekf", "number_of_targets", [1, 4, 16, 64], [1, 16], _ekf),
+    Benchmark("multi_target_ekf", "number_of_targets", [1, 4, 16, 64], [1, 16], _multi_target_ekf),
+]
+# endregion
+
+
+def run(names: Optional[List[str]] = None, quick: bool = False, seed: int = 0, repeat: int = 5,
+        minimum_time: float = 0.05, log: Optional[Callable[[str], None]] = None) -> Dict:
+    """
+    :param names: benchmarks whose name starts with one of {names}, all of them if None
+    :param quick: fewer sizes
+    :param seed: seed of the synthetic inputs
+    :param repeat:
+    :param minimum_time:
+    :param log: called with a line for each measure
+    :return: results, as saved in JSON
+    """
+    results = {}
+    for benchmark in BENCHMARKS:
+        if names and not any(benchmark.name.startswith(name) for name in names):
+            continue
+        sizes = benchmark.quick_sizes if quick else benchmark.sizes
+        timings = [measure(benchmark.setup(size, seed), repeat, minimum_time) for size in sizes]
+        results[benchmark.name] = {"parameter": benchmark.parameter, "sizes": sizes,
+                                   "median": [timing["median"] for timing in timings],
+                                   "minimum": [timing["minimum"] for timing in timings]}
+        if log is not None:
+            log(f"{benchmark.name:<26}{benchmark.parameter:<20}"
+                + "  ".join(f"{size}: {1e3 * timing['median']:.3f} ms" for size, timing in zip(sizes, timings)))
+    return {"metadata": {"python": platform.python_version(), "numpy": np.__version__,
+                         "machine": platform.machine(), "seed": seed, "quick": quick,
+                         "date": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+def compare(results: Dict, baseline: Dict, threshold: float = 0.2) -> List[Dict]:
+    """
+    Ratio of the median times of each (benchmark, size) measured in both {results} and {baseline}.
+
+    >>> baseline = {"results": {"ekf": {"sizes": [1, 4], "median": [1e-5, 4e-5]}}}
+    >>> results = {"results": {"ekf": {"sizes": [1, 4], "median": [1e-5, 6e-5]}}}
+    >>> [(row["size"], row["ratio"], row["regression"]) for row in compare(results, baseline)]
+    [(1, 1.0, False), (4, 1.5, True)]
+
+    :param results:
+    :param baseline:
+    :param threshold: a ratio greater than 1 + {threshold} is a regression
+    :return: one row per (benchmark, size)
+    """
+    rows = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        reference = dict(zip(baseline["results"][name]["sizes"], baseline["results"][name]["median"]))
+        for size, median in zip(result["sizes"], result["median"]):
+            if size not in reference:
+                continue
+            ratio = median / reference[size]
+            rows.append({"name": name, "size": size, "baseline": reference[size], "median": median,
+                         "ratio": ratio, "regression": ratio > 1 + threshold})
+    return rows
@@ -0,0 +1,94 @@
+"""
+Seeded synthetic worlds and scans, so that benchmark results can be reproduced.
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+from slam_robot.models.robot import Robot
+from slam_robot.models.world import World
+from slam_robot.models.world_items import Circle, LineByTwoPoints, LineSegment, WorldItem
+from slam_robot.utils.geometry import Point
+
+# size of the table, in mm
+TABLE_X = 3000
+TABLE_Y = 2000
+
+
+def generate_world(number_of_items: int, seed: int = 0, limit_x: int = TABLE_X, limit_y: int = TABLE_Y,
+                   circle_ratio: float = 0.3, segment_length: float = 150.,
+                   circle_radius: Tuple[float, float] = (20, 80)) -> World:
+    """
+    Four walls around the table and {number_of_items} obstacles inside it, segments and circles.
+
+    >>> world = generate_world(10, seed=1)
+    >>> len(world.items)
+    14
+    >>> boxes = [item.get_bounding_box() for item in world.items[4:]]
+    >>> boxes == [item.get_bounding_box() for item in generate_world(10, seed=1).items[4:]]
+    True
+
+    :param number_of_items: number of obstacles, walls excluded
+    :param seed:
+    :param limit_x:
+    :param limit_y:
+    :param circle_ratio: proportion of circles among the obstacles
+    :param segment_length: mean length of the segments
+    :param circle_radius: range of the radii of the circles
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    items: List[WorldItem] = [LineByTwoPoints(Point(0, 0), Point(0, limit_y)),
+                              LineByTwoPoints(Point(0, limit_y), Point(limit_x, limit_y)),
+                              LineByTwoPoints(Point(limit_x, limit_y), Point(limit_x, 0)),
+                              LineByTwoPoints(Point(limit_x, 0), Point(0, 0))]
+    margin = max(segment_length, circle_radius[1])
+    for _ in range(number_of_items):
+        x, y = rng.uniform([margin, margin], [limit_x - margin, limit_y - margin])
+        if rng.uniform() < circle_ratio:
+            items.append(Circle(Point(x, y), rng.uniform(*circle_radius)))
+        else:
+            angle = rng.uniform(0, np.pi)
+            half_length = rng.uniform(0.5, 1.5) * segment_length / 2
+            dx, dy = half_length * np.cos(angle), half_length * np.sin(angle)
+            items.append(LineSegment(Point(x - dx, y - dy), Point(x + dx, y + dy)))
+    return World(items, limit_x, limit_y)
+
+
+def generate_robot(world: World, seed: int = 0, angle_measures: int = 300, measure_max_distance: float = 4000.) \
+        -> Robot:
+    """
+    Robot at a random pose in {world}, clear of its circles.
+    """
+    rng = np.random.default_rng(seed)
+    circles = [item for item in world.items if isinstance(item, Circle)]
+    while True:
+        x, y = rng.uniform([100, 100], [world.limit_x - 100, world.limit_y - 100])
+        if all(np.hypot(x - circle.center.x, y - circle.center.y) > circle.radius for circle in circles):
+            break
+    robot = Robot(Point(x, y), rng.uniform(-np.pi, np.pi))
+    robot.angle_measures = angle_measures
+    robot.measure_max_distance = measure_max_distance
+    return robot
+
+
+def generate_arcs(number_of_clusters: int, cluster_size: int, seed: int = 0, radius: float = 50.,
+                  noise: float = 1.) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Noisy arcs of circles of radius {radius}, as a lidar sees beacons.
+
+    :param number_of_clusters:
+    :param cluster_size: number of points of each arc
+    :param seed:
+    :param radius:
+    :param noise: standard deviation of the noise on the points
+    :return: (number_of_clusters * cluster_size, 2) points, cluster after cluster, and the length of each cluster
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform([0, 0], [TABLE_X, TABLE_Y], (number_of_clusters, 2))
+    starts = rng.uniform(0, 2 * np.pi, number_of_clusters)
+    angles = starts[:, np.newaxis] + np.linspace(0, np.pi * 2 / 3, cluster_size)
+    points = centers[:, np.newaxis, :] + radius * np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+    points += rng.normal(0, noise, points.shape)
+    return points.reshape(-1, 2), np.full(number_of_clusters, cluster_size)
@@ -50,17 +50,8 @@ def show(world: World,
         if show_world:
             world.draw(ax)
         if show_measures:
-            x_values = []
-            y_values = []
             print(measure.position)
-            for point in measure.obstacles:
-                line = LineByTwoPoints(measure.position, point)
-                # line.draw(ax)
-                # x_values.append(point.x + robot.position.x)
-                x_values.append(point.x)
-                # y_values.append(point.y + robot.position.y)
-                y_values.append(point.y)
-            plt.scatter(x_values, y_values, color="blue")
+            plt.scatter(measure.obstacles.x, measure.obstacles.y, color="blue")
         if show_clusters:
             clusters = measure.clusterize()
             for cluster in clusters:
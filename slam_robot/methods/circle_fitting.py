@@ -0,0 +1,127 @@
+"""
+Closed-form circle fitting of many clusters at once.
+
+The clusters of a turn are given as one ragged array: the concatenated points and the number of points of each
+cluster. Every sum needed by the algebraic (Kasa) fit and by the Gauss-Newton refinement is computed per cluster
+with np.add.reduceat, and the small linear systems of all the clusters are solved in one batched call.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from slam_robot.utils import profiling
+
+
+def _sums(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    return np.add.reduceat(values, starts, axis=0)
+
+
+def _solve(matrices: np.ndarray, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched solve where singular systems give nan instead of raising for the whole batch.
+    """
+    scale = np.abs(matrices).max(axis=(1, 2)) ** matrices.shape[1]
+    singular = ~(np.abs(np.linalg.det(matrices)) > 1e-12 * scale)
+    safe_matrices = np.where(singular[:, np.newaxis, np.newaxis], np.eye(matrices.shape[1]), matrices)
+    solutions = np.linalg.solve(safe_matrices, vectors[..., np.newaxis])[..., 0]
+    solutions[singular] = np.nan
+    return solutions, singular
+
+
+@profiling.profiled("fitting.circles")
+def fit_circles(points: np.ndarray,
+                lengths: Sequence[int],
+                radius: Optional[float] = None,
+                refine: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits a circle to each cluster.
+
+    The algebraic fit minimises sum((x - a)² + (y - b)² - r²)² which is linear in (a, b, a² + b² - r²). The points of
+    each cluster are centred on their mean first, so that the normal equations are well conditioned. Then one
+    Gauss-Newton step on the geometric residuals |p - c| - r is taken if {refine}, with the radius fixed to {radius}
+    if it is given, free otherwise.
+
+    >>> thetas = np.deg2rad(np.arange(0, 150, 6))
+    >>> arc_1 = np.column_stack([100 * np.cos(thetas) - 420, 100 * np.sin(thetas) + 780])
+    >>> arc_2 = np.column_stack([50 * np.cos(thetas) + 10, 50 * np.sin(thetas) + 20])
+    >>> centers, radii, residuals = fit_circles(np.concatenate([arc_1, arc_2]), [len(arc_1), len(arc_2)])
+    >>> np.round(centers, 6).tolist(), np.round(radii, 6).tolist(), bool(np.all(residuals < 1e-6))
+    ([[-420.0, 780.0], [10.0, 20.0]], [100.0, 50.0], True)
+
+    :param points: (M, 2) points of all the clusters, cluster after cluster
+    :param lengths: (K,) number of points of each cluster
+    :param radius: known radius, like FIX_BEACON_RADIUS, or None
+    :param refine: whether the Gauss-Newton step is taken
+    :return: centers (K, 2), radii (K,) and root mean square geometric residuals (K,). Clusters with less than three
+    points, or with aligned points, give nan.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    number_of_clusters = len(lengths)
+    centers = np.full((number_of_clusters, 2), np.nan)
+    radii = np.full(number_of_clusters, np.nan)
+    residuals = np.full(number_of_clusters, np.nan)
+
+    fitted = lengths >= 3
+    if not np.any(fitted):
+        return centers, radii, residuals
+    # clusters which are too small are removed from the ragged array
+    point_mask = np.repeat(fitted, lengths)
+    points = points[point_mask]
+    lengths = lengths[fitted]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    cluster_indices = np.repeat(np.arange(len(lengths)), lengths)
+
+    means = _sums(points, starts) / lengths[:, np.newaxis]
+    u = points - means[cluster_indices]
+    squared_norms = np.sum(u ** 2, axis=1)
+
+    # algebraic fit: u² + v² + d * u + e * v + f = 0
+    design = np.column_stack([u, np.ones(len(u))])
+    normal_matrices = _sums(design[:, :, np.newaxis] * design[:, np.newaxis, :], starts)
+    normal_vectors = -_sums(design * squared_norms[:, np.newaxis], starts)
+    solutions, _ = _solve(normal_matrices, normal_vectors)
+    fit_centers = -solutions[:, :2] / 2
+    fit_radii = np.sqrt(np.sum(fit_centers ** 2, axis=1) - solutions[:, 2])
+    if radius is not None:
+        fit_radii = np.full(len(lengths), float(radius))
+
+    if refine:
+        differences = u - fit_centers[cluster_indices]
+        distances = np.hypot(differences[:, 0], differences[:, 1])
+        distances[distances == 0] = np.finfo(float).eps
+        jacobians = -differences / distances[:, np.newaxis]
+        if radius is None:
+            jacobians = np.column_stack([jacobians, -np.ones(len(u))])
+        errors = distances - fit_radii[cluster_indices]
+        jtj = _sums(jacobians[:, :, np.newaxis] * jacobians[:, np.newaxis, :], starts)
+        jtr = _sums(jacobians * errors[:, np.newaxis], starts)
+        steps, _ = _solve(jtj, -jtr)
+        fit_centers = fit_centers + steps[:, :2]
+        if radius is None:
+            fit_radii = fit_radii + steps[:, 2]
+
+    differences = u - fit_centers[cluster_indices]
+    errors = np.hypot(differences[:, 0], differences[:, 1]) - fit_radii[cluster_indices]
+    centers[fitted] = fit_centers + means
+    radii[fitted] = fit_radii
+    residuals[fitted] = np.sqrt(_sums(errors ** 2, starts) / lengths)
+    return centers, radii, residuals
+
+
+def fit_cluster_circles(clusters: List[np.ndarray],
+                        radius: Optional[float] = None,
+                        refine: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    fit_circles for a list of clusters.
+
+    :param clusters: list of (n_i, 2) arrays or lists of 2D points
+    :param radius: known radius or None
+    :param refine: whether the Gauss-Newton step is taken
+    :return: centers (K, 2), radii (K,) and root mean square residuals (K,)
+    """
+    arrays = [np.asarray(cluster, dtype=float).reshape(-1, 2) for cluster in clusters]
+    if len(arrays) == 0:
+        return np.empty((0, 2)), np.empty(0), np.empty(0)
+    return fit_circles(np.concatenate(arrays), [len(array) for array in arrays], radius, refine)
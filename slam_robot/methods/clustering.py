@@ -1,12 +1,55 @@
 
 
+from typing import List, Optional
+
 import numpy as np
+from numpy.linalg import norm
+
+import slam_robot.methods.hough_transform as outr
+from slam_robot.methods.circle_fitting import fit_cluster_circles
+from slam_robot.methods.ransac import ransac_circle, ransac_line
+from slam_robot.models.beacon import CylinderBeacon as Beacon
+from slam_robot.utils.constants import FIX_BEACON_RADIUS, OPPONENT_ROBOT_BEACON_RADIUS, \
+    TOLERANCE_FOR_CIRCLE_COHERENCE, RANSAC_TOLERANCE, RANSAC_MINIMUM_INLIER_RATIO, seuil_association
+from slam_robot.utils.point_cloud import PointCloud
+from slam_robot.utils.spatial_index import SpatialIndex
+
+
+def distance(point_1, point_2):
+    return norm(np.asarray(point_1) - np.asarray(point_2))
+
+
+def associate_beacons(beacons: List[Beacon], known_beacons: List[Beacon], maximum_distance=seuil_association):
+    """
+    Matches each detected beacon with the closest known beacon.
+
+    >>> known = [Beacon(), Beacon()]
+    >>> known[0].set_parameters(0, 0, 50, 0)
+    >>> known[1].set_parameters(1000, 0, 50, 1)
+    >>> detected = [Beacon(), Beacon()]
+    >>> detected[0].set_parameters(990, 20, 50, 0)
+    >>> detected[1].set_parameters(500, 500, 50, 0)
+    >>> associate_beacons(detected, known).tolist()
+    [1, -1]
+
+    :param beacons: detected beacons
+    :param known_beacons: expected beacons
+    :param maximum_distance: beacons farther than it from any known beacon are not associated
+    :return: index in {known_beacons} of the beacon associated with each detected beacon, -1 if none
+    """
+    if len(beacons) == 0 or len(known_beacons) == 0:
+        return np.full(len(beacons), -1, dtype=np.int64)
+    index = SpatialIndex(np.array([[beacon.x_center, beacon.y_center] for beacon in known_beacons], dtype=float))
+    _, ids = index.nearest(np.array([[beacon.x_center, beacon.y_center] for beacon in beacons], dtype=float),
+                           maximum_distance)
+    return ids
+
 
 class Cluster:
     """
     Cluster of points. May be an obstacle or a beacon.
     """
-    def __init__(self, beacon_radius, opponent_robot_radius):
+    def __init__(self, beacon_radius=FIX_BEACON_RADIUS, opponent_robot_radius=OPPONENT_ROBOT_BEACON_RADIUS):
         self.points = []
         self.mean = None
         self.beacon_radius = beacon_radius
@@ -16,12 +59,63 @@ class Cluster:
     def get_std(self):
         return np.std(self.points)
 
-    def is_linear(self):
+    def is_linear(self, tolerance=RANSAC_TOLERANCE, minimum_inlier_ratio=RANSAC_MINIMUM_INLIER_RATIO, seed=0):
         """
-        Hough transform or RANSAC
+        RANSAC
+
+        >>> cluster = Cluster()
+        >>> cluster.add_points([np.array([x, 3 * x]) for x in range(10)])
+        >>> cluster.is_linear()
+        True
+
+        :param tolerance: maximum distance of an inlier to the line
+        :param minimum_inlier_ratio:
+        :param seed:
+        :return:
+        """
+        result = ransac_line(np.array(self.points, dtype=float), tolerance, stop_inlier_ratio=minimum_inlier_ratio,
+                             seed=seed)
+        return result is not None and result.inlier_ratio >= minimum_inlier_ratio
+
+    def is_circular(self, radius, tolerance=RANSAC_TOLERANCE, minimum_inlier_ratio=RANSAC_MINIMUM_INLIER_RATIO,
+                    seed=0):
+        """
+        RANSAC with a fixed radius, the points are in the lidar frame so the sensor is at (0, 0).
+
+        :param radius:
+        :param tolerance: maximum distance of an inlier to the circle
+        :param minimum_inlier_ratio:
+        :param seed:
         :return:
         """
-        pass
+        result = ransac_circle(np.array(self.points, dtype=float), radius, tolerance,
+                               stop_inlier_ratio=minimum_inlier_ratio, seed=seed, sensor=np.zeros(2))
+        return result is not None and result.inlier_ratio >= minimum_inlier_ratio
+
+    def classify_shape(self, tolerance=RANSAC_TOLERANCE, minimum_inlier_ratio=RANSAC_MINIMUM_INLIER_RATIO, seed=0):
+        """
+        Shape which explains the greatest ratio of points, at least {minimum_inlier_ratio}.
+
+        :param tolerance:
+        :param minimum_inlier_ratio:
+        :param seed:
+        :return: "fix_beacon", "opponent_robot", "line" or None
+        """
+        points = np.array(self.points, dtype=float)
+        results = {
+            "fix_beacon": ransac_circle(points, self.beacon_radius, tolerance, stop_inlier_ratio=minimum_inlier_ratio,
+                                        seed=seed, sensor=np.zeros(2)),
+            "opponent_robot": ransac_circle(points, self.adverse_robot_radius, tolerance,
+                                            stop_inlier_ratio=minimum_inlier_ratio, seed=seed, sensor=np.zeros(2)),
+            "line": ransac_line(points, tolerance, stop_inlier_ratio=minimum_inlier_ratio, seed=seed),
+        }
+        shape = None
+        best_ratio = minimum_inlier_ratio
+        for name, result in results.items():
+            if result is not None and result.inlier_ratio >= best_ratio:
+                shape = name
+                best_ratio = result.inlier_ratio
+        return shape
 
     def compute_mean(self):
         if len(self.points) > 0:
@@ -40,8 +134,20 @@ class Cluster:
         self.points.append(point)
 
     def add_points(self, points):
+        if isinstance(points, PointCloud):
+            points = list(points.xy)
         self.points.extend(points)
 
+    def to_point_cloud(self) -> PointCloud:
+        return PointCloud(np.array(self.points, dtype=float).reshape(-1, 2))
+
+    @classmethod
+    def from_point_cloud(cls, points: PointCloud, beacon_radius=FIX_BEACON_RADIUS,
+                         opponent_robot_radius=OPPONENT_ROBOT_BEACON_RADIUS) -> 'Cluster':
+        cluster = cls(beacon_radius, opponent_robot_radius)
+        cluster.add_points(points)
+        return cluster
+
     def distance(self, other):
         if isinstance(other, Cluster):
             cluster_mean = np.sum(self.points, axis=0) / len(self.points)
@@ -71,18 +177,43 @@ class Cluster:
         >>> cluster.add_points(points)
         >>> cluster.is_a_fix_beacon()
 
+        >>> cluster = Cluster(beacon_radius=real_radius)
+        >>> cluster.add_points(points)
+        >>> print(cluster.is_a_fix_beacon())
+        (-420.0,780.0) , 50 n°0
+
         :return:
         """
 
-        initial_guess = self.get_mean()
-        solution = root(self._beacons_objective_function, initial_guess, method="lm")
+        return Cluster.detect_fix_beacons([self])[0]
 
-        beacon = None
-        if np.isclose(solution.fun[0], 0, atol=TOLERANCE_FOR_CIRCLE_COHERENCE):
-            beacon = Beacon()
-            beacon.set_parameters(solution.x[0], solution.x[1], FIX_BEACON_RADIUS, 0)
-            beacon.set_cluster(self)
-        return beacon
+    @staticmethod
+    def detect_fix_beacons(clusters: List['Cluster']) -> List[Optional[Beacon]]:
+        """
+        Fits a circle of the beacon radius to all the clusters at once.
+        A cluster is a beacon if the sum of its squared residuals is within TOLERANCE_FOR_CIRCLE_COHERENCE.
+
+        :param clusters:
+        :return: a beacon or None for each cluster
+        """
+        beacons = []
+        if len(clusters) == 0:
+            return beacons
+        radii = np.array([cluster.beacon_radius for cluster in clusters], dtype=float)
+        if np.all(radii == radii[0]):
+            centers, _, residuals = fit_cluster_circles([cluster.points for cluster in clusters], radii[0])
+        else:
+            fits = [fit_cluster_circles([cluster.points], cluster.beacon_radius) for cluster in clusters]
+            centers = np.concatenate([fit[0] for fit in fits])
+            residuals = np.concatenate([fit[2] for fit in fits])
+        for cluster, center, residual in zip(clusters, centers, residuals):
+            beacon = None
+            if residual ** 2 * len(cluster) <= TOLERANCE_FOR_CIRCLE_COHERENCE:
+                beacon = Beacon()
+                beacon.set_parameters(center[0], center[1], FIX_BEACON_RADIUS, 0)
+                beacon.set_cluster(cluster)
+            beacons.append(beacon)
+        return beacons
 
     def is_an_opponent_robot_beacon(self):
         """
@@ -93,30 +224,15 @@ class Cluster:
         return cluster_mean
 
     def is_a_circle(self, radius):
-        def objective_function(pos):
-            circle_position = pos
-            dist_sum = 0
-            for point in self.points:
-                dist_sum += (distance(point, circle_position) - radius) ** 2
-            return dist_sum, 0
-        initial_guess = self.get_mean()
-        solution = root(objective_function, initial_guess, method="lm")
-
-        return solution
-
-    def _beacons_objective_function(self, pos):
-        # circle_position = np.array([x, y])
-        return self._objective_function(pos, self.beacon_radius)
-
-    def _objective_function(self, pos, radius):
-        circle_position = pos
-        dist_sum = 0
-        for point in self.points:
-            dist_sum += (distance(point, circle_position) - radius) ** 2
-        return dist_sum, 0
+        """
+        Circle of radius {radius} which fits the best the points.
 
-    def _adverse_objective_function(self, pos):
-        return self._objective_function(pos, self.adverse_robot_radius)
+        :param radius:
+        :return: center and root mean square distance of the points to the circle, nan if there are less than three
+        points
+        """
+        centers, _, residuals = fit_cluster_circles([self.points], radius)
+        return centers[0], residuals[0]
 
     def new_cluster_by_points(self, points: List):
         new_cluster = Cluster()
@@ -0,0 +1,256 @@
+"""
+EKF-SLAM: joint estimation of the robot pose and of the landmark positions.
+
+The state is [x, y, theta, x_1, y_1, ..., x_L, y_L]. The state vector and the covariance matrix are stored in arrays
+whose capacity doubles when landmarks are added, so adding a landmark does not copy the whole state every time.
+
+Odometry only changes the pose, so the prediction touches the pose block and the pose-landmark cross-covariance.
+A range-bearing measurement of one landmark only depends on the pose and on that landmark. With the sparse update,
+only the rows and columns of the pose and of the observed landmark are updated, which costs O(L) instead of O(L²).
+The skipped block is the one between the unobserved landmarks, whose variances are then overestimated, never
+underestimated, so the covariance stays consistent.
+"""
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from slam_robot.utils import profiling
+from slam_robot.utils.constants import seuil_association
+
+POSE_SIZE = 3
+LANDMARK_SIZE = 2
+
+
+def normalize_angle(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+class EkfSlam:
+    def __init__(self,
+                 initial_pose: Sequence[float],
+                 initial_covariance: Optional[np.ndarray] = None,
+                 translation_noise: float = 0.01,
+                 rotation_noise: float = 0.01,
+                 range_noise: float = 10.,
+                 bearing_noise: float = 0.01,
+                 initial_capacity: int = 8):
+        """
+
+        :param initial_pose: (x, y, theta)
+        :param initial_covariance: 3 x 3, zero if None
+        :param translation_noise: standard deviation of the translation per unit of distance travelled
+        :param rotation_noise: standard deviation of the rotation per radian turned
+        :param range_noise: standard deviation of the measured distances
+        :param bearing_noise: standard deviation of the measured angles, in radian
+        :param initial_capacity: number of landmarks which fit before the arrays grow
+        """
+        capacity = POSE_SIZE + LANDMARK_SIZE * initial_capacity
+        self._state = np.zeros(capacity)
+        self._covariance = np.zeros((capacity, capacity))
+        self.size = POSE_SIZE
+        self._state[:POSE_SIZE] = initial_pose
+        if initial_covariance is not None:
+            self._covariance[:POSE_SIZE, :POSE_SIZE] = initial_covariance
+        self.translation_noise = translation_noise
+        self.rotation_noise = rotation_noise
+        self.measurement_noise = np.diag([range_noise ** 2, bearing_noise ** 2])
+
+    # region state
+    @property
+    def state(self) -> np.ndarray:
+        return self._state[:self.size]
+
+    @property
+    def covariance(self) -> np.ndarray:
+        return self._covariance[:self.size, :self.size]
+
+    @property
+    def pose(self) -> np.ndarray:
+        return self._state[:POSE_SIZE]
+
+    @property
+    def pose_covariance(self) -> np.ndarray:
+        return self._covariance[:POSE_SIZE, :POSE_SIZE]
+
+    @property
+    def number_of_landmarks(self) -> int:
+        return (self.size - POSE_SIZE) // LANDMARK_SIZE
+
+    @property
+    def landmarks(self) -> np.ndarray:
+        """
+        :return: (L, 2) positions of the landmarks
+        """
+        return self._state[POSE_SIZE:self.size].reshape(-1, LANDMARK_SIZE)
+
+    def landmark_covariance(self, landmark: int) -> np.ndarray:
+        j = self._landmark_slice(landmark)
+        return self._covariance[j, j]
+
+    def _landmark_slice(self, landmark: int) -> slice:
+        start = POSE_SIZE + LANDMARK_SIZE * landmark
+        return slice(start, start + LANDMARK_SIZE)
+
+    def _reserve(self, size: int):
+        capacity = len(self._state)
+        if size <= capacity:
+            return
+        new_capacity = max(2 * capacity, size)
+        state = np.zeros(new_capacity)
+        covariance = np.zeros((new_capacity, new_capacity))
+        state[:self.size] = self._state[:self.size]
+        covariance[:self.size, :self.size] = self._covariance[:self.size, :self.size]
+        self._state = state
+        self._covariance = covariance
+    # endregion
+
+    @profiling.profiled("ekf_slam.predict")
+    def predict(self, distance: float, rotation: float):
+        """
+        The robot moves forward by {distance} and then turns by {rotation}, like Robot.move and Robot.turn.
+
+        :param distance:
+        :param rotation: in radian
+        :return:
+        """
+        n = self.size
+        theta = self._state[2]
+        cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+        self._state[0] += distance * cos_theta
+        self._state[1] += distance * sin_theta
+        self._state[2] = normalize_angle(theta + rotation)
+
+        g = np.array([[1, 0, -distance * sin_theta],
+                      [0, 1, distance * cos_theta],
+                      [0, 0, 1]])
+        # noise on (distance, rotation) mapped to the pose
+        v = np.array([[cos_theta, 0],
+                      [sin_theta, 0],
+                      [0, 1]])
+        m = np.diag([(self.translation_noise * distance) ** 2, (self.rotation_noise * rotation) ** 2])
+
+        p = self._covariance
+        p[:POSE_SIZE, :POSE_SIZE] = g @ p[:POSE_SIZE, :POSE_SIZE] @ g.T + v @ m @ v.T
+        if n > POSE_SIZE:
+            p[:POSE_SIZE, POSE_SIZE:n] = g @ p[:POSE_SIZE, POSE_SIZE:n]
+            p[POSE_SIZE:n, :POSE_SIZE] = p[:POSE_SIZE, POSE_SIZE:n].T
+
+    def expected_position(self, distance: float, bearing: float) -> np.ndarray:
+        x, y, theta = self._state[:POSE_SIZE]
+        return np.array([x + distance * np.cos(theta + bearing), y + distance * np.sin(theta + bearing)])
+
+    def add_landmark(self, distance: float, bearing: float) -> int:
+        """
+        New landmark at the measured position, correlated with the whole state through the pose.
+
+        >>> slam = EkfSlam([0, 0, np.pi / 2])
+        >>> slam.add_landmark(100, -np.pi / 2)
+        0
+        >>> slam.landmarks.round(6).tolist()
+        [[100.0, 0.0]]
+
+        :param distance:
+        :param bearing: angle relative to the robot orientation, in radian
+        :return: index of the landmark
+        """
+        n = self.size
+        self._reserve(n + LANDMARK_SIZE)
+        theta = self._state[2]
+        angle = theta + bearing
+        cos_angle, sin_angle = np.cos(angle), np.sin(angle)
+        self._state[n:n + LANDMARK_SIZE] = self.expected_position(distance, bearing)
+
+        g_pose = np.array([[1, 0, -distance * sin_angle],
+                           [0, 1, distance * cos_angle]])
+        g_measure = np.array([[cos_angle, -distance * sin_angle],
+                              [sin_angle, distance * cos_angle]])
+        p = self._covariance
+        cross = g_pose @ p[:POSE_SIZE, :n]
+        p[n:n + LANDMARK_SIZE, :n] = cross
+        p[:n, n:n + LANDMARK_SIZE] = cross.T
+        p[n:n + LANDMARK_SIZE, n:n + LANDMARK_SIZE] = (g_pose @ p[:POSE_SIZE, :POSE_SIZE] @ g_pose.T
+                                                       + g_measure @ self.measurement_noise @ g_measure.T)
+        self.size = n + LANDMARK_SIZE
+        return self.number_of_landmarks - 1
+
+    def update(self, landmark: int, distance: float, bearing: float, sparse: bool = True) -> np.ndarray:
+        """
+        Range-bearing measurement of a known landmark.
+
+        :param landmark: index of the landmark
+        :param distance:
+        :param bearing: angle relative to the robot orientation, in radian
+        :param sparse: only the rows and columns of the pose and of the landmark are updated if True
+        :return: innovation (distance, bearing)
+        """
+        n = self.size
+        j = self._landmark_slice(landmark)
+        active = np.r_[0:POSE_SIZE, j.start:j.stop]
+
+        delta = self._state[j] - self._state[:2]
+        q = delta @ delta
+        expected_distance = np.sqrt(q)
+        innovation = np.array([distance - expected_distance,
+                               normalize_angle(bearing - np.arctan2(delta[1], delta[0]) + self._state[2])])
+        h = np.array([[-delta[0] / expected_distance, -delta[1] / expected_distance, 0,
+                       delta[0] / expected_distance, delta[1] / expected_distance],
+                      [delta[1] / q, -delta[0] / q, -1, -delta[1] / q, delta[0] / q]])
+
+        p = self._covariance
+        ph_t = p[:n, active] @ h.T  # (n, 2), only the active columns are read
+        s = h @ ph_t[active] + self.measurement_noise
+        k = ph_t @ np.linalg.inv(s)  # (n, 2)
+        self._state[:n] += k @ innovation
+        self._state[2] = normalize_angle(self._state[2])
+
+        ks = k @ s
+        if sparse:
+            p[active, :n] -= ks[active] @ k.T
+            p[:n, active] = p[active, :n].T
+        else:
+            p[:n, :n] -= ks @ k.T
+        return innovation
+
+    def find_landmark(self, distance: float, bearing: float, maximum_distance: float = seuil_association) -> int:
+        """
+        :param distance:
+        :param bearing:
+        :param maximum_distance:
+        :return: index of the closest landmark to the measured position, -1 if none is closer than maximum_distance
+        """
+        if self.number_of_landmarks == 0:
+            return -1
+        distances = np.hypot(*(self.landmarks - self.expected_position(distance, bearing)).T)
+        closest = int(np.argmin(distances))
+        return closest if distances[closest] <= maximum_distance else -1
+
+    @profiling.profiled("ekf_slam.observe")
+    def observe(self, measures: Sequence[Tuple[float, float]], maximum_distance: float = seuil_association,
+                sparse: bool = True) -> np.ndarray:
+        """
+        Updates the state with each measure, landmarks which are not found are added.
+
+        >>> slam = EkfSlam([0, 0, 0], range_noise=1, bearing_noise=0.001)
+        >>> slam.observe([(1000, 0), (1000, np.pi / 2)]).tolist()
+        [0, 1]
+        >>> slam.predict(100, 0)
+        >>> slam.observe([(900, 0), (np.hypot(100, 1000), np.arctan2(1000, -100))]).tolist()
+        [0, 1]
+        >>> slam.pose.round(1).tolist()
+        [100.0, 0.0, 0.0]
+
+        :param measures: [(distance, bearing), ...]
+        :param maximum_distance: association threshold
+        :param sparse:
+        :return: index of the landmark of each measure
+        """
+        indices = []
+        for distance, bearing in measures:
+            landmark = self.find_landmark(distance, bearing, maximum_distance)
+            if landmark < 0:
+                landmark = self.add_landmark(distance, bearing)
+            else:
+                self.update(landmark, distance, bearing, sparse)
+            indices.append(landmark)
+        return np.array(indices, dtype=np.int64)
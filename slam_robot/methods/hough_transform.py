@@ -7,10 +7,14 @@ lines are detected. If an 8 cm line is found, then it is one of the three immobi
 The immobile beacons are used to change basis from the robot's to the table's.
 """
 
-from typing import List, Union
+from typing import List, Optional, Union
 import math
 import numpy as np
 from collections import defaultdict
+from scipy.ndimage import label, maximum_filter
+
+from slam_robot.models.world_items import CartesianLine
+from slam_robot.utils import constants, profiling
 
 __author__ = "Clément Besnier"
 
@@ -37,36 +41,100 @@ def polar_to_y(measure: Union[List, np.ndarray]):
 
 def cartesian_to_polar(cartesian):
     """
+    >>> cartesian_to_polar([0., -2.]).tolist()
+    [4.71238898038469, 2.0]
+    >>> np.round(cartesian_to_polar([[1., 1.], [-1., 0.]]), 6).tolist()
+    [[0.785398, 1.414214], [3.141593, 1.0]]
 
-    :param cartesian: (x, y)
-    :return: (theta, rho), theta in radian
-    """
-    x, y = cartesian
-    if x != 0:
-        if x > 0 and y >= 0:
-            angle = math.atan(y / x)
-        elif x > 0 > y:
-            angle = math.atan(y / x) + 2*math.pi
-        elif x < 0:
-            angle = math.atan(y / x) + math.pi
-        elif x == 0 and y > 0:
-            angle = math.pi/2
-        elif x == 0 and y < 0:
-            angle = 3*math.pi/2
-        else:
-            angle = 0
-        return [angle, math.sqrt(x*x+y*y)]
-    else:
-        return [math.pi/2, y]
+    :param cartesian: (x, y) or (N, 2)
+    :return: (theta, rho) or (N, 2), theta in radian, in [0, 2 pi)
+    """
+    cartesian = np.asarray(cartesian, dtype=float)
+    x, y = cartesian[..., 0], cartesian[..., 1]
+    return np.stack([np.arctan2(y, x) % (2 * np.pi), np.hypot(x, y)], axis=-1)
 
 
-def one_turn_to_cartesian_points(turn: List):
+def one_turn_to_cartesian_points(turn) -> np.ndarray:
     """
+    >>> np.round(one_turn_to_cartesian_points([(0., 2.), (np.pi / 2, 3.)]), 6).tolist()
+    [[2.0, 0.0], [0.0, 3.0]]
 
-    :param turn: [(theta, rho), ...], theta in radian
-    :return: [array(x, y), ...]
+    :param turn: [(theta, rho), ...] or (N, 2), theta in radian
+    :return: (N, 2) array of (x, y)
     """
-    return [np.array([polar_to_x(measure), polar_to_y(measure)]) for measure in turn]
+    turn = np.asarray(turn, dtype=float).reshape(-1, 2)
+    return turn[:, 1:] * np.column_stack([np.cos(turn[:, 0]), np.sin(turn[:, 0])])
+
+
+class TurnConverter:
+    def __init__(self, angles: Optional[np.ndarray] = None,
+                 minimum_distance: float = constants.minimum_distance,
+                 maximum_distance: float = constants.maximum_distance,
+                 threshold_quality: Optional[float] = constants.THRESHOLD_QUALITY):
+        """
+        Filters raw measures of a turn and converts them to cartesian coordinates.
+
+        A measure is kept if its range is in [{minimum_distance}, {maximum_distance}] and its quality is at least
+        {threshold_quality}. When the sensor measures at fixed angles, give them as {angles}: their cosines and sines
+        are computed once, and a turn is then only given by its ranges and qualities.
+
+        >>> converter = TurnConverter(np.deg2rad([0., 90., 180., 270.]))
+        >>> cartesian, polar = converter.convert(np.array([1000., 50., 2000., 4000.]), np.array([47, 47, 10, 47]))
+        >>> np.round(cartesian, 6).tolist(), polar.tolist()
+        ([[1000.0, 0.0]], [[0.0, 1000.0]])
+
+        :param angles: (M,) fixed angles of the measures of a turn, in radian
+        :param minimum_distance:
+        :param maximum_distance:
+        :param threshold_quality: no filter on the quality if None
+        """
+        self.minimum_distance = minimum_distance
+        self.maximum_distance = maximum_distance
+        self.threshold_quality = threshold_quality
+        self.angles = None if angles is None else np.asarray(angles, dtype=float)
+        if self.angles is None:
+            self._cos = self._sin = None
+        else:
+            self._cos = np.cos(self.angles)
+            self._sin = np.sin(self.angles)
+
+    def mask(self, ranges: np.ndarray, qualities: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        :return: (N,) whether each measure passes the filters
+        """
+        kept = (ranges >= self.minimum_distance) & (ranges <= self.maximum_distance)
+        if qualities is not None and self.threshold_quality is not None:
+            kept &= qualities >= self.threshold_quality
+        return kept
+
+    @profiling.profiled("turn_conversion")
+    def convert(self, ranges: np.ndarray, qualities: Optional[np.ndarray] = None,
+                angles: Optional[np.ndarray] = None):
+        """
+        :param ranges: (N,)
+        :param qualities: (N,), not filtered on if None
+        :param angles: (N,) in radian, the fixed angles of the converter if None
+        :return: the kept measures, as (K, 2) (x, y) and (K, 2) (theta, rho)
+        """
+        ranges = np.asarray(ranges, dtype=float)
+        if angles is None:
+            if self.angles is None:
+                raise ValueError("No angles given and the converter has no fixed angles")
+            if len(ranges) != len(self.angles):
+                raise ValueError(f"{len(ranges)} ranges for {len(self.angles)} fixed angles")
+            angles, cos, sin = self.angles, self._cos, self._sin
+        else:
+            angles = np.asarray(angles, dtype=float)
+            cos = sin = None
+        kept = np.flatnonzero(self.mask(ranges, None if qualities is None else np.asarray(qualities)))
+        kept_ranges = ranges[kept]
+        kept_angles = angles[kept]
+        polar = np.column_stack([kept_angles, kept_ranges])
+        if cos is None:
+            cartesian = np.column_stack([kept_ranges * np.cos(kept_angles), kept_ranges * np.sin(kept_angles)])
+        else:
+            cartesian = np.column_stack([kept_ranges * cos[kept], kept_ranges * sin[kept]])
+        return cartesian, polar
 
 
 # def cartesian_points_to_array(cartesian_points):
@@ -80,7 +148,6 @@ def get_width_height(cartesian_points):
     :return:
     """
     points = np.array(cartesian_points)
-    print(points.shape)
     x_min, x_max, y_min, y_max = points[:, 0].min(), points[:, 0].max(), points[:, 1].min(), points[:, 1].max()
     return x_max - x_min, y_max - y_min
 
@@ -92,7 +159,6 @@ def get_mins(cartesian_points):
     :return:
     """
     points = np.array(cartesian_points)
-    print(points.shape)
     x_min, x_max, y_min, y_max = points[:, 0].min(), points[:, 0].max(), points[:, 1].min(), points[:, 1].max()
     return x_min, y_min
 
@@ -112,60 +178,103 @@ def change_basis(cartesian_points):
     return l, [-x_min, -y_min]
 
 
-def hough_transform(cartesian_points, angle_step=0.3):
+def _hough_vote_indices(points: np.ndarray, cos_t: np.ndarray, sin_t: np.ndarray, diag_len: int,
+                        chunk_size: Optional[int] = None):
     """
+    Flat (rho index * len(thetas) + theta index) indices of the votes of the points, one array per chunk of points.
 
+    The rho indices of a chunk of points are computed as one (points x thetas) matrix, so {chunk_size} bounds the
+    memory used by dense scans. Votes whose rho falls outside [0, 2 * diag_len) are dropped.
+    """
+    num_thetas = len(cos_t)
+    theta_indices = np.arange(num_thetas)
+    if chunk_size is None:
+        chunk_size = max(len(points), 1)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        rho_indices = np.rint(np.outer(chunk[:, 0], cos_t) + np.outer(chunk[:, 1], sin_t)).astype(np.int64)
+        rho_indices += diag_len
+        valid = (rho_indices >= 0) & (rho_indices < 2 * diag_len)
+        yield (rho_indices * num_thetas + theta_indices)[valid]
+
+
+def _hough_votes(cartesian_points, cos_t: np.ndarray, sin_t: np.ndarray, diag_len: int, accumulator: np.ndarray,
+                 vote=1, chunk_size: Optional[int] = None):
+    """
+    Adds the votes of all the points in {accumulator}, in place.
+
+    :param cartesian_points: [(x, y), ...]
+    :param cos_t: cosines of the thetas
+    :param sin_t: sines of the thetas
+    :param diag_len: rho index offset, the accumulator has 2 * diag_len rows
+    :param accumulator: (2 * diag_len, len(thetas)) array
+    :param vote: value added for each vote
+    :param chunk_size: number of points processed at once, all of them if None
+    :return:
+    """
+    points = np.asarray(cartesian_points, dtype=float).reshape(-1, 2)
+    if np.issubdtype(accumulator.dtype, np.integer) and len(points) * vote > np.iinfo(accumulator.dtype).max:
+        raise ValueError(f"{accumulator.dtype} accumulator may overflow with {len(points)} points, "
+                         f"use a wider dtype")
+    flat_accumulator = accumulator.reshape(-1)
+    for flat_indices in _hough_vote_indices(points, cos_t, sin_t, diag_len, chunk_size):
+        np.add.at(flat_accumulator, flat_indices, vote)
 
 
+@profiling.profiled("hough")
+def hough_transform(cartesian_points, angle_step=0.3, dtype=np.uint32, vote=20, chunk_size: Optional[int] = None):
+    """
+    >>> accumulator, thetas, rhos = hough_transform([[0, 0], [10, 0], [20, 0], [30, 0]], angle_step=45)
+    >>> accumulator.shape, accumulator.dtype, int(accumulator.max())
+    ((60, 4), dtype('uint32'), 80)
+
     :param cartesian_points:
     :param angle_step:
+    :param dtype: dtype of the accumulator, it must be able to hold len(cartesian_points) * vote
+    :param vote: value added by each vote
+    :param chunk_size: number of points processed at once, all of them if None
     :return: array
     """
     thetas = np.deg2rad(np.arange(-90.0, 90.0, angle_step))
     width, height = get_width_height(cartesian_points)
     diag_len = int(round(math.sqrt(width * width + height * height)))
-    print("diag_len", diag_len)
+    profiling.log_event("hough_transform", number_of_points=len(cartesian_points), diag_len=diag_len)
     rhos = np.linspace(-diag_len, diag_len, diag_len * 2)
     cos_t = np.cos(thetas)
     sin_t = np.sin(thetas)
     num_thetas = len(thetas)
-    accumulator = np.zeros((2 * diag_len, num_thetas), dtype=np.uint8)
+    accumulator = np.zeros((2 * diag_len, num_thetas), dtype=dtype)
 
-    for i in range(len(cartesian_points)):
-        x, y = cartesian_points[i]
-        for t_idx in range(num_thetas):
-            rho = diag_len+int(round(x * cos_t[t_idx] + y * sin_t[t_idx]))
-            if rho < 0:
-                print("rho négatif", rho)
-            accumulator[rho, t_idx] += 20
+    _hough_votes(cartesian_points, cos_t, sin_t, diag_len, accumulator, vote, chunk_size)
     return accumulator, thetas, rhos
 
 
-def hough_transform_to_dict(cartesian_points, angle_step=0.3):
+@profiling.profiled("hough")
+def hough_transform_to_dict(cartesian_points, angle_step=0.3, chunk_size: Optional[int] = None):
     """
+    Only the (rho, theta) cells which received votes are keys of the dict.
 
     :param cartesian_points:
     :param angle_step:
+    :param chunk_size: number of points processed at once, all of them if None
     :return: dict
     """
     thetas = np.deg2rad(np.arange(-90.0, 90.0, angle_step))
     width, height = get_width_height(cartesian_points)
     diag_len = int(round(math.sqrt(width * width + height * height)))
-    print("diag_len", diag_len)
+    profiling.log_event("hough_transform", number_of_points=len(cartesian_points), diag_len=diag_len)
     rhos = np.linspace(-diag_len, diag_len, diag_len * 2)
     cos_t = np.cos(thetas)
     sin_t = np.sin(thetas)
     num_thetas = len(thetas)
+    points = np.asarray(cartesian_points, dtype=float).reshape(-1, 2)
     accumulator = defaultdict(int)
-
-    for i in range(len(cartesian_points)):
-        x, y = cartesian_points[i]
-        for t_idx in range(num_thetas):
-            rho = diag_len+int(round(x * cos_t[t_idx] + y * sin_t[t_idx]))
-            # rho = int(round(x * cos_t[t_idx] + y * sin_t[t_idx]))
-            accumulator[rho, t_idx] += 1
-            if rho < 0:
-                print("rho négatif", rho)
+    # only the cells which received votes are stored, chunk by chunk
+    for flat_indices in _hough_vote_indices(points, cos_t, sin_t, diag_len, chunk_size):
+        cells, counts = np.unique(flat_indices, return_counts=True)
+        for rho_index, theta_index, count in zip((cells // num_thetas).tolist(), (cells % num_thetas).tolist(),
+                                                 counts.tolist()):
+            accumulator[rho_index, theta_index] += count
     return accumulator, thetas, rhos
 
 
@@ -192,9 +301,7 @@ def take_brightest_points(accumulator, thetas, rhos):
         if current_rho < lowest_rho:
             lowest_rho = current_rho
     extrema = [lowest_theta, greatest_theta, lowest_rho, greatest_rho]
-    print("extrema", extrema)
-    print("theta", theta_max)
-    print("rho", rho_max)
+    profiling.log_event("brightest_point", extrema=extrema, theta=theta_max, rho=rho_max)
 
     return [max_value], [thetas[theta_max]], rhos[[rho_max]], extrema
 
@@ -208,6 +315,83 @@ def peak_votes(accumulator, thetas, rhos):
     return idx, theta, rho
 
 
+def dict_to_accumulator(accumulator, number_of_rhos: int, number_of_thetas: int, dtype=np.int64) -> np.ndarray:
+    """
+    Dense accumulator from the dict given by hough_transform_to_dict.
+
+    :param accumulator: {(rho index, theta index): votes}
+    :param number_of_rhos:
+    :param number_of_thetas:
+    :param dtype:
+    :return: (number_of_rhos, number_of_thetas) array
+    """
+    dense = np.zeros((number_of_rhos, number_of_thetas), dtype=dtype)
+    if accumulator:
+        keys = np.array(list(accumulator.keys()), dtype=np.int64)
+        dense[keys[:, 0], keys[:, 1]] = np.fromiter(accumulator.values(), dtype=dtype, count=len(keys))
+    return dense
+
+
+@profiling.profiled("hough.peaks")
+def find_peaks(accumulator, thetas, rhos, number_of_peaks=5, neighbourhood_size=(21, 21), threshold=1):
+    """
+    The {number_of_peaks} strongest lines of the accumulator.
+
+    A cell is a peak if it has at least {threshold} votes and if it is the maximum of the
+    {neighbourhood_size} = (rhos, thetas) window around it. Cells of a plateau count as one peak.
+
+    >>> accumulator = np.zeros((10, 8), dtype=np.uint32)
+    >>> accumulator[2, 3] = 9
+    >>> accumulator[2, 4] = 7
+    >>> accumulator[7, 1] = 5
+    >>> accumulator[7, 6] = 1
+    >>> votes, peak_thetas, peak_rhos = find_peaks(accumulator, np.arange(8), np.linspace(-5, 5, 10), 3, (3, 3), 2)
+    >>> votes.tolist(), peak_thetas.tolist(), peak_rhos.tolist()
+    ([9, 5], [3, 1], [-3.0, 2.0])
+
+    :param accumulator: dense array or dict given by hough_transform or hough_transform_to_dict
+    :param thetas:
+    :param rhos: only its length is used, to get diag_len
+    :param number_of_peaks: maximum number of peaks returned
+    :param neighbourhood_size: size of the non-maximum suppression window, in cells, (rho, theta)
+    :param threshold: minimum number of votes of a peak
+    :return: votes, thetas and rhos of the peaks, strongest first
+    """
+    if isinstance(accumulator, dict):
+        accumulator = dict_to_accumulator(accumulator, len(rhos), len(thetas))
+    local_maxima = maximum_filter(accumulator, size=neighbourhood_size, mode="nearest")
+    peaks = (accumulator == local_maxima) & (accumulator >= threshold)
+
+    # a plateau gives several equal maxima, only the first cell of each one is kept
+    labels, _ = label(peaks)
+    _, first_indices = np.unique(labels.ravel(), return_index=True)
+    first_indices = first_indices[labels.ravel()[first_indices] > 0]
+
+    votes = accumulator.ravel()[first_indices]
+    order = np.argsort(-votes.astype(np.int64), kind="stable")[:number_of_peaks]
+    rho_indices, theta_indices = np.unravel_index(first_indices[order], accumulator.shape)
+    # row i holds the votes of round(rho) == i - diag_len, np.linspace in hough_transform is slightly off
+    diag_len = len(rhos) // 2
+    return votes[order], np.asarray(thetas)[theta_indices], (rho_indices - diag_len).astype(float)
+
+
+def find_lines(accumulator, thetas, rhos, number_of_peaks=5, neighbourhood_size=(21, 21), threshold=1) \
+        -> List[CartesianLine]:
+    """
+    Lines of the peaks given by find_peaks, each is x * cos(theta) + y * sin(theta) = rho.
+
+    :param accumulator:
+    :param thetas:
+    :param rhos:
+    :param number_of_peaks:
+    :param neighbourhood_size:
+    :param threshold:
+    :return: lines, strongest first
+    """
+    _, peak_thetas, peak_rhos = find_peaks(accumulator, thetas, rhos, number_of_peaks, neighbourhood_size, threshold)
+    return [CartesianLine(a, b, c) for a, b, c in zip(np.cos(peak_thetas), np.sin(peak_thetas), peak_rhos)]
+
+
 def theta2gradient(theta):
     return np.cos(theta) / np.sin(theta)
 
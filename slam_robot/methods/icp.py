@@ -0,0 +1,196 @@
+"""
+Iterative Closest Point registration of two scans.
+
+The source scan is moved onto the target scan. At each iteration, the correspondences of all the source points are
+found at once with the KD-tree of the target, the farthest ones are rejected, and the point-to-line error is
+minimised with one 3 x 3 linear solve. The scans can be registered coarse to fine by subsampling them first.
+"""
+
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from slam_robot.models.perception import RobotPerception
+from slam_robot.utils import profiling
+from slam_robot.utils.point_cloud import PointCloud
+from slam_robot.utils.spatial_index import SpatialIndex
+
+
+class IcpResult:
+    def __init__(self, transform: np.ndarray, covariance: np.ndarray, error: float, iterations: int,
+                 converged: bool, number_of_correspondences: int):
+        """
+
+        :param transform: (x, y, theta), source points p are moved to R(theta) p + (x, y)
+        :param covariance: 3 x 3 covariance of the transform
+        :param error: root mean square error of the kept correspondences
+        :param iterations: total number of iterations, over all the resolutions
+        :param converged: whether the last resolution converged
+        :param number_of_correspondences: number of correspondences kept at the last iteration
+        """
+        self.transform = transform
+        self.covariance = covariance
+        self.error = error
+        self.iterations = iterations
+        self.converged = converged
+        self.number_of_correspondences = number_of_correspondences
+
+    def __str__(self):
+        return f"transform: {self.transform}, error: {self.error}, iterations: {self.iterations}"
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        return _apply(self.transform, points)
+
+
+def _to_array(scan: Union[RobotPerception, PointCloud, np.ndarray]) -> np.ndarray:
+    if isinstance(scan, RobotPerception):
+        scan = scan.obstacles
+    if isinstance(scan, PointCloud):
+        return scan.xy
+    return np.asarray(scan, dtype=float).reshape(-1, 2)
+
+
+def _apply(transform: np.ndarray, points: np.ndarray) -> np.ndarray:
+    cos_theta, sin_theta = np.cos(transform[2]), np.sin(transform[2])
+    return points @ np.array([[cos_theta, sin_theta], [-sin_theta, cos_theta]]) + transform[:2]
+
+
+def _compose(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Transform which applies {second} and then {first}.
+    """
+    return np.array([*_apply(first, second[np.newaxis, :2])[0], first[2] + second[2]])
+
+
+def estimate_normals(points: np.ndarray, index: SpatialIndex, number_of_neighbours: int = 5) -> np.ndarray:
+    """
+    Normal of each point, orthogonal to the principal axis of its neighbours.
+
+    >>> points = np.column_stack([np.arange(10.), np.zeros(10)])
+    >>> np.abs(estimate_normals(points, SpatialIndex(points))).round(6).tolist()[:2]
+    [[0.0, 1.0], [0.0, 1.0]]
+
+    :param points: (N, 2)
+    :param index: index of {points}
+    :param number_of_neighbours:
+    :return: (N, 2) unit normals
+    """
+    _, ids = index.k_nearest(points, min(number_of_neighbours, len(points)))
+    neighbours = points[ids]  # (N, k, 2)
+    centered = neighbours - neighbours.mean(axis=1, keepdims=True)
+    xx = np.sum(centered[..., 0] ** 2, axis=1)
+    yy = np.sum(centered[..., 1] ** 2, axis=1)
+    xy = np.sum(centered[..., 0] * centered[..., 1], axis=1)
+    angles = 0.5 * np.arctan2(2 * xy, xx - yy) + np.pi / 2
+    return np.column_stack([np.cos(angles), np.sin(angles)])
+
+
+def _register(source: np.ndarray,
+              target: np.ndarray,
+              transform: np.ndarray,
+              maximum_iterations: int,
+              tolerance: float,
+              maximum_distance: float,
+              inlier_ratio: float,
+              point_to_line: bool) -> Tuple[np.ndarray, np.ndarray, float, int, bool, int]:
+    index = SpatialIndex(target)
+    normals = estimate_normals(target, index) if point_to_line else None
+    jacobians = np.empty((0, 3))
+    errors = np.empty(0)
+    converged = False
+    iteration = 0
+    for iteration in range(1, maximum_iterations + 1):
+        moved = _apply(transform, source)
+        distances, ids = index.nearest(moved, maximum_distance)
+        kept = ids >= 0
+        if np.count_nonzero(kept) > 3:
+            # the worst correspondences are rejected as outliers
+            kept &= distances <= np.quantile(distances[kept], inlier_ratio)
+        if np.count_nonzero(kept) <= 3:
+            break
+        moved = moved[kept]
+        matched = target[ids[kept]]
+        differences = moved - matched
+        # derivative of a point with respect to a small rotation about the origin
+        rotation_derivatives = np.column_stack([-moved[:, 1], moved[:, 0]])
+        if point_to_line:
+            matched_normals = normals[ids[kept]]
+            errors = np.sum(matched_normals * differences, axis=1)
+            jacobians = np.column_stack([matched_normals,
+                                         np.sum(matched_normals * rotation_derivatives, axis=1)])
+        else:
+            errors = differences.reshape(-1)
+            jacobians = np.empty((2 * len(moved), 3))
+            jacobians[0::2] = [1, 0, 0]
+            jacobians[1::2] = [0, 1, 0]
+            jacobians[:, 2] = rotation_derivatives.reshape(-1)
+        hessian = jacobians.T @ jacobians
+        if np.linalg.cond(hessian) > 1e12:
+            break
+        step = -np.linalg.solve(hessian, jacobians.T @ errors)
+        transform = _compose(step, transform)
+        if np.all(np.abs(step) < tolerance):
+            converged = True
+            break
+
+    number_of_equations = len(errors)
+    covariance = np.full((3, 3), np.nan)
+    error = float(np.sqrt(np.mean(errors ** 2))) if number_of_equations > 0 else np.nan
+    if number_of_equations > 3:
+        hessian = jacobians.T @ jacobians
+        if np.linalg.cond(hessian) < 1e12:
+            covariance = np.sum(errors ** 2) / (number_of_equations - 3) * np.linalg.inv(hessian)
+    number_of_correspondences = number_of_equations if point_to_line else number_of_equations // 2
+    return transform, covariance, error, iteration, converged, number_of_correspondences
+
+
+@profiling.profiled("icp")
+def icp(source: Union[RobotPerception, PointCloud, np.ndarray],
+        target: Union[RobotPerception, PointCloud, np.ndarray],
+        initial_transform: Optional[Sequence[float]] = None,
+        maximum_iterations: int = 30,
+        tolerance: float = 1e-4,
+        maximum_distance: float = np.inf,
+        inlier_ratio: float = 0.9,
+        point_to_line: bool = True,
+        subsampling_steps: Sequence[int] = (1,)) -> IcpResult:
+    """
+    Transform which moves {source} onto {target}.
+
+    >>> thetas = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    >>> target = np.column_stack([1000 * np.cos(thetas), 500 * np.sin(thetas)])
+    >>> cos_t, sin_t = np.cos(0.05), np.sin(0.05)
+    >>> source = (target - [30, -20]) @ np.array([[cos_t, -sin_t], [sin_t, cos_t]])
+    >>> result = icp(source, target, subsampling_steps=(4, 1))
+    >>> result.converged, np.round(result.transform, 3).tolist()
+    (True, [30.0, -20.0, 0.05])
+
+    :param source: scan which is moved
+    :param target: reference scan
+    :param initial_transform: (x, y, theta), from the odometry for instance, identity if None
+    :param maximum_iterations: per resolution
+    :param tolerance: the iterations stop when every component of the update is smaller
+    :param maximum_distance: correspondences farther than it are rejected
+    :param inlier_ratio: ratio of the closest correspondences kept at each iteration
+    :param point_to_line: point-to-line error if True, point-to-point error otherwise
+    :param subsampling_steps: one resolution per step, coarse to fine, only one point every step is used
+    :return:
+    """
+    source = _to_array(source)
+    target = _to_array(target)
+    transform = np.zeros(3) if initial_transform is None else np.asarray(initial_transform, dtype=float)
+    covariance = np.full((3, 3), np.nan)
+    error = np.nan
+    total_iterations = 0
+    converged = False
+    number_of_correspondences = 0
+    for step in subsampling_steps:
+        sub_source = source[::step]
+        sub_target = target[::step]
+        if len(sub_source) < 4 or len(sub_target) < 4:
+            continue
+        transform, covariance, error, iterations, converged, number_of_correspondences = _register(
+            sub_source, sub_target, transform, maximum_iterations, tolerance, maximum_distance, inlier_ratio,
+            point_to_line)
+        total_iterations += iterations
+    return IcpResult(transform, covariance, error, total_iterations, converged, number_of_correspondences)
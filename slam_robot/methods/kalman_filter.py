@@ -4,9 +4,14 @@
 Inspired by https://github.com/hermes-project/lidar.
 """
 
+import threading
+
+import numpy as np
 from numpy import array, eye
 from math import cos, sin
-from numpy.linalg import inv
+
+import slam_robot.utils.constants as constants
+from slam_robot.utils import profiling
 
 
 __author__ = ["https://github.com/hermes-project/lidar", ]
@@ -27,32 +32,254 @@ def ekf(te, y_k, x_kalm_prec, p_kalm_prec, dt, sigma_q, sigma_angle, sigma_dista
     :return: x_kalm, p_kalm: Le couple du vecteur position estimé et la matrice de covariance estimée (x_k|k , p_k|k)
     """
 
-    te = dt*te
+    tracker = _get_tracker(dt, sigma_q, sigma_angle, sigma_distance)
+    tracker.set_state(x_kalm_prec, p_kalm_prec)
+    x_kalm, p_kalm = tracker.step(te, y_k)
+    return x_kalm.copy(), p_kalm.copy()
+
+
+# un filtre par thread et par jeu de paramètres : ekf reste réentrant, utilisable depuis plusieurs threads
+_local = threading.local()
+maximum_cached_trackers = 8
+
+
+def _get_tracker(dt, sigma_q, sigma_angle, sigma_distance) -> 'KalmanTracker':
+    trackers = getattr(_local, "trackers", None)
+    if trackers is None:
+        trackers = _local.trackers = {}
+    key = (dt, sigma_q, sigma_angle, sigma_distance)
+    if key not in trackers:
+        if len(trackers) >= maximum_cached_trackers:
+            del trackers[next(iter(trackers))]
+        trackers[key] = KalmanTracker(dt, sigma_q, sigma_angle, sigma_distance)
+    return trackers[key]
+
+
+class KalmanTracker:
+    """
+    Stateful version of ekf.
+
+    The model matrices only depend on the elapsed time, so they are computed once per distinct elapsed time and
+    cached. The state, the covariance and every intermediate result live in preallocated buffers, and the covariance
+    is updated with the Joseph form, which keeps it symmetric and positive.
+    """
+    maximum_cached_models = 32
+
+    def __init__(self, dt, sigma_q=constants.sigma_q, sigma_angle=constants.sigma_angle,
+                 sigma_distance=constants.sigma_distance, x_kalm=None, p_kalm=None):
+        """
+        :param dt: facteur appliqué au temps écoulé
+        :param sigma_q:
+        :param sigma_angle:
+        :param sigma_distance:
+        :param x_kalm: état initial [x, vitesse_x, y, vitesse_y], nul si None
+        :param p_kalm: covariance initiale, identité si None
+        """
+        self.dt = dt
+        self.sigma_q = sigma_q
+        self.r = array([[sigma_angle ** 2, 0],
+                        [0, sigma_distance ** 2]], dtype=float)
+        self.h = array([[1, 0, 0, 0], [0, 0, 1, 0]], dtype=float)
+        self._identity = eye(4)
+        self._models = {}
+
+        # region buffers
+        self.x_kalm = np.zeros(4)
+        self.p_kalm = eye(4)
+        self._x_predit = np.empty(4)
+        self._p_predit = np.empty((4, 4))
+        self._fp = np.empty((4, 4))
+        self._ph_t = np.empty((4, 2))
+        self._s = np.empty((2, 2))
+        self._s_inv = np.empty((2, 2))
+        self._k = np.empty((4, 2))
+        self._kr = np.empty((4, 2))
+        self._i_kh = np.empty((4, 4))
+        self._joseph = np.empty((4, 4))
+        self._y = np.empty(2)
+        self._innovation = np.empty(2)
+        # endregion
+        self.set_state(x_kalm, p_kalm)
+
+    def set_state(self, x_kalm=None, p_kalm=None):
+        self.x_kalm[:] = 0 if x_kalm is None else x_kalm
+        self.p_kalm[:] = self._identity if p_kalm is None else p_kalm
+
+    def model(self, te):
+        """
+        :param te: Temps écoulé depuis la dernière mesure
+        :return: f, f^T and q, cached
+        """
+        if te not in self._models:
+            if len(self._models) >= self.maximum_cached_models:
+                del self._models[next(iter(self._models))]
+            scaled_te = self.dt * te
+            f = array([[1, scaled_te, 0, 0],
+                       [0, 1, 0, 0],
+                       [0, 0, 1, scaled_te],
+                       [0, 0, 0, 1]], dtype=float)
+            q = self.sigma_q * array([[(scaled_te ** 3) / 3, (scaled_te ** 2) / 2, 0, 0],
+                                      [(scaled_te ** 2) / 2, scaled_te, 0, 0],
+                                      [0, 0, (scaled_te ** 3) / 3, (scaled_te ** 2) / 2],
+                                      [0, 0, (scaled_te ** 2) / 2, scaled_te]], dtype=float)
+            self._models[te] = (f, np.ascontiguousarray(f.T), q)
+        return self._models[te]
+
+    def predict(self, te):
+        """
+        Prédiction: passage de x_k|k, p_k|k à x_k+1|k, p_k+1|k
+        :param te: Temps écoulé depuis la dernière mesure
+        """
+        f, f_t, q = self.model(te)
+        np.dot(f, self.x_kalm, out=self._x_predit)
+        np.dot(f, self.p_kalm, out=self._fp)
+        np.dot(self._fp, f_t, out=self._p_predit)
+        self._p_predit += q
+        self.x_kalm[:] = self._x_predit
+        self.p_kalm[:] = self._p_predit
+
+    def update(self, y_k):
+        """
+        Mise à jour: passage de x_k+1|k, p_k+1|k à x_k+1|k+1, p_k+1|k+1
+        :param y_k: Le vecteur des mesures, sous la forme numpy.array([angle,distance])
+        """
+        self._y[0] = y_k[1] * cos(y_k[0])
+        self._y[1] = y_k[1] * sin(y_k[0])
+
+        # h sélectionne x et y, donc p.h^T et h.p.h^T sont des blocs de p
+        self._ph_t[:, 0] = self.p_kalm[:, 0]
+        self._ph_t[:, 1] = self.p_kalm[:, 2]
+        self._s[0] = self._ph_t[0]
+        self._s[1] = self._ph_t[2]
+        self._s += self.r
+        determinant = self._s[0, 0] * self._s[1, 1] - self._s[0, 1] * self._s[1, 0]
+        self._s_inv[0, 0] = self._s[1, 1] / determinant
+        self._s_inv[1, 1] = self._s[0, 0] / determinant
+        self._s_inv[0, 1] = -self._s[0, 1] / determinant
+        self._s_inv[1, 0] = -self._s[1, 0] / determinant
+        np.dot(self._ph_t, self._s_inv, out=self._k)  # Gain de Kalman optimal
+
+        self._innovation[0] = self._y[0] - self.x_kalm[0]
+        self._innovation[1] = self._y[1] - self.x_kalm[2]
+        np.dot(self._k, self._innovation, out=self._x_predit)
+        self.x_kalm += self._x_predit  # Etat mis à jour
+
+        # forme de Joseph: (I - k.h).p.(I - k.h)^T + k.r.k^T
+        np.dot(self._k, self.h, out=self._i_kh)
+        np.subtract(self._identity, self._i_kh, out=self._i_kh)
+        np.dot(self._i_kh, self.p_kalm, out=self._fp)
+        np.dot(self._fp, self._i_kh.T, out=self._joseph)
+        np.dot(self._k, self.r, out=self._kr)
+        np.dot(self._kr, self._k.T, out=self.p_kalm)
+        self.p_kalm += self._joseph  # Mise à jour de la covariance
+
+    @profiling.profiled("ekf")
+    def step(self, te, y_k):
+        """
+        :param te: Temps écoulé depuis la dernière mesure
+        :param y_k: Le vecteur des mesures, sous la forme numpy.array([angle,distance])
+        :return: x_kalm, p_kalm, ce sont les buffers de l'objet, à copier pour les garder
+        """
+        self.predict(te)
+        self.update(y_k)
+        return self.x_kalm, self.p_kalm
+
+
+class MultiTargetEKF:
+    """
+    Same filter as ekf, for N targets at once.
+
+    States and covariances are stacked in (N, 4) and (N, 4, 4) arrays, and the prediction and the update of all the
+    targets are done with einsum. The 2 x 2 innovation matrices are inverted in closed form.
+    """
+    def __init__(self, x_kalm, p_kalm, dt, sigma_q, sigma_angle, sigma_distance):
+        """
+        :param x_kalm: (N, 4) états [x, vitesse_x, y, vitesse_y]
+        :param p_kalm: (N, 4, 4) matrices de covariance, identité pour chaque cible si None
+        :param dt:
+        :param sigma_q:
+        :param sigma_angle:
+        :param sigma_distance:
+        """
+        self.x_kalm = np.array(x_kalm, dtype=float).reshape(-1, 4)
+        if p_kalm is None:
+            p_kalm = np.broadcast_to(eye(4), (len(self.x_kalm), 4, 4))
+        self.p_kalm = np.array(p_kalm, dtype=float).reshape(-1, 4, 4)
+        self.dt = dt
+        self.sigma_q = sigma_q
+        self.r = array([[sigma_angle ** 2, 0],
+                        [0, sigma_distance ** 2]])
 
-    f = array([[1, te, 0, 0],
-               [0, 1, 0, 0],
-               [0, 0, 1, te],
-               [0, 0, 0, 1]])
+    def __len__(self):
+        return len(self.x_kalm)
 
-    q = sigma_q * array([[(te ** 3) / 3, (te ** 2) / 2, 0, 0],
-                        [(te ** 2) / 2, te, 0, 0],
-                        [0, 0, (te ** 3) / 3, (te ** 2) / 2],
-                        [0, 0, (te ** 2) / 2, te]])
+    def add_targets(self, x_kalm, p_kalm=None):
+        x_kalm = np.array(x_kalm, dtype=float).reshape(-1, 4)
+        if p_kalm is None:
+            p_kalm = np.broadcast_to(eye(4), (len(x_kalm), 4, 4))
+        self.x_kalm = np.concatenate([self.x_kalm, x_kalm])
+        self.p_kalm = np.concatenate([self.p_kalm, np.array(p_kalm, dtype=float).reshape(-1, 4, 4)])
 
-    r = array([[sigma_angle ** 2, 0],
-               [0, sigma_distance ** 2]])
+    def remove_targets(self, mask):
+        """
+        :param mask: (N,) True pour les cibles à supprimer
+        """
+        kept = ~np.asarray(mask, dtype=bool)
+        self.x_kalm = self.x_kalm[kept]
+        self.p_kalm = self.p_kalm[kept]
 
-    h = array([[1, 0, 0, 0], [0, 0, 1, 0]])
+    def predict(self, te):
+        """
+        Passage de x_k|k, p_k|k à x_k+1|k, p_k+1|k pour toutes les cibles.
+        :param te: Temps écoulé depuis la dernière mesure, commun ou (N,) un par cible
+        """
+        te = self.dt * np.broadcast_to(np.asarray(te, dtype=float), (len(self),))
+        f = np.broadcast_to(eye(4), (len(self), 4, 4)).copy()
+        f[:, 0, 1] = te
+        f[:, 2, 3] = te
+        q = np.zeros((len(self), 4, 4))
+        q[:, 0, 0] = q[:, 2, 2] = te ** 3 / 3
+        q[:, 0, 1] = q[:, 1, 0] = q[:, 2, 3] = q[:, 3, 2] = te ** 2 / 2
+        q[:, 1, 1] = q[:, 3, 3] = te
+        self.x_kalm = np.einsum("nij,nj->ni", f, self.x_kalm)
+        self.p_kalm = np.einsum("nij,njk,nlk->nil", f, self.p_kalm, f) + self.sigma_q * q
 
-    y_k = array([y_k[1]*cos(y_k[0]), y_k[1]*sin(y_k[0])])
+    def update(self, y_k, mask=None):
+        """
+        Passage de x_k+1|k, p_k+1|k à x_k+1|k+1, p_k+1|k+1 pour les cibles mesurées.
+        :param y_k: (N, 2) mesures [angle, distance]
+        :param mask: (N,) True pour les cibles qui ont une mesure, toutes si None
+        """
+        selected = slice(None) if mask is None else np.flatnonzero(mask)
+        y_k = np.asarray(y_k, dtype=float).reshape(-1, 2)[selected]
+        x_predit = self.x_kalm[selected]
+        p_predit = self.p_kalm[selected]
 
-    # prediction: passage de x_k|k, p_k|k à x_k+1|k, p_k+1|k
-    x_predit = f.dot(x_kalm_prec)  # Etat prédit
-    p_predit = f.dot(p_kalm_prec).dot(f.T) + q  # Estimation prédite de la covariance
+        y_k = np.column_stack([y_k[:, 1] * np.cos(y_k[:, 0]), y_k[:, 1] * np.sin(y_k[:, 0])])
+        # h sélectionne x et y: h.p.h^T est un bloc de p
+        ph_t = p_predit[:, :, [0, 2]]  # (n, 4, 2)
+        s = ph_t[:, [0, 2], :] + self.r  # (n, 2, 2)
+        determinant = s[:, 0, 0] * s[:, 1, 1] - s[:, 0, 1] * s[:, 1, 0]
+        s_inv = np.empty_like(s)
+        s_inv[:, 0, 0] = s[:, 1, 1]
+        s_inv[:, 1, 1] = s[:, 0, 0]
+        s_inv[:, 0, 1] = -s[:, 0, 1]
+        s_inv[:, 1, 0] = -s[:, 1, 0]
+        s_inv /= determinant[:, np.newaxis, np.newaxis]
 
-    # mise à jour: passage de x_k+1|k, p_k+1|k à x_k+1|k+1, p_k+1|k+1
-    k = p_predit.dot(h.T).dot(inv(h.dot(p_predit).dot(h.T) + r))  # Gain de Kalman optimal
-    x_kalm = x_predit + k.dot(y_k - h.dot(x_predit))  # Etat mis à jour
-    p_kalm = (eye(4) - k.dot(h)).dot(p_predit)  # Mise à jour de la covariance
+        k = np.einsum("nij,njk->nik", ph_t, s_inv)  # Gain de Kalman optimal
+        innovation = y_k - x_predit[:, [0, 2]]
+        self.x_kalm[selected] = x_predit + np.einsum("nij,nj->ni", k, innovation)
+        self.p_kalm[selected] = p_predit - np.einsum("nij,njk->nik", k, p_predit[:, [0, 2], :])
 
-    return x_kalm, p_kalm
+    @profiling.profiled("ekf.multi_target")
+    def step(self, te, y_k, mask=None):
+        """
+        :param te:
+        :param y_k: (N, 2) mesures [angle, distance]
+        :param mask: (N,) True pour les cibles qui ont une mesure
+        :return: états (N, 4) et covariances (N, 4, 4)
+        """
+        self.predict(te)
+        self.update(y_k, mask)
+        return self.x_kalm, self.p_kalm
@@ -0,0 +1,248 @@
+"""
+Monte Carlo localization against a known world.
+
+Particles are (x, y, theta) poses stored in one (N, 3) array. The motion model moves all of them at once, the expected
+scans of all the particles are computed with one call to World.cast_rays, and resampling is the low-variance scheme.
+The number of particles is adapted after each resampling with the KLD bound, capped by the time budget of a turn.
+"""
+
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+
+from slam_robot.models.action import Action, Move, Turn
+from slam_robot.models.likelihood_field import LikelihoodField
+from slam_robot.models.perception import RobotPerception
+from slam_robot.models.world import World
+from slam_robot.utils import profiling
+
+
+class MonteCarloLocalization:
+    def __init__(self,
+                 world: World,
+                 number_of_particles: int = 1000,
+                 initial_pose: Optional[Sequence[float]] = None,
+                 initial_spread: Sequence[float] = (10., 10., 0.1),
+                 translation_noise: float = 0.05,
+                 rotation_noise: float = 0.05,
+                 range_noise: float = 5.,
+                 maximum_range: float = 1000.,
+                 number_of_beams: int = 30,
+                 minimum_particles: int = 100,
+                 maximum_particles: int = 5000,
+                 kld_error: float = 0.05,
+                 kld_quantile: float = 2.33,
+                 bin_size: Sequence[float] = (5., 5., 0.1),
+                 time_budget: Optional[float] = None,
+                 likelihood_field: Optional[LikelihoodField] = None,
+                 seed: Optional[int] = None):
+        """
+
+        :param world: known world
+        :param number_of_particles: initial number of particles
+        :param initial_pose: (x, y, theta), particles are spread uniformly in the world if None
+        :param initial_spread: standard deviations around {initial_pose}
+        :param translation_noise: standard deviation of the translation per unit of distance travelled
+        :param rotation_noise: standard deviation of the rotation per radian turned
+        :param range_noise: standard deviation of the measured distances
+        :param maximum_range: expected distances are clipped to it
+        :param number_of_beams: number of beams of a scan used to weight the particles
+        :param minimum_particles:
+        :param maximum_particles:
+        :param kld_error: maximum Kullback-Leibler divergence between the particles and the true distribution
+        :param kld_quantile: upper quantile of the standard normal distribution, 2.33 for 0.99
+        :param bin_size: size of the (x, y, theta) bins used to count the occupied bins of the KLD bound
+        :param time_budget: time allowed to one update, in seconds, the number of particles is capped so that the next
+        update stays within it
+        :param likelihood_field: if given, scans are scored with it instead of casting rays, see World.likelihood_field
+        :param seed: seed of the random generator
+        """
+        self.world = world
+        self.rng = np.random.default_rng(seed)
+        self.translation_noise = translation_noise
+        self.rotation_noise = rotation_noise
+        self.range_noise = range_noise
+        self.maximum_range = maximum_range
+        self.number_of_beams = number_of_beams
+        self.minimum_particles = minimum_particles
+        self.maximum_particles = maximum_particles
+        self.kld_error = kld_error
+        self.kld_quantile = kld_quantile
+        self.bin_size = np.asarray(bin_size, dtype=float)
+        self.time_budget = time_budget
+        self.likelihood_field = likelihood_field
+        # duration of the last update and of the last resampling, and total duration of the moves and turns since
+        # the update before them
+        self.timings = {"predict": 0., "update": 0., "resample": 0.}
+        self._prediction_started = False
+
+        if initial_pose is None:
+            self.particles = np.column_stack([self.rng.uniform(0, world.limit_x, number_of_particles),
+                                              self.rng.uniform(0, world.limit_y, number_of_particles),
+                                              self.rng.uniform(-np.pi, np.pi, number_of_particles)])
+        else:
+            self.particles = np.asarray(initial_pose, dtype=float) + \
+                self.rng.normal(size=(number_of_particles, 3)) * np.asarray(initial_spread, dtype=float)
+        self.weights = np.full(number_of_particles, 1 / number_of_particles)
+
+    def __len__(self):
+        return len(self.particles)
+
+    # region motion model
+    def _add_prediction_time(self, duration: float):
+        if not self._prediction_started:
+            self.timings["predict"] = 0.
+            self._prediction_started = True
+        self.timings["predict"] += duration
+
+    @profiling.profiled("localization.predict")
+    def move(self, distance: float):
+        start = time.perf_counter()
+        distances = distance + self.rng.normal(size=len(self)) * self.translation_noise * abs(distance)
+        self.particles[:, 0] += distances * np.cos(self.particles[:, 2])
+        self.particles[:, 1] += distances * np.sin(self.particles[:, 2])
+        self._add_prediction_time(time.perf_counter() - start)
+
+    @profiling.profiled("localization.predict")
+    def turn(self, angle: float):
+        start = time.perf_counter()
+        self.particles[:, 2] += angle + self.rng.normal(size=len(self)) * self.rotation_noise * abs(angle)
+        self._add_prediction_time(time.perf_counter() - start)
+
+    def apply_action(self, action: Action, velocity: Optional[float] = None,
+                     rotation_velocity: Optional[float] = None):
+        """
+        Moves the particles like action.apply moves the robot.
+
+        :param action: Move or Turn, other actions do not move the robot
+        :param velocity: velocity of the robot, used if the action does not set it
+        :param rotation_velocity: rotation velocity of the robot, used if the action does not set it
+        :return:
+        """
+        if isinstance(action, Move):
+            velocity = action.velocity or velocity
+            if action.distance is not None:
+                self.move(action.distance)
+            elif action.duration and velocity is not None:
+                self.move(velocity * action.duration)
+        elif isinstance(action, Turn):
+            rotation_velocity = action.rotation_velocity if action.rotation_velocity is not None \
+                else rotation_velocity
+            if action.angle is not None:
+                self.turn(action.angle)
+            elif action.duration and rotation_velocity is not None:
+                self.turn(rotation_velocity * action.duration)
+    # endregion
+
+    # region measurement model
+    @profiling.profiled("localization.update")
+    def update(self, perception: RobotPerception):
+        """
+        Weights the particles by comparing their expected scans with the observed one.
+
+        The angles of the obstacles are taken relative to the orientation of the robot when it is known, since a lidar
+        measures angles in its own frame.
+
+        :param perception: obstacles with their angles and ranges, as given by Robot.sense
+        :return:
+        """
+        start = time.perf_counter()
+        obstacles = perception.obstacles
+        if len(obstacles) == 0:
+            return
+        if obstacles.angles is None or obstacles.ranges is None:
+            relative = obstacles.xy - perception.position.to_array()
+            angles = np.arctan2(relative[:, 1], relative[:, 0])
+            ranges = np.hypot(relative[:, 0], relative[:, 1])
+        else:
+            angles, ranges = obstacles.angles, obstacles.ranges
+        if perception.orientation is not None:
+            angles = angles - perception.orientation
+        beams = np.unique(np.linspace(0, len(angles) - 1, self.number_of_beams).astype(np.int64))
+        angles = angles[beams]
+        ranges = ranges[beams]
+
+        if self.likelihood_field is not None:
+            points = ranges[:, np.newaxis] * np.column_stack([np.cos(angles), np.sin(angles)])
+            log_likelihoods = self.likelihood_field.score_poses(self.particles, points, self.range_noise)
+        else:
+            expected = self.world.cast_rays(self.particles[:, :2], self.particles[:, 2:3] + angles)  # (N, B)
+            np.minimum(expected, self.maximum_range, out=expected)
+            # a small uniform term keeps one wrong beam from killing a good particle
+            likelihoods = np.exp(-0.5 * ((expected - ranges) / self.range_noise) ** 2) + 1e-3
+            log_likelihoods = np.sum(np.log(likelihoods), axis=1)
+        log_weights = np.log(self.weights) + log_likelihoods
+        log_weights -= log_weights.max()
+        self.weights = np.exp(log_weights)
+        self.weights /= self.weights.sum()
+        self.timings["update"] = time.perf_counter() - start
+        self._prediction_started = False
+    # endregion
+
+    # region resampling
+    @property
+    def effective_sample_size(self) -> float:
+        return 1 / np.sum(self.weights ** 2)
+
+    def kld_number_of_particles(self, particles: np.ndarray) -> int:
+        """
+        Number of particles needed so that the divergence to the true distribution is below kld_error with
+        probability given by kld_quantile, given the number of occupied bins.
+
+        :param particles: (N, 3)
+        :return:
+        """
+        bins = np.floor(particles / self.bin_size).astype(np.int64)
+        k = len(np.unique(bins, axis=0))
+        if k <= 1:
+            return self.minimum_particles
+        a = 2 / (9 * (k - 1))
+        n = (k - 1) / (2 * self.kld_error) * (1 - a + np.sqrt(a) * self.kld_quantile) ** 3
+        return int(np.ceil(n))
+
+    @profiling.profiled("localization.resample")
+    def resample(self, number_of_particles: Optional[int] = None):
+        """
+        Low-variance resampling: one random offset and {number_of_particles} evenly spaced pointers.
+
+        :param number_of_particles: adapted with kld_number_of_particles and the time budget if None
+        :return:
+        """
+        start = time.perf_counter()
+        if number_of_particles is None:
+            number_of_particles = self.kld_number_of_particles(self.particles)
+            if self.time_budget is not None and self.timings["update"] > 0:
+                time_per_particle = self.timings["update"] / len(self)
+                number_of_particles = min(number_of_particles, int(self.time_budget / time_per_particle))
+            number_of_particles = int(np.clip(number_of_particles, self.minimum_particles, self.maximum_particles))
+        pointers = (self.rng.uniform() + np.arange(number_of_particles)) / number_of_particles
+        cumulative = np.cumsum(self.weights)
+        cumulative[-1] = 1.
+        indices = np.searchsorted(cumulative, pointers)
+        self.particles = self.particles[indices]
+        self.weights = np.full(number_of_particles, 1 / number_of_particles)
+        self.timings["resample"] = time.perf_counter() - start
+    # endregion
+
+    def step(self, perception: RobotPerception, resampling_threshold: float = 0.5):
+        """
+        Weights the particles and resamples them when the effective sample size is below
+        {resampling_threshold} times the number of particles.
+
+        :param perception:
+        :param resampling_threshold:
+        :return: estimated pose
+        """
+        self.update(perception)
+        if self.effective_sample_size < resampling_threshold * len(self):
+            self.resample()
+        return self.estimate()
+
+    def estimate(self) -> np.ndarray:
+        """
+        :return: weighted mean (x, y, theta), theta is a circular mean
+        """
+        x, y = self.weights @ self.particles[:, :2]
+        theta = np.arctan2(self.weights @ np.sin(self.particles[:, 2]), self.weights @ np.cos(self.particles[:, 2]))
+        return np.array([x, y, theta])
@@ -0,0 +1,356 @@
+"""
+Streaming perception pipeline.
+
+A stage is a generator function: it takes an iterator of inputs and yields outputs, so it may keep state from one
+turn to the next, like a tracker, and yield zero, one or several outputs per input. Each stage runs in its own thread
+and stages are linked by bounded queues. When a queue is full, its oldest item is dropped: a stage which falls behind
+skips turns instead of working on stale ones, and the stages after it keep receiving the latest turns.
+
+Each stage records the time between receiving an input and yielding its outputs, and the number of inputs dropped
+before it. The pipeline records the end-to-end latency, from the time a turn was taken from the source to the time it
+comes out of the last stage.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from slam_robot.methods.circle_fitting import fit_cluster_circles
+from slam_robot.methods.hough_transform import TurnConverter
+from slam_robot.methods.kalman_filter import MultiTargetEKF
+from slam_robot.models.perception import Cluster, RobotPerception
+from slam_robot.utils import constants
+from slam_robot.utils.geometry import Point
+from slam_robot.utils.lidar import LidarTurn
+from slam_robot.utils.point_cloud import PointCloud
+from slam_robot.utils.profiling import SpanStatistics
+
+_CLOSED = object()
+
+
+class DropOldestQueue:
+    def __init__(self, maximum_size: int):
+        """
+        Thread-safe queue which drops its oldest item when an item is put while it is full.
+
+        >>> queue = DropOldestQueue(2)
+        >>> [queue.put(item) for item in "abc"]
+        [False, False, True]
+        >>> queue.close()
+        >>> queue.get(), queue.get(), queue.get() is _CLOSED, queue.dropped
+        ('b', 'c', True, 1)
+
+        :param maximum_size:
+        """
+        self._items = deque()
+        self.maximum_size = maximum_size
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item: Any) -> bool:
+        """
+        :return: whether an item was dropped
+        """
+        with self._condition:
+            dropped = len(self._items) >= self.maximum_size
+            if dropped:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+            return dropped
+
+    def get(self) -> Any:
+        """
+        Waits for an item.
+
+        :return: the oldest item, _CLOSED once the queue is closed and empty
+        """
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if self._items:
+                return self._items.popleft()
+            return _CLOSED
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class Stage:
+    def __init__(self, name: str, function: Callable[[Iterator[Any]], Iterator[Any]], queue_size: int = 2):
+        """
+
+        :param name:
+        :param function: generator function, from the iterator of inputs to the outputs
+        :param queue_size: size of the queue of inputs of this stage
+        """
+        self.name = name
+        self.function = function
+        self.queue_size = queue_size
+        self.latency = SpanStatistics()
+        self.received = 0
+        self.emitted = 0
+        self.queue: Optional[DropOldestQueue] = None
+
+    @property
+    def dropped(self) -> int:
+        return 0 if self.queue is None else self.queue.dropped
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], output_queue_size: int = 2, join_timeout: float = 1.):
+        """
+        >>> def double(items):
+        ...     for item in items:
+        ...         yield 2 * item
+        >>> def running_sum(items):
+        ...     total = 0
+        ...     for item in items:
+        ...         total += item
+        ...         yield total
+        >>> pipeline = Pipeline([Stage("double", double, 10), Stage("sum", running_sum, 10)], 10)
+        >>> list(pipeline.run(range(5)))
+        [0, 2, 6, 12, 20]
+
+        The statistics are those of the last run:
+
+        >>> list(pipeline.run(range(3))), pipeline.stages[0].received
+        ([0, 2, 6], 3)
+
+        :param stages: in order
+        :param output_queue_size: size of the queue between the last stage and the consumer
+        :param join_timeout: time given to the threads of a run to stop once it ends, in seconds
+        """
+        self.stages = stages
+        self.output_queue_size = output_queue_size
+        self.join_timeout = join_timeout
+        self.latency = SpanStatistics()
+
+    def _run_source(self, source: Iterable, queue: DropOldestQueue, stop: threading.Event,
+                    errors: List[BaseException]):
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                queue.put((time.perf_counter(), item))
+        except BaseException as error:
+            errors.append(error)
+        finally:
+            queue.close()
+
+    def _run_stage(self, stage: Stage, input_queue: DropOldestQueue, output_queue: DropOldestQueue,
+                   stop: threading.Event, errors: List[BaseException]):
+        # arrival time of the turn and time its processing started, for the input being processed
+        current = [0., 0.]
+
+        def inputs():
+            while not stop.is_set():
+                envelope = input_queue.get()
+                if envelope is _CLOSED:
+                    return
+                stage.received += 1
+                current[0], current[1] = envelope[0], time.perf_counter()
+                yield envelope[1]
+
+        try:
+            for output in stage.function(inputs()):
+                stage.latency.record(time.perf_counter() - current[1])
+                stage.emitted += 1
+                output_queue.put((current[0], output))
+        except BaseException as error:
+            errors.append(error)
+        finally:
+            output_queue.close()
+
+    def run(self, source: Iterable) -> Iterator[Any]:
+        """
+        Starts the threads and yields the outputs of the last stage. Closing the generator stops the pipeline and waits
+        for its threads, at most {self.join_timeout} seconds each.
+
+        The statistics are reset at the start of each run. Each run has its own stop flag, so the threads of a previous
+        run which did not stop in time never take the inputs of a new one.
+
+        :param source: turns, iterated in a thread of its own
+        :return:
+        """
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        self.latency = SpanStatistics()
+        queues = []
+        for stage in self.stages:
+            stage.latency = SpanStatistics()
+            stage.received = 0
+            stage.emitted = 0
+            stage.queue = DropOldestQueue(stage.queue_size)
+            queues.append(stage.queue)
+        output_queue = DropOldestQueue(self.output_queue_size)
+        queues.append(output_queue)
+
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0], stop, errors), name="source",
+                                    daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage,
+                                            args=(stage, queues[i], queues[i + 1], stop, errors),
+                                            name=stage.name, daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                envelope = output_queue.get()
+                if envelope is _CLOSED:
+                    break
+                self.latency.record(time.perf_counter() - envelope[0])
+                yield envelope[1]
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for queue in queues:
+                queue.close()
+            for thread in threads:
+                thread.join(self.join_timeout)
+
+    def report(self) -> dict:
+        """
+        :return: for each stage, the number of inputs received and dropped, outputs emitted and the latency statistics
+        in seconds, and the end-to-end latency
+        """
+        stages = {stage.name: {"received": stage.received, "dropped": stage.dropped, "emitted": stage.emitted,
+                               **stage.latency.to_dict()} for stage in self.stages}
+        return {"stages": stages, "end_to_end": self.latency.to_dict()}
+
+    def format_report(self) -> str:
+        lines = [f"{'stage':<16}{'received':>10}{'dropped':>10}{'emitted':>10}{'mean ms':>10}{'p50 ms':>10}"
+                 f"{'p99 ms':>10}"]
+        rows = [(stage.name, stage.received, stage.dropped, stage.emitted, stage.latency) for stage in self.stages]
+        rows.append(("end to end", self.latency.count, "", "", self.latency))
+        for name, received, dropped, emitted, latency in rows:
+            lines.append(f"{name:<16}{received:>10}{dropped:>10}{emitted:>10}{1e3 * latency.mean:>10.3f}"
+                         f"{1e3 * latency.quantile(0.5):>10.3f}{1e3 * latency.quantile(0.99):>10.3f}")
+        return "\n".join(lines)
+
+
+# region perception stages
+def to_perceptions(turns: Iterator[Any], position: Optional[Point] = None,
+                   converter: Optional[TurnConverter] = None) -> Iterator[RobotPerception]:
+    """
+    Raw turns are filtered by {converter} before they become perceptions.
+
+    >>> turn = LidarTurn(1., np.deg2rad([0., 90., 180.]), np.array([1000., 0., 2000.]), np.array([47, 47, 10]))
+    >>> [perception.obstacles.xy.round(6).tolist() for perception in to_perceptions([turn])]
+    [[[1000.0, 0.0]]]
+
+    :param turns: RobotPerception, passed through, LidarTurn, or (timestamp, (N, 2) array of (theta, rho)), like the
+    turns of one_turn_to_cartesian_points, theta in radian
+    :param position: position of the sensor, (0, 0) if None
+    :param converter: filter of the measures, TurnConverter() if None, the qualities are only checked for a LidarTurn
+    :return:
+    """
+    position = Point(0, 0) if position is None else position
+    converter = TurnConverter() if converter is None else converter
+    for turn in turns:
+        if isinstance(turn, RobotPerception):
+            yield turn
+            continue
+        if isinstance(turn, LidarTurn):
+            timestamp = turn.timestamp
+            _, measures = converter.convert(turn.ranges, turn.qualities, turn.angles)
+        else:
+            timestamp, measures = turn
+            measures = np.asarray(measures, dtype=float).reshape(-1, 2)
+            _, measures = converter.convert(measures[:, 1], angles=measures[:, 0])
+        yield RobotPerception(timestamp, PointCloud.from_polar(measures[:, 0], measures[:, 1], position), position)
+
+
+def clusterize(perceptions: Iterator[RobotPerception], split_distance: Optional[float] = None,
+               merge_distance: Optional[float] = None, minimum_points: Optional[int] = None) \
+        -> Iterator[Tuple[RobotPerception, List[Cluster]]]:
+    for perception in perceptions:
+        yield perception, perception.clusterize(split_distance, merge_distance, minimum_points)
+
+
+def detect_beacons(turns: Iterator[Tuple[RobotPerception, List[Cluster]]],
+                   radius: float = constants.FIX_BEACON_RADIUS,
+                   tolerance: float = constants.TOLERANCE_FOR_CIRCLE_COHERENCE) \
+        -> Iterator[Tuple[RobotPerception, np.ndarray]]:
+    """
+    Fits a circle of radius {radius} to all the clusters of a turn at once, with the criterion of
+    Cluster.detect_fix_beacons.
+
+    :return: the perception and the (K, 2) centers of the beacons
+    """
+    for perception, clusters in turns:
+        centers, _, residuals = fit_cluster_circles([cluster.points.xy for cluster in clusters], radius)
+        lengths = np.array([len(cluster) for cluster in clusters], dtype=float)
+        with np.errstate(invalid="ignore"):
+            beacons = residuals ** 2 * lengths <= tolerance
+        yield perception, centers[beacons]
+
+
+def track_beacons(turns: Iterator[Tuple[RobotPerception, np.ndarray]], dt: float = 1.,
+                  sigma_q: float = constants.sigma_q, sigma_angle: float = constants.sigma_angle,
+                  sigma_distance: float = constants.sigma_distance,
+                  maximum_distance: float = constants.seuil_association, maximum_missed_turns: int = 5) \
+        -> Iterator[Tuple[float, np.ndarray]]:
+    """
+    Tracks the beacons in the sensor frame with a MultiTargetEKF. Each beacon is associated with the closest predicted
+    target within {maximum_distance}, the other ones start new targets, and targets missed for more than
+    {maximum_missed_turns} turns are dropped.
+
+    :return: timestamp and (K, 4) states [x, vitesse_x, y, vitesse_y] of the targets
+    """
+    tracker = MultiTargetEKF(np.empty((0, 4)), np.empty((0, 4, 4)), dt, sigma_q, sigma_angle, sigma_distance)
+    missed = np.empty(0, dtype=np.int64)
+    last_timestamp = None
+    for perception, centers in turns:
+        relative = centers - perception.position.to_array()
+        if len(tracker) > 0 and last_timestamp is not None:
+            tracker.predict(perception.timestamp - last_timestamp)
+        last_timestamp = perception.timestamp
+
+        measured = np.zeros(len(tracker), dtype=bool)
+        measures = np.zeros((len(tracker), 2))
+        new_targets = []
+        predicted = tracker.x_kalm[:, [0, 2]]
+        for center in relative:
+            if len(tracker) > 0:
+                distances = np.hypot(*(predicted - center).T)
+                distances[measured] = np.inf
+                closest = int(np.argmin(distances))
+                if distances[closest] <= maximum_distance:
+                    measured[closest] = True
+                    measures[closest] = np.arctan2(center[1], center[0]), np.hypot(center[0], center[1])
+                    continue
+            new_targets.append([center[0], 0., center[1], 0.])
+        if np.any(measured):
+            tracker.update(measures, measured)
+
+        missed = np.where(measured, 0, missed + 1)
+        lost = missed > maximum_missed_turns
+        if np.any(lost):
+            tracker.remove_targets(lost)
+            missed = missed[~lost]
+        if new_targets:
+            tracker.add_targets(new_targets)
+            missed = np.concatenate([missed, np.zeros(len(new_targets), dtype=np.int64)])
+        yield perception.timestamp, tracker.x_kalm.copy()
+
+
+def beacon_tracking_pipeline(queue_size: int = 2, position: Optional[Point] = None,
+                             converter: Optional[TurnConverter] = None) -> Pipeline:
+    """
+    Turns to beacon tracks: to_perceptions, clusterize, detect_beacons and track_beacons. The turns may be the
+    LidarTurn of a LidarReader, they are filtered by {converter}.
+    """
+    return Pipeline([Stage("perception", lambda turns: to_perceptions(turns, position, converter), queue_size),
+                     Stage("clustering", clusterize, queue_size),
+                     Stage("beacons", detect_beacons, queue_size),
+                     Stage("tracking", track_beacons, queue_size)], queue_size)
+# endregion
@@ -0,0 +1,188 @@
+"""
+RANSAC detection of lines and fixed-radius circles in clusters of points.
+
+Hypotheses are drawn by batches from minimal samples (two points) and all the hypotheses of a batch are scored against
+all the points in one residual matrix. The search stops as soon as a hypothesis explains enough points.
+"""
+
+from typing import Callable, Optional
+
+import numpy as np
+
+from slam_robot.utils import profiling
+from slam_robot.utils.constants import RANSAC_TOLERANCE, RANSAC_HYPOTHESES, RANSAC_MINIMUM_INLIER_RATIO
+
+
+class RansacResult:
+    def __init__(self, model: np.ndarray, inliers: np.ndarray, number_of_hypotheses: int):
+        """
+
+        :param model: line (a, b, c) with a * x + b * y = c and a² + b² = 1, or circle (x_center, y_center, radius)
+        :param inliers: boolean mask of the points explained by the model
+        :param number_of_hypotheses: number of hypotheses scored before stopping
+        """
+        self.model = model
+        self.inliers = inliers
+        self.number_of_hypotheses = number_of_hypotheses
+
+    @property
+    def number_of_inliers(self) -> int:
+        return int(np.count_nonzero(self.inliers))
+
+    @property
+    def inlier_ratio(self) -> float:
+        return self.number_of_inliers / len(self.inliers)
+
+    def __str__(self):
+        return f"model: {self.model}, inliers: {self.number_of_inliers}/{len(self.inliers)}"
+
+
+def _draw_pairs(rng: np.random.Generator, number_of_points: int, number_of_pairs: int):
+    first = rng.integers(number_of_points, size=number_of_pairs)
+    second = (first + rng.integers(1, number_of_points, size=number_of_pairs)) % number_of_points
+    return first, second
+
+
+def _ransac(points: np.ndarray,
+            make_models: Callable[[np.ndarray, np.ndarray], np.ndarray],
+            compute_residuals: Callable[[np.ndarray, np.ndarray], np.ndarray],
+            tolerance: float,
+            number_of_hypotheses: int,
+            batch_size: int,
+            stop_inlier_ratio: float,
+            seed: Optional[int]) -> Optional[RansacResult]:
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(points) < 2:
+        return None
+    rng = np.random.default_rng(seed)
+    best_model = None
+    best_inliers = None
+    best_count = 0
+    tested = 0
+    while tested < number_of_hypotheses:
+        size = min(batch_size, number_of_hypotheses - tested)
+        first, second = _draw_pairs(rng, len(points), size)
+        tested += size
+        models = make_models(points[first], points[second])
+        if len(models) == 0:
+            continue
+        inliers = np.abs(compute_residuals(models, points)) <= tolerance  # (hypotheses, points)
+        counts = np.count_nonzero(inliers, axis=1)
+        best = int(np.argmax(counts))
+        if counts[best] > best_count:
+            best_count = counts[best]
+            best_model = models[best]
+            best_inliers = inliers[best]
+        if best_count >= stop_inlier_ratio * len(points):
+            break
+    if best_model is None:
+        return None
+    return RansacResult(best_model, best_inliers, tested)
+
+
+def _lines_from_pairs(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    directions = second - first
+    lengths = np.hypot(directions[:, 0], directions[:, 1])
+    valid = lengths > 0
+    normals = np.stack([-directions[valid, 1], directions[valid, 0]], axis=1) / lengths[valid, np.newaxis]
+    offsets = np.sum(normals * first[valid], axis=1)
+    return np.column_stack([normals, offsets])
+
+
+def _line_residuals(models: np.ndarray, points: np.ndarray) -> np.ndarray:
+    return models[:, :2] @ points.T - models[:, 2:3]
+
+
+@profiling.profiled("fitting.ransac_line")
+def ransac_line(points: np.ndarray,
+                tolerance: float = RANSAC_TOLERANCE,
+                number_of_hypotheses: int = RANSAC_HYPOTHESES,
+                batch_size: int = 16,
+                stop_inlier_ratio: float = RANSAC_MINIMUM_INLIER_RATIO,
+                seed: Optional[int] = 0) -> Optional[RansacResult]:
+    """
+    Best line through {points}, refitted on its inliers by total least squares.
+
+    >>> t = np.linspace(0, 100, 20)
+    >>> points = np.column_stack([t, 2 * t + 10])
+    >>> points[5] = [50, 0]
+    >>> result = ransac_line(points, tolerance=1)
+    >>> result.number_of_inliers
+    19
+    >>> a, b, c = result.model
+    >>> bool(np.isclose(-a / b, 2) and np.isclose(c / b, 10))
+    True
+
+    :param points: (N, 2)
+    :param tolerance: maximum distance of an inlier to the line
+    :param number_of_hypotheses: maximum number of hypotheses
+    :param batch_size: number of hypotheses scored at once
+    :param stop_inlier_ratio: the search stops when a hypothesis has this ratio of inliers
+    :param seed: seed of the random generator, the result is deterministic if it is not None
+    :return: None if there are less than two distinct points
+    """
+    result = _ransac(points, _lines_from_pairs, _line_residuals, tolerance, number_of_hypotheses, batch_size,
+                     stop_inlier_ratio, seed)
+    if result is not None and result.number_of_inliers >= 2:
+        inlier_points = np.asarray(points, dtype=float).reshape(-1, 2)[result.inliers]
+        mean = inlier_points.mean(axis=0)
+        _, _, vh = np.linalg.svd(inlier_points - mean)
+        normal = vh[1]
+        result.model = np.array([normal[0], normal[1], normal @ mean])
+    return result
+
+
+def _circle_residuals(models: np.ndarray, points: np.ndarray) -> np.ndarray:
+    differences = points[np.newaxis, :, :] - models[:, np.newaxis, :2]
+    return np.hypot(differences[..., 0], differences[..., 1]) - models[:, 2:3]
+
+
+@profiling.profiled("fitting.ransac_circle")
+def ransac_circle(points: np.ndarray,
+                  radius: float,
+                  tolerance: float = RANSAC_TOLERANCE,
+                  number_of_hypotheses: int = RANSAC_HYPOTHESES,
+                  batch_size: int = 16,
+                  stop_inlier_ratio: float = RANSAC_MINIMUM_INLIER_RATIO,
+                  seed: Optional[int] = 0,
+                  sensor: Optional[np.ndarray] = None) -> Optional[RansacResult]:
+    """
+    Best circle of radius {radius} through {points}.
+
+    Two points give two possible centers, one on each side of the chord. When the position of the sensor is known, only
+    the center farther from the sensor is kept, since the sensor sees the circle from outside.
+
+    >>> thetas = np.deg2rad(np.arange(200, 340, 10))
+    >>> points = np.column_stack([50 * np.cos(thetas) + 300, 50 * np.sin(thetas) + 400])
+    >>> result = ransac_circle(points, 50, tolerance=1, sensor=np.array([0, 0]))
+    >>> result.number_of_inliers, np.round(result.model).tolist()
+    (14, [300.0, 400.0, 50.0])
+
+    :param points: (N, 2)
+    :param radius: FIX_BEACON_RADIUS or OPPONENT_ROBOT_BEACON_RADIUS for instance
+    :param tolerance: maximum distance of an inlier to the circle
+    :param number_of_hypotheses: maximum number of point pairs drawn
+    :param batch_size: number of point pairs scored at once
+    :param stop_inlier_ratio: the search stops when a hypothesis has this ratio of inliers
+    :param seed: seed of the random generator, the result is deterministic if it is not None
+    :param sensor: position of the sensor in the frame of {points}
+    :return: None if no pair of points fits in a circle of radius {radius}
+    """
+    def make_models(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        middles = (first + second) / 2
+        half_chords = second - middles
+        half_lengths = np.hypot(half_chords[:, 0], half_chords[:, 1])
+        valid = (half_lengths > 0) & (half_lengths <= radius)
+        middles = middles[valid]
+        half_lengths = half_lengths[valid]
+        normals = np.stack([-half_chords[valid, 1], half_chords[valid, 0]], axis=1) / half_lengths[:, np.newaxis]
+        heights = np.sqrt(radius ** 2 - half_lengths ** 2)[:, np.newaxis]
+        if sensor is not None:
+            away = np.sign(np.sum(normals * (middles - sensor), axis=1))[:, np.newaxis]
+            centers = middles + np.where(away == 0, 1, away) * heights * normals
+        else:
+            centers = np.concatenate([middles + heights * normals, middles - heights * normals])
+        return np.column_stack([centers, np.full(len(centers), float(radius))])
+
+    return _ransac(points, make_models, _circle_residuals, tolerance, number_of_hypotheses, batch_size,
+                   stop_inlier_ratio, seed)
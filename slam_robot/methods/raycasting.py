@@ -0,0 +1,126 @@
+"""
+Batched ray casting.
+
+The items of a world are compiled once into contiguous arrays so that all the rays of a turn are intersected with all
+the items in one broadcast operation, instead of building line objects for every (ray, item) pair.
+"""
+
+from typing import List, Union
+
+import numpy as np
+
+from slam_robot.models.world_items import WorldItem, CartesianLine, Circle, LineByTwoPoints, LineSegment, \
+    SEGMENT_TOLERANCE
+
+# Same tolerance as np.isclose in CartesianLine._get_intersection_with_other
+PARALLEL_TOLERANCE = 1e-8
+
+
+class RayCaster:
+    """
+    Compiled geometry of a list of world items.
+
+    Lines, CartesianLine items and the lines of LineByTwoPoints items, are stored as a normal (a, b) and an offset c so
+    that a * x + b * y = c.
+    Segments are stored as a start and a vector to their end.
+    Circles are stored as centers and radii.
+    """
+    def __init__(self, items: List[WorldItem]):
+        """
+        :param items: LineByTwoPoints, LineSegment, CartesianLine and Circle
+        :raise ValueError: if an item has another type, since its rays would be silently lost
+        """
+        unsupported = [item for item in items if not isinstance(item, (LineByTwoPoints, CartesianLine, Circle))]
+        if unsupported:
+            raise ValueError(f"Ray casting does not support {type(unsupported[0]).__name__} items")
+        lines = [item.cartesian_line if isinstance(item, LineByTwoPoints) else item for item in items
+                 if isinstance(item, (LineByTwoPoints, CartesianLine)) and not isinstance(item, LineSegment)]
+        segments = [item for item in items if isinstance(item, LineSegment)]
+        circles = [item for item in items if isinstance(item, Circle)]
+
+        line_coefficients = np.array([[line.a, line.b, line.c] for line in lines], dtype=float).reshape(-1, 3)
+        self.line_normals = np.ascontiguousarray(line_coefficients[:, :2])
+        self.line_offsets = line_coefficients[:, 2].copy()
+
+        segment_points = np.array([[segment.point_1.x, segment.point_1.y, segment.point_2.x, segment.point_2.y]
+                                   for segment in segments], dtype=float).reshape(-1, 4)
+        self.segment_starts = np.ascontiguousarray(segment_points[:, :2])
+        self.segment_vectors = segment_points[:, 2:] - segment_points[:, :2]
+
+        self.circle_centers = np.array([[circle.center.x, circle.center.y] for circle in circles],
+                                       dtype=float).reshape(-1, 2)
+        self.circle_radii = np.array([circle.radius for circle in circles], dtype=float)
+
+    def __len__(self):
+        return len(self.line_offsets) + len(self.segment_starts) + len(self.circle_radii)
+
+    def cast(self, origins: np.ndarray, angles: Union[np.ndarray, List[float]]) -> np.ndarray:
+        """
+        Distance to the first item hit by each ray, np.inf if the ray hits nothing.
+
+        >>> from slam_robot.utils.geometry import Point
+        >>> caster = RayCaster([LineByTwoPoints(Point(10, 0), Point(10, 1)), Circle(Point(0, 5), 1)])
+        >>> caster.cast(np.array([0., 0.]), [0., np.pi / 2, np.pi])
+        array([10.,  4., inf])
+        >>> caster.cast(np.array([[0., 0.], [5., 0.]]), [0.]).tolist()
+        [[10.0], [5.0]]
+        >>> RayCaster([LineSegment(Point(10, 0), Point(10, 1))]).cast(np.array([0., 0.]), [0., np.pi / 4]).tolist()
+        [10.0, inf]
+        >>> RayCaster([CartesianLine(0., 1., 3.)]).cast(np.array([0., 0.]), [np.pi / 2]).tolist()
+        [3.0]
+
+        :param origins: (2,) for one origin or (P, 2) for P origins
+        :param angles: (A,) angles shared by all origins or (P, A) angles per origin, in radian
+        :return: (A,) distances for one origin, (P, A) otherwise
+        """
+        origins = np.asarray(origins, dtype=float)
+        angles = np.asarray(angles, dtype=float)
+        single_origin = origins.ndim == 1
+
+        origins = np.atleast_2d(origins)[:, np.newaxis, :]  # (P, 1, 2)
+        angles = np.atleast_2d(angles)  # (1, A) or (P, A)
+        directions_x = np.cos(angles)
+        directions_y = np.sin(angles)
+
+        shape = np.broadcast_shapes(origins.shape[:2], angles.shape)
+        distances = np.full(shape, np.inf)
+
+        if len(self.line_offsets) > 0:
+            normals = self.line_normals[:, np.newaxis, np.newaxis, :]  # (L, 1, 1, 2)
+            denominators = normals[..., 0] * directions_x + normals[..., 1] * directions_y  # (L, P, A)
+            numerators = self.line_offsets[:, np.newaxis, np.newaxis] - np.sum(normals * origins, axis=-1)
+            parallel = np.abs(denominators) <= PARALLEL_TOLERANCE
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = numerators / np.where(parallel, 1., denominators)
+            t[parallel | (t <= 0)] = np.inf
+            np.minimum(distances, t.min(axis=0), out=distances)
+
+        if len(self.segment_starts) > 0:
+            # origin + t * direction = start + u * vector, solved by Cramer's rule
+            starts = self.segment_starts[:, np.newaxis, np.newaxis, :]  # (S, 1, 1, 2)
+            vectors = self.segment_vectors[:, np.newaxis, np.newaxis, :]
+            offsets = starts - origins  # (S, P, 1, 2)
+            denominators = directions_x * vectors[..., 1] - directions_y * vectors[..., 0]  # (S, P, A)
+            parallel = np.abs(denominators) <= PARALLEL_TOLERANCE
+            denominators = np.where(parallel, 1., denominators)
+            t = (offsets[..., 0] * vectors[..., 1] - offsets[..., 1] * vectors[..., 0]) / denominators
+            u = (offsets[..., 0] * directions_y - offsets[..., 1] * directions_x) / denominators
+            t[parallel | (t <= 0) | (u < -SEGMENT_TOLERANCE) | (u > 1 + SEGMENT_TOLERANCE)] = np.inf
+            np.minimum(distances, t.min(axis=0), out=distances)
+
+        if len(self.circle_radii) > 0:
+            centered = origins - self.circle_centers[:, np.newaxis, np.newaxis, :]  # (M, P, 1, 2)
+            half_b = centered[..., 0] * directions_x + centered[..., 1] * directions_y  # (M, P, A)
+            c = np.sum(centered ** 2, axis=-1) - self.circle_radii[:, np.newaxis, np.newaxis] ** 2
+            discriminants = half_b ** 2 - c
+            hit = discriminants >= 0
+            root = np.sqrt(np.where(hit, discriminants, 0.))
+            near = -half_b - root
+            far = -half_b + root
+            t = np.where(near > 0, near, np.where(far > 0, far, np.inf))
+            t[~hit] = np.inf
+            np.minimum(distances, t.min(axis=0), out=distances)
+
+        if single_origin:
+            return distances[0]
+        return distances
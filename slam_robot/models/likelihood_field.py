@@ -0,0 +1,177 @@
+"""
+Likelihood field of a world.
+
+All the items of a world are rasterized once and the Euclidean distance transform of the raster gives, for every node of
+a regular grid, the distance to the closest obstacle. Scoring a scan against the world is then a bilinear lookup of
+the scan points instead of casting rays. The distance grid only depends on the geometry of the world and on the
+resolution, so it can be cached on disk under a hash of both, in a directory given by the caller.
+"""
+
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from slam_robot.methods.raycasting import RayCaster
+
+# suggested cache directory, the disk cache is only used when a directory is given
+LIKELIHOOD_FIELD_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "slam_robot", "likelihood_fields")
+
+
+class LikelihoodField:
+    def __init__(self, distances: np.ndarray, origin: np.ndarray, resolution: float):
+        """
+
+        :param distances: (W, H) distance to the closest obstacle of each node, indexed [x, y]
+        :param origin: position of the node [0, 0]
+        :param resolution: distance between two nodes
+        """
+        self.distances = distances
+        self.origin = np.asarray(origin, dtype=float)
+        self.resolution = resolution
+
+    # region building
+    @staticmethod
+    def geometry_key(ray_caster: RayCaster, limit_x: float, limit_y: float, resolution: float, margin: float) -> str:
+        digest = hashlib.sha1()
+        for array in [ray_caster.line_normals, ray_caster.line_offsets, ray_caster.segment_starts,
+                      ray_caster.segment_vectors, ray_caster.circle_centers,
+                      ray_caster.circle_radii, np.array([limit_x, limit_y, resolution, margin], dtype=float)]:
+            digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def rasterize(cls, ray_caster: RayCaster, limit_x: float, limit_y: float, resolution: float,
+                  margin: float) -> 'LikelihoodField':
+        """
+        Lines, segments and circles are sampled every half node and the nodes of the samples are the obstacles.
+
+        :param ray_caster: compiled items of the world
+        :param limit_x:
+        :param limit_y:
+        :param resolution:
+        :param margin: the grid covers the world and {margin} around it
+        :return:
+        """
+        origin = np.array([-margin, -margin], dtype=float)
+        shape = np.ceil((np.array([limit_x, limit_y]) + 2 * margin) / resolution).astype(np.int64) + 1
+        step = resolution / 2
+        diagonal = np.hypot(*(shape * resolution))
+        samples = [np.empty((0, 2))]
+
+        if len(ray_caster.line_offsets) > 0:
+            normals = ray_caster.line_normals / np.hypot(*ray_caster.line_normals.T)[:, np.newaxis]
+            offsets = ray_caster.line_offsets / np.hypot(*ray_caster.line_normals.T)
+            # closest point of each line to the center of the grid, then both ways along the line
+            center = origin + (shape - 1) * resolution / 2
+            feet = center - (normals @ center - offsets)[:, np.newaxis] * normals
+            directions = np.column_stack([-normals[:, 1], normals[:, 0]])
+            t = np.arange(-diagonal / 2, diagonal / 2 + step, step)
+            samples.append((feet[:, np.newaxis, :] + t[np.newaxis, :, np.newaxis] * directions[:, np.newaxis, :])
+                           .reshape(-1, 2))
+
+        for start, vector in zip(ray_caster.segment_starts, ray_caster.segment_vectors):
+            u = np.linspace(0, 1, int(np.ceil(np.hypot(*vector) / step)) + 1)
+            samples.append(start + u[:, np.newaxis] * vector)
+
+        for center, radius in zip(ray_caster.circle_centers, ray_caster.circle_radii):
+            angles = np.arange(0, 2 * np.pi, step / max(radius, step))
+            samples.append(center + radius * np.column_stack([np.cos(angles), np.sin(angles)]))
+
+        nodes = np.rint((np.concatenate(samples) - origin) / resolution).astype(np.int64)
+        nodes = nodes[np.all((nodes >= 0) & (nodes < shape), axis=1)]
+        free = np.ones(shape, dtype=bool)
+        free[nodes[:, 0], nodes[:, 1]] = False
+        if np.all(free):
+            distances = np.full(shape, np.inf)
+        else:
+            distances = distance_transform_edt(free) * resolution
+        return cls(distances, origin, resolution)
+
+    @classmethod
+    def from_world_geometry(cls, ray_caster: RayCaster, limit_x: float, limit_y: float, resolution: float,
+                            margin: float, cache_directory: Optional[str] = None) \
+            -> 'LikelihoodField':
+        """
+        With a {cache_directory}, loads the field from it if it was already computed for this geometry, computes and
+        saves it otherwise.
+
+        :param ray_caster:
+        :param limit_x:
+        :param limit_y:
+        :param resolution:
+        :param margin:
+        :param cache_directory: no disk cache if None
+        :return:
+        """
+        path = None
+        if cache_directory is not None:
+            key = cls.geometry_key(ray_caster, limit_x, limit_y, resolution, margin)
+            path = os.path.join(cache_directory, f"{key}.npz")
+            if os.path.exists(path):
+                with np.load(path) as saved:
+                    return cls(saved["distances"], saved["origin"], float(saved["resolution"]))
+        field = cls.rasterize(ray_caster, limit_x, limit_y, resolution, margin)
+        if path is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(temporary_path, distances=field.distances, origin=field.origin, resolution=field.resolution)
+            os.replace(temporary_path, path)
+        return field
+    # endregion
+
+    # region lookup
+    def distance_at(self, points: np.ndarray) -> np.ndarray:
+        """
+        Bilinear interpolation of the distances, points outside the grid take the value of the closest border.
+
+        >>> field = LikelihoodField(np.array([[0., 1.], [2., 3.]]), np.zeros(2), 10.)
+        >>> field.distance_at(np.array([[5., 5.], [0., 10.], [-50., 0.]])).tolist()
+        [1.5, 1.0, 0.0]
+
+        :param points: (..., 2)
+        :return: (...,)
+        """
+        coordinates = (np.asarray(points, dtype=float) - self.origin) / self.resolution
+        maximum = np.array(self.distances.shape) - 1
+        coordinates = np.clip(coordinates, 0, maximum)
+        lower = np.minimum(np.floor(coordinates).astype(np.int64), np.maximum(maximum - 1, 0))
+        upper = np.minimum(lower + 1, maximum)
+        fraction = coordinates - lower
+        fx, fy = fraction[..., 0], fraction[..., 1]
+        x0, y0, x1, y1 = lower[..., 0], lower[..., 1], upper[..., 0], upper[..., 1]
+        d = self.distances
+        return ((1 - fx) * (1 - fy) * d[x0, y0] + fx * (1 - fy) * d[x1, y0]
+                + (1 - fx) * fy * d[x0, y1] + fx * fy * d[x1, y1])
+
+    def log_likelihood(self, points: np.ndarray, sigma: float, floor: float = 1e-3) -> np.ndarray:
+        """
+        :param points: (..., B, 2) points of scans in the table frame
+        :param sigma: standard deviation of the measures
+        :param floor: added to the likelihood of each point, so that one outlier does not rule a scan out
+        :return: (...,) log-likelihood of each scan
+        """
+        distances = self.distance_at(points)
+        return np.sum(np.log(np.exp(-0.5 * (distances / sigma) ** 2) + floor), axis=-1)
+
+    def score_poses(self, poses: np.ndarray, points: np.ndarray, sigma: float, floor: float = 1e-3) -> np.ndarray:
+        """
+        Log-likelihood of one scan seen from each pose.
+
+        :param poses: (P, 3) poses (x, y, theta)
+        :param points: (B, 2) points of the scan in the robot frame
+        :param sigma:
+        :param floor:
+        :return: (P,)
+        """
+        poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        cos_theta = np.cos(poses[:, 2])[:, np.newaxis]
+        sin_theta = np.sin(poses[:, 2])[:, np.newaxis]
+        table_points = np.empty((len(poses), len(points), 2))
+        table_points[..., 0] = poses[:, 0:1] + cos_theta * points[:, 0] - sin_theta * points[:, 1]
+        table_points[..., 1] = poses[:, 1:2] + sin_theta * points[:, 0] + cos_theta * points[:, 1]
+        return self.log_likelihood(table_points, sigma, floor)
+    # endregion
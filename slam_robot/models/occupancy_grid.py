@@ -0,0 +1,174 @@
+"""
+Log-odds occupancy grid.
+
+The grid is stored as square tiles created when a beam reaches them. At most {maximum_tiles} tiles are kept, the least
+recently updated ones are dropped first, so the memory used is bounded whatever the size of the explored area.
+"""
+
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import numpy as np
+
+from slam_robot.models.perception import RobotPerception
+from slam_robot.utils import profiling
+
+
+class OccupancyGrid:
+    def __init__(self,
+                 resolution: float = 10.,
+                 tile_size: int = 64,
+                 maximum_tiles: int = 256,
+                 log_odds_free: float = -0.4,
+                 log_odds_occupied: float = 0.85,
+                 log_odds_limit: float = 4.,
+                 beam_chunk_size: int = 512):
+        """
+        >>> grid = OccupancyGrid(resolution=1., tile_size=4)
+        >>> grid.update_beams(np.array([0.5, 0.5]), np.array([[5.5, 0.5]]))
+        >>> grid.log_odds_at(np.array([[2.5, 0.5], [5.5, 0.5], [2.5, 2.5]])).tolist()
+        [-0.4000000059604645, 0.8500000238418579, 0.0]
+
+        :param resolution: side of a cell, in mm
+        :param tile_size: number of cells of the side of a tile
+        :param maximum_tiles: memory budget, a tile uses 4 * tile_size² bytes
+        :param log_odds_free: added to the cells crossed by a beam
+        :param log_odds_occupied: added to the cell where a beam stops
+        :param log_odds_limit: log-odds are clamped to [-log_odds_limit, log_odds_limit]
+        :param beam_chunk_size: number of beams traversed at once
+        """
+        self.resolution = resolution
+        self.tile_size = tile_size
+        self.maximum_tiles = maximum_tiles
+        self.log_odds_free = log_odds_free
+        self.log_odds_occupied = log_odds_occupied
+        self.log_odds_limit = log_odds_limit
+        self.beam_chunk_size = beam_chunk_size
+        self.tiles: "OrderedDict[Tuple[int, int], np.ndarray]" = OrderedDict()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def _to_cells(self, points: np.ndarray) -> np.ndarray:
+        return np.floor(points / self.resolution).astype(np.int64)
+
+    def _get_tile(self, key: Tuple[int, int]) -> np.ndarray:
+        tile = self.tiles.get(key)
+        if tile is None:
+            if len(self.tiles) >= self.maximum_tiles:
+                self.tiles.popitem(last=False)
+            tile = np.zeros((self.tile_size, self.tile_size), dtype=np.float32)
+            self.tiles[key] = tile
+        else:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def _group_by_tile(self, cells: np.ndarray):
+        """
+        :param cells: (N, 2) cell indices
+        :return: for each tile reached by {cells}, its key, the rows of {cells} in it and their indices in the tile
+        """
+        tile_keys = cells // self.tile_size
+        local = cells - tile_keys * self.tile_size
+        unique_keys, inverse = np.unique(tile_keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique_keys) + 1))
+        for i, (tile_x, tile_y) in enumerate(unique_keys.tolist()):
+            selected = order[bounds[i]:bounds[i + 1]]
+            yield (tile_x, tile_y), selected, (local[selected, 0], local[selected, 1])
+
+    def _add(self, cells: np.ndarray, value: float):
+        """
+        Adds {value} once per row of {cells}, a cell may appear several times.
+        """
+        if len(cells) == 0:
+            return
+        for key, _, local in self._group_by_tile(cells):
+            tile = self._get_tile(key)
+            np.add.at(tile, local, value)
+            np.clip(tile, -self.log_odds_limit, self.log_odds_limit, out=tile)
+
+    @profiling.profiled("mapping")
+    def update_beams(self, origin: np.ndarray, hits: np.ndarray):
+        """
+        All the beams from {origin} to {hits} are traversed at once, each beam is sampled every half cell.
+        The hit cell is occupied, the other ones are free.
+
+        :param origin: (2,) position of the sensor
+        :param hits: (N, 2) positions where the beams stopped
+        :return:
+        """
+        origin = np.asarray(origin, dtype=float)
+        hits = np.asarray(hits, dtype=float).reshape(-1, 2)
+        step = self.resolution / 2
+        for start in range(0, len(hits), self.beam_chunk_size):
+            chunk = hits[start:start + self.beam_chunk_size]
+            directions = chunk - origin
+            lengths = np.hypot(directions[:, 0], directions[:, 1])
+            hit_cells = self._to_cells(chunk)
+
+            number_of_samples = int(np.ceil(lengths.max() / step)) + 1 if len(chunk) > 0 else 0
+            t = np.arange(number_of_samples) * step  # (S,)
+            inside = t[np.newaxis, :] < lengths[:, np.newaxis]  # (N, S)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                fractions = np.where(lengths[:, np.newaxis] > 0, t[np.newaxis, :] / lengths[:, np.newaxis], 0)
+            samples = origin + fractions[..., np.newaxis] * directions[:, np.newaxis, :]  # (N, S, 2)
+            cells = self._to_cells(samples)
+            # a beam updates a cell once, however many of its samples fall in it: since a beam is straight, the
+            # samples of a cell are consecutive, so only the first one is kept
+            first_in_cell = np.ones(inside.shape, dtype=bool)
+            first_in_cell[:, 1:] = np.any(cells[:, 1:] != cells[:, :-1], axis=2)
+            free = inside & first_in_cell & np.any(cells != hit_cells[:, np.newaxis, :], axis=2)
+            self._add(cells[free], self.log_odds_free)
+            self._add(hit_cells, self.log_odds_occupied)
+
+    def update(self, perception: RobotPerception):
+        """
+        :param perception: obstacles in the table frame, seen from perception.position
+        :return:
+        """
+        self.update_beams(perception.position.to_array(), perception.obstacles.xy)
+
+    def log_odds_at(self, points: np.ndarray) -> np.ndarray:
+        """
+        :param points: (N, 2)
+        :return: (N,) log-odds of the cells of {points}, 0 for unknown cells
+        """
+        cells = self._to_cells(np.asarray(points, dtype=float).reshape(-1, 2))
+        values = np.zeros(len(cells), dtype=np.float32)
+        if len(cells) == 0:
+            return values
+        for key, selected, local in self._group_by_tile(cells):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                values[selected] = tile[local]
+        return values
+
+    def snapshot(self) -> Tuple[np.ndarray, Optional[Tuple[float, float, float, float]]]:
+        """
+        Copy of the known area, as probabilities of occupation.
+
+        :return: (height, width) array indexed [y, x] and its extent (x_min, x_max, y_min, y_max), for imshow with
+        origin="lower"
+        """
+        if not self.tiles:
+            return np.empty((0, 0), dtype=np.float32), None
+        keys = np.array(list(self.tiles.keys()))
+        minimum = keys.min(axis=0)
+        shape = (keys.max(axis=0) - minimum + 1) * self.tile_size
+        log_odds = np.zeros((shape[0], shape[1]), dtype=np.float32)
+        for (tile_x, tile_y), tile in self.tiles.items():
+            x = (tile_x - minimum[0]) * self.tile_size
+            y = (tile_y - minimum[1]) * self.tile_size
+            log_odds[x:x + self.tile_size, y:y + self.tile_size] = tile
+        probabilities = 1 - 1 / (1 + np.exp(log_odds))
+        x_min, y_min = (minimum * self.tile_size * self.resolution).astype(float).tolist()
+        width, height = (shape * self.resolution).astype(float).tolist()
+        extent = (x_min, x_min + width, y_min, y_min + height)
+        return probabilities.T, extent
+
+    def draw(self, ax: Any):
+        probabilities, extent = self.snapshot()
+        if extent is not None:
+            ax.imshow(probabilities, extent=extent, origin="lower", cmap="Greys", vmin=0, vmax=1)
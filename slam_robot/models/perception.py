@@ -1,9 +1,11 @@
-import imghdr
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import numpy as np
 
+from slam_robot.utils import profiling
 from slam_robot.utils.geometry import Point
+from slam_robot.utils.point_cloud import PointCloud
+from slam_robot.utils.spatial_index import SpatialIndex
 
 
 class Cluster:
@@ -11,25 +13,115 @@ class Cluster:
     minimum_points_in_cluster = 3  # in mm
     maximum_distance_between_means = 20
 
-    def __init__(self):
-        self.points: List[Point] = []
-        self.mean: Optional[Point] = None
+    def __init__(self, points: Optional[PointCloud] = None):
+        # the points are the first {self._size} rows of buffers whose capacity doubles when they are full
+        self._xy = np.empty((0, 2))
+        self._columns: List[Optional[np.ndarray]] = [None] * len(PointCloud.columns)
+        self._size = 0
+        self._owned = False
+        # the setter computes the running statistics
+        self.points = PointCloud.empty() if points is None else points
 
-    def append(self, point: Point):
-        self.points.append(point)
+    @property
+    def points(self) -> PointCloud:
+        """
+        Points of the cluster, as views of its buffers: they may be overwritten after a pop, copy them to keep them.
+        """
+        return PointCloud(self._xy[:self._size], *[None if column is None else column[:self._size]
+                                                   for column in self._columns])
+
+    @points.setter
+    def points(self, points: PointCloud):
+        # the arrays of {points} are shared until the first append, which copies them, so {points} is never modified
+        self._xy = points.xy
+        self._columns = [getattr(points, name) for name in PointCloud.columns]
+        self._size = len(points)
+        self._owned = False
         self.update_mean()
 
+    def _reserve(self, size: int):
+        if self._owned and size <= len(self._xy):
+            return
+        capacity = max(size, 2 * len(self._xy), 8)
+        xy = np.empty((capacity, 2))
+        xy[:self._size] = self._xy[:self._size]
+        self._xy = xy
+        for i, column in enumerate(self._columns):
+            if column is not None:
+                self._columns[i] = np.empty(capacity)
+                self._columns[i][:self._size] = column[:self._size]
+        self._owned = True
+
+    def _append_cloud(self, cloud: PointCloud):
+        # like PointCloud.concatenate, a column is kept only if both the cluster and {cloud} have it
+        self._columns = [None if column is None or getattr(cloud, name) is None else column
+                         for column, name in zip(self._columns, PointCloud.columns)]
+        end = self._size + len(cloud)
+        self._reserve(end)
+        self._xy[self._size:end] = cloud.xy
+        for column, name in zip(self._columns, PointCloud.columns):
+            if column is not None:
+                column[self._size:end] = getattr(cloud, name)
+        self._size = end
+
+    def _add_statistics(self, xy: np.ndarray):
+        self.count += len(xy)
+        self.sum += xy.sum(axis=0)
+        self.sum_of_products += [np.dot(xy[:, 0], xy[:, 0]), np.dot(xy[:, 1], xy[:, 1]), np.dot(xy[:, 0], xy[:, 1])]
+        if len(xy) > 0:
+            np.minimum(self.minimum, xy.min(axis=0), out=self.minimum)
+            np.maximum(self.maximum, xy.max(axis=0), out=self.maximum)
+
+    def append(self, point: Point):
+        """
+        Amortized O(1).
+
+        >>> cluster = Cluster()
+        >>> for x in range(5):
+        ...     cluster.append(Point(x, 0.))
+        >>> len(cluster), cluster.mean
+        (5, Point(2.0, 0.0))
+        """
+        xy = np.array([[point.x, point.y]], dtype=float)
+        self._append_cloud(PointCloud(xy))
+        self._add_statistics(xy)
+        if self._spatial_index is not None:
+            self._spatial_index.add(xy)
+
     def extend(self, other: 'Cluster'):
-        self.points.extend(other.points)
-        self.update_mean()
+        """
+        Statistics of {other} are combined with those of the cluster instead of being computed again.
+        :param other:
+        :return:
+        """
+        other_points = other.points
+        self._append_cloud(other_points)
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_of_products += other.sum_of_products
+        np.minimum(self.minimum, other.minimum, out=self.minimum)
+        np.maximum(self.maximum, other.maximum, out=self.maximum)
+        if self._spatial_index is not None:
+            self._spatial_index.add(other_points.xy)
 
     def pop(self):
-        point = self.points.pop()
-        self.update_mean()
+        point = Point(float(self._xy[self._size - 1, 0]), float(self._xy[self._size - 1, 1]))
+        self._size -= 1
+        self.count -= 1
+        self.sum -= [point.x, point.y]
+        self.sum_of_products -= [point.x * point.x, point.y * point.y, point.x * point.y]
+        # the bounding box can only be computed again if the point was on it
+        if np.any(self.minimum == [point.x, point.y]) or np.any(self.maximum == [point.x, point.y]):
+            xy = self._xy[:self._size]
+            self.minimum = xy.min(axis=0) if self.count > 0 else np.full(2, np.inf)
+            self.maximum = xy.max(axis=0) if self.count > 0 else np.full(2, -np.inf)
+        if self._spatial_index is not None:
+            # points are only added at the end, so the last alive one is the popped one
+            self._spatial_index.remove([np.flatnonzero(self._spatial_index.alive)[-1]])
         return point
 
     def __len__(self):
-        return len(self.points)
+        return self._size
 
     def __iter__(self):
         return iter(self.points)
@@ -51,80 +143,245 @@ class Cluster:
         :param point:
         :return:
         """
-        if self.points:
-            minimum_distance = point.distance(self.points[0])
-            for i in range(1, len(self.points)):
-                distance = self.points[i].distance(point)
-                if distance < minimum_distance:
-                    minimum_distance = distance
-            return minimum_distance
+        if len(self.points) > 0:
+            return np.min(np.hypot(self.points.x - point.x, self.points.y - point.y))
         return 0
 
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        """
+        Index of the points, built at the first query and then kept up to date by append, extend and pop.
+        :return:
+        """
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex(self.points.xy)
+        return self._spatial_index
+
+    def distance_to_points(self, points: Union[PointCloud, np.ndarray]) -> np.ndarray:
+        """
+        Minimum distance of each point of {points} to any point in the cluster.
+
+        >>> cluster = Cluster(PointCloud([[0, 0], [10, 0]]))
+        >>> cluster.distance_to_points(np.array([[1, 0], [10, 3]])).tolist()
+        [1.0, 3.0]
+
+        :param points: (N, 2)
+        :return: (N,), infinite if the cluster is empty
+        """
+        if isinstance(points, PointCloud):
+            points = points.xy
+        return self.spatial_index.nearest(points)[0]
+
     def update_mean(self):
-        self.mean = Point.from_array(np.sum([point.to_array() for point in self.points], axis=0) / len(self.points))
+        """
+        Computes the running statistics from the points and drops the spatial index. The setter of {self.points}
+        calls it, append, extend and pop keep the statistics up to date.
+
+        >>> cluster = Cluster(PointCloud([[0, 0], [10, 0]]))
+        >>> cluster.points = PointCloud([[100, 100]])
+        >>> len(cluster), cluster.mean
+        (1, Point(100.0, 100.0))
+        """
+        # region running statistics
+        self.count = 0
+        self.sum = np.zeros(2)
+        # sums of x², y² and x * y
+        self.sum_of_products = np.zeros(3)
+        self.minimum = np.full(2, np.inf)
+        self.maximum = np.full(2, -np.inf)
+        # endregion
+        self._spatial_index: Optional[SpatialIndex] = None
+        self._add_statistics(self.points.xy)
+
+    # region statistics
+    @property
+    def mean(self) -> Optional[Point]:
+        if self.count == 0:
+            return None
+        return Point.from_array(self.sum / self.count)
 
     @property
-    def x_points(self):
-        return [i.x for i in self.points]
+    def covariance(self) -> Optional[np.ndarray]:
+        """
+        >>> cluster = Cluster(PointCloud([[0, 0], [2, 0], [2, 2], [0, 2]]))
+        >>> cluster.covariance.tolist()
+        [[1.0, 0.0], [0.0, 1.0]]
+
+        :return: biased covariance matrix, 2 x 2
+        """
+        if self.count == 0:
+            return None
+        mean_x, mean_y = self.sum / self.count
+        xx, yy, xy = self.sum_of_products / self.count
+        covariance_xy = xy - mean_x * mean_y
+        return np.array([[xx - mean_x * mean_x, covariance_xy],
+                         [covariance_xy, yy - mean_y * mean_y]])
 
     @property
-    def y_points(self):
-        return [i.y for i in self.points]
+    def principal_axis(self) -> Optional[np.ndarray]:
+        """
+        >>> cluster = Cluster(PointCloud([[0, 0], [1, 1], [2, 2], [3, 3.1]]))
+        >>> cluster.principal_axis.round(2).tolist()
+        [0.7, 0.72]
+
+        :return: unit vector of the direction of greatest variance
+        """
+        covariance = self.covariance
+        if covariance is None:
+            return None
+        angle = 0.5 * np.arctan2(2 * covariance[0, 1], covariance[0, 0] - covariance[1, 1])
+        return np.array([np.cos(angle), np.sin(angle)])
+
+    @property
+    def extent(self) -> np.ndarray:
+        """
+        :return: width and height of the bounding box
+        """
+        if self.count == 0:
+            return np.zeros(2)
+        return self.maximum - self.minimum
+    # endregion
+
+    @property
+    def x_points(self) -> np.ndarray:
+        return self.points.x
+
+    @property
+    def y_points(self) -> np.ndarray:
+        return self.points.y
 
 
 class RobotPerception:
     def __init__(self,
                  timestamp: float,
-                 obstacles: List[Optional[Point]],
+                 obstacles: Union[PointCloud, List[Optional[Point]]],
                  position: Point,
+                 orientation: Optional[float] = None,
                  ):
+        """
+
+        :param timestamp:
+        :param obstacles: PointCloud, a list of points is converted
+        :param position: position of the sensor
+        :param orientation: orientation of the robot when the measures were taken, if known
+        """
         self.timestamp = timestamp
-        self.obstacles = obstacles
+        if not isinstance(obstacles, PointCloud):
+            obstacles = PointCloud.from_points([obstacle for obstacle in obstacles if obstacle is not None])
+        self.obstacles: PointCloud = obstacles
         self.position = position
+        self.orientation = orientation
+
+    def segment(self,
+                split_distance: Optional[float] = None,
+                merge_distance: Optional[float] = None,
+                minimum_points: Optional[int] = None) -> np.ndarray:
+        """
+        Labels the obstacles, which are ordered by angle, with array operations over the gaps between consecutive
+        obstacles.
+
+        The scan is split where the gap is greater than {split_distance}, and the segments with less than
+        {minimum_points} obstacles are pruned as noise. Then two consecutive remaining segments are merged when the end
+        of the first one is closer than {merge_distance} to the start of the second one, across the pruned obstacles
+        between them. The last and the first obstacles are neighbours too, so a segment may wrap around.
+
+        >>> xy = [[0, 0], [1, 0], [2, 0], [50, 0], [51, 0], [100, 0], [101, 0], [102, 0], [1, 1]]
+        >>> RobotPerception(0, PointCloud(xy), Point(0, 0)).segment().tolist()
+        [0, 0, 0, -1, -1, 1, 1, 1, 0]
+
+        A spike in a wall is pruned and the wall stays one segment:
+
+        >>> xy = [[0, 0], [1, 0], [2, 0], [2, 15], [3, 0], [4, 0], [5, 0], [100, 0], [101, 0], [102, 0]]
+        >>> RobotPerception(0, PointCloud(xy), Point(0, 0)).segment().tolist()
+        [0, 0, 0, -1, 0, 0, 0, 1, 1, 1]
+
+        :param split_distance: Cluster.minimum_distance_between_clusters by default
+        :param merge_distance: Cluster.maximum_distance_between_means by default
+        :param minimum_points: Cluster.minimum_points_in_cluster by default
+        :return: (N,) label of each obstacle, labels are consecutive from 0 in the order of their first obstacle, -1
+        for pruned obstacles
+        """
+        return self._segment(split_distance, merge_distance, minimum_points)[0]
+
+    @profiling.profiled("segmentation")
+    def _segment(self,
+                 split_distance: Optional[float] = None,
+                 merge_distance: Optional[float] = None,
+                 minimum_points: Optional[int] = None):
+        """
+        :return: the labels, see segment, and the indices of the obstacles in a circular scan order in which the
+        obstacles of each label are in scan order
+        """
+        if split_distance is None:
+            split_distance = Cluster.minimum_distance_between_clusters
+        if merge_distance is None:
+            merge_distance = Cluster.maximum_distance_between_means
+        if minimum_points is None:
+            minimum_points = Cluster.minimum_points_in_cluster
 
-    def clusterize(self) -> List[Cluster]:
+        xy = self.obstacles.xy
+        n = len(xy)
+        if n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        # gap i is between obstacles i and i + 1, the closing gap is the one between the last and the first obstacles
+        gaps = np.hypot(*(np.roll(xy, -1, axis=0) - xy).T)
+        boundaries = gaps > split_distance
+        # the scan is rotated to start after a boundary, so that no segment wraps around
+        first = (np.flatnonzero(boundaries)[-1] + 1) % n if np.any(boundaries) else 0
+        order = np.roll(np.arange(n), -first)
+        segment_ids = np.concatenate([[0], np.cumsum(boundaries[order][:-1])])
+        counts = np.bincount(segment_ids)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        kept = counts >= minimum_points
+        kept_starts = starts[kept]
+        kept_ends = (starts + counts - 1)[kept]
+        if len(kept_starts) == 0:
+            return np.full(n, -1, dtype=np.int64), order
+
+        # merged[i]: kept segment i merges with the next kept one
+        facing = xy[order[np.roll(kept_starts, -1)]] - xy[order[kept_ends]]
+        merged = np.hypot(*facing.T) < merge_distance
+        if len(kept_starts) == 1:
+            merged[:] = False
+        groups = np.concatenate([[0], np.cumsum(~merged[:-1])])
+        shift = 0
+        if merged[-1] and groups[-1] != 0:
+            # the last group continues the first one
+            shift = kept_starts[np.argmax(groups == groups[-1])]
+            groups[groups == groups[-1]] = 0
+        segment_groups = np.full(len(counts), -1, dtype=np.int64)
+        segment_groups[kept] = groups
+        rotated_labels = np.roll(segment_groups[segment_ids], -shift)
+        order = np.roll(order, -shift)
+
+        labels = np.empty(n, dtype=np.int64)
+        labels[order] = rotated_labels
+        # labels are numbered in the order of their first obstacle
+        present, first_indices = np.unique(labels[labels >= 0], return_index=True)
+        mapping = np.empty(len(counts), dtype=np.int64)
+        mapping[present] = np.argsort(np.argsort(np.flatnonzero(labels >= 0)[first_indices]))
+        labels = np.where(labels >= 0, mapping[np.maximum(labels, 0)], -1)
+        return labels, order
+
+    @profiling.profiled("clustering")
+    def clusterize(self,
+                   split_distance: Optional[float] = None,
+                   merge_distance: Optional[float] = None,
+                   minimum_points: Optional[int] = None) -> List[Cluster]:
         """
+        Clusters given by segment, in the order of their labels. The points of a cluster are in scan order, so the
+        points of a cluster which wraps around start with the end of the scan.
+
+        :param split_distance:
+        :param merge_distance:
+        :param minimum_points:
         :return:
         """
-        clusters = []
-        if len(self.obstacles) > 0:
-            n = 0
-            clusters.append(Cluster())
-            clusters[0].append(self.obstacles[0])
-
-            for i in range(1, len(self.obstacles) - 1):
-                if self.obstacles[i - 1].distance(self.obstacles[i]) > Cluster.minimum_distance_between_clusters:
-                    n += 1
-                    clusters.append(Cluster())
-                clusters[n].append(self.obstacles[i])
-            if self.obstacles[0].distance(self.obstacles[-1]) <= Cluster.minimum_distance_between_clusters:
-                # TODO fix it
-                if len(clusters) > 1:
-                    print(len(clusters))
-                    clusters[-1].extend(clusters[0])
-                    clusters[0] = clusters.pop()
-                    n -= 1
-
-            if len(clusters) > 1:
-                j = 0
-                k = 1
-                while k < n:
-                    dist_j = clusters[j].distance(clusters[k])
-                    # if cluster barycenters are close enough to each other, then clusters are merged
-                    if dist_j < Cluster.maximum_distance_between_means:
-                        clusters[j].extend(clusters[k])
-                        del clusters[k]
-                        n -= 1
-                    else:
-                        # if the j'th and k'th are far enough, then, they are just different clusters
-                        j += 1
-                        k += 1
-                        # if a cluster has too few points, then it is deleted
-                        if len(clusters[j - 1]) < Cluster.minimum_points_in_cluster:
-                            del clusters[j - 1]
-                            n -= 1
-                # if cluster_distance_mean(clusters[0], clusters[-1]) < 200:
-                if clusters[0].distance(clusters[-1]) < Cluster.maximum_distance_between_means:
-                    clusters[-1].extend(clusters[0])
-                    clusters[0] = clusters.pop()
-        return clusters
+        labels, order = self._segment(split_distance, merge_distance, minimum_points)
+        # in {order}, the obstacles of each cluster are in scan order, even when it wraps around
+        ordered_labels = labels[order]
+        positions = np.flatnonzero(ordered_labels >= 0)
+        positions = positions[np.argsort(ordered_labels[positions], kind="stable")]
+        counts = np.bincount(ordered_labels[positions]) if len(positions) > 0 else np.empty(0, dtype=np.int64)
+        return [Cluster(self.obstacles[order[cluster_positions]])
+                for cluster_positions in np.split(positions, np.cumsum(counts)[:-1]) if len(cluster_positions) > 0]
@@ -1,16 +1,26 @@
 import math
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Union
 
 import numpy as np
 
 from slam_robot.models.action import Action
 from slam_robot.models.perception import RobotPerception
 from slam_robot.models.world import World
+from slam_robot.utils import profiling
 from slam_robot.utils.geometry import Point
+from slam_robot.utils.point_cloud import PointCloud
 
 
 class Robot:
-    def __init__(self, initial_position: Point, initial_orientation: float):
+    def __init__(self, initial_position: Point, initial_orientation: float,
+                 rng: Optional[np.random.Generator] = None):
+        """
+
+        :param initial_position:
+        :param initial_orientation:
+        :param rng: if given, moves, turns and measures are noisy, with the standard deviations of the uncertainty
+        region, and drawn from {rng} so that a seeded generator gives reproducible runs
+        """
         # region robot state
         self.position = initial_position
         self.orientation = initial_orientation
@@ -26,7 +36,9 @@ class Robot:
         # region uncertainty
         self.rotation_noise = 0.01
         self.translation_noise = 0.01
+        self.range_noise = 1.  # in mm
         # self.velocity_noise = 0.01
+        self.rng = rng
 
         # endregion
 
@@ -37,14 +49,18 @@ class Robot:
 
     # region actions
     def move(self, duration: float) -> Point:
-        # TODO add translation_noise
-        translation = Point(self.velocity * duration * math.cos(self.orientation), self.velocity * duration * math.sin(self.orientation))
+        distance = self.velocity * duration
+        if self.rng is not None:
+            distance *= 1 + self.translation_noise * self.rng.standard_normal()
+        translation = Point(distance * math.cos(self.orientation), distance * math.sin(self.orientation))
         self.position += translation
         return self.position
 
     def turn(self, duration: float) -> float:
-        # TODO add rotation_noise
-        self.orientation += self.rotation_velocity * duration
+        rotation = self.rotation_velocity * duration
+        if self.rng is not None:
+            rotation *= 1 + self.rotation_noise * self.rng.standard_normal()
+        self.orientation += rotation
         return self.orientation
 
     def apply_action(self, action: Action, world):
@@ -53,7 +69,7 @@ class Robot:
 
     def apply_actions(self, actions: List[Action], world):
         for action in actions:
-            print(action)
+            profiling.log_event("action", action=action)
             action.apply(self, world)
 
     def set_velocity(self, velocity: float):
@@ -64,19 +80,20 @@ class Robot:
 
     # endregion
 
-    def sense(self, world: World) -> List[Optional[Point]]:
-        obstacles = []
-        for angle in np.linspace(0, 2 * np.pi, self.angle_measures):
-            obstacle = world.see_obstacles(self.position, angle)
-            if obstacle and obstacle.distance(self.position) < self.measure_max_distance:
-                obstacles.append(obstacle)
+    @profiling.profiled("sense")
+    def sense(self, world: World) -> PointCloud:
+        angles = np.linspace(0, 2 * np.pi, self.angle_measures)
+        distances = world.cast_rays(self.position, angles)
+        if self.rng is not None:
+            distances = distances + self.range_noise * self.rng.standard_normal(len(distances))
+        seen = distances < self.measure_max_distance
+        obstacles = PointCloud.from_polar(angles[seen], distances[seen], self.position,
+                                          np.full(np.count_nonzero(seen), float(self.lifetime)))
         self.add_measure(obstacles)
         return obstacles
 
     def draw(self, ax: Any):
         ax.scatter([self.position.x], [self.position.y], color='red', marker='o', s=20)
 
-    def add_measure(self, obstacles: List[Point]):
-        self.measures.append(RobotPerception(self.lifetime, obstacles, self.position))
-
-
+    def add_measure(self, obstacles: Union[PointCloud, List[Point]]):
+        self.measures.append(RobotPerception(self.lifetime, obstacles, self.position, self.orientation))
@@ -1,40 +1,214 @@
-from typing import List, Optional, Any
+import math
+from typing import Any, Dict, List, Optional, Union
 
-from slam_robot.models.world_items import WorldItem, LineByPointAndAngle
+import numpy as np
+
+from slam_robot.methods.raycasting import RayCaster
+from slam_robot.models.likelihood_field import LikelihoodField
+from slam_robot.models.world_items import WorldItem, LineByPointAndAngle, LineByTwoPoints, LineSegment
+from slam_robot.utils import profiling
 from slam_robot.utils.geometry import Point
+from slam_robot.utils.uniform_grid import UniformGrid
 
 
 class World:
-    def __init__(self, items: List[WorldItem], limit_x: int, limit_y: int):
+    def __init__(self, items: List[WorldItem], limit_x: int, limit_y: int, grid_cell_size: Optional[float] = None,
+                 grid_margin: float = 10.):
+        """
+
+        :param items:
+        :param limit_x:
+        :param limit_y:
+        :param grid_cell_size: side of the cells of the grid used by see_obstacles, chosen from the number of items if
+        None
+        :param grid_margin: the grid covers the world and {grid_margin} around it
+        """
         self.items = items
         self.limit_x = limit_x
         self.limit_y = limit_y
+        self.grid_cell_size = grid_cell_size
+        self.grid_margin = grid_margin
+        self._ray_caster: Optional[RayCaster] = None
+        self._likelihood_fields = {}
+        self._grid: Optional[UniformGrid] = None
+        # key of the grid -> item, kept with the grid
+        self._grid_items: Dict[int, WorldItem] = {}
+        # items which may be hit outside the grid: unbounded lines and items which stick out of it
+        self._items_outside_grid = set()
+        # list and number of items the grid and the ray caster were built from, a cheap test of direct modifications
+        self._grid_source = (None, 0)
+        self._ray_caster_source = (None, 0)
+
+    # region items
+    def _is_current(self, source) -> bool:
+        return source[0] is self.items and source[1] == len(self.items)
+
+    def invalidate(self):
+        """
+        Drops the grid and the compiled items. Needed only if {self.items} was modified in place without changing its
+        length, other changes are detected.
+        """
+        self._grid = None
+        self._ray_caster = None
+        self._likelihood_fields = {}
+
+    def add_item(self, item: WorldItem):
+        """
+        Adds {item}, only its cells of the grid are updated.
+        """
+        grid_is_current = self._grid is not None and self._is_current(self._grid_source)
+        self.items.append(item)
+        self._ray_caster = None
+        if grid_is_current:
+            self._grid_items[id(item)] = item
+            self._insert_in_grid(item)
+            self._grid_source = (self.items, len(self.items))
+
+    def remove_item(self, item: WorldItem):
+        """
+        Removes {item}, only its cells of the grid are updated.
+        """
+        grid_is_current = self._grid is not None and self._is_current(self._grid_source)
+        self.items.remove(item)
+        self._ray_caster = None
+        if grid_is_current:
+            del self._grid_items[id(item)]
+            self._grid.remove(id(item))
+            self._items_outside_grid.discard(id(item))
+            self._grid_source = (self.items, len(self.items))
+
+    def _insert_in_grid(self, item: WorldItem):
+        key = id(item)
+        box = item.get_bounding_box()
+        if isinstance(item, LineSegment):
+            self._grid.insert_segment(key, item.point_1.to_tuple(), item.point_2.to_tuple())
+        elif isinstance(item, LineByTwoPoints):
+            self._grid.insert_line(key, item.point_1.to_tuple(), (item.point_2 - item.point_1).to_tuple())
+        elif box is not None:
+            self._grid.insert_box(key, box)
+        else:
+            self._grid.insert_box(key, (self._grid.x_min, self._grid.y_min, self._grid.x_max, self._grid.y_max))
+        if box is None or not self._grid.contains_box(box):
+            self._items_outside_grid.add(key)
+
+    @property
+    def grid(self) -> UniformGrid:
+        """
+        Uniform grid over the bounding boxes of the items, infinite lines are clipped to the grid.
+        It is built again only if {self.items} changed other than through add_item and remove_item, see invalidate.
+        :return:
+        """
+        if self._grid is None or not self._is_current(self._grid_source):
+            cell_size = self.grid_cell_size
+            if cell_size is None:
+                cell_size = max(self.limit_x, self.limit_y) / max(4, math.ceil(math.sqrt(len(self.items))))
+            self._grid = UniformGrid(-self.grid_margin, -self.grid_margin, self.limit_x + self.grid_margin,
+                                     self.limit_y + self.grid_margin, cell_size)
+            self._grid_items = {id(item): item for item in self.items}
+            self._items_outside_grid = set()
+            for item in self.items:
+                self._insert_in_grid(item)
+            self._grid_source = (self.items, len(self.items))
+        return self._grid
+
+    def build_grid(self) -> UniformGrid:
+        """
+        Builds the grid now instead of at the first query, if it is not current.
+        :return:
+        """
+        return self.grid
+    # endregion
+
+    @property
+    def ray_caster(self) -> RayCaster:
+        """
+        Items compiled into arrays. They are compiled again only if {self.items} changed, see invalidate.
+        :return:
+        """
+        if self._ray_caster is None or not self._is_current(self._ray_caster_source):
+            self._ray_caster = RayCaster(self.items)
+            self._ray_caster_source = (self.items, len(self.items))
+            self._likelihood_fields = {}
+        return self._ray_caster
+
+    def likelihood_field(self, resolution: float, margin: float = 0.,
+                         cache_directory: Optional[str] = None) -> LikelihoodField:
+        """
+        Distance to the closest item on a grid of step {resolution}, see LikelihoodField.
+
+        It is kept in memory until the items change, and cached in {cache_directory}, if given, under a hash of the
+        geometry. LIKELIHOOD_FIELD_CACHE is a suitable directory.
+
+        :param resolution: in mm
+        :param margin: the grid covers the world and {margin} around it
+        :param cache_directory: no disk cache if None
+        :return:
+        """
+        ray_caster = self.ray_caster
+        key = (resolution, margin)
+        if key not in self._likelihood_fields:
+            self._likelihood_fields[key] = LikelihoodField.from_world_geometry(
+                ray_caster, self.limit_x, self.limit_y, resolution, margin, cache_directory)
+        return self._likelihood_fields[key]
+
+    @profiling.profiled("raycast")
+    def cast_rays(self, origin: Union[Point, np.ndarray], angles: Union[np.ndarray, List[float]]) -> np.ndarray:
+        """
+        Distances to the first obstacle seen from {origin} at each angle of {angles}, np.inf if there is none.
+
+        All the rays are intersected with all the items at once, see RayCaster.cast.
+
+        :param origin: Point, (2,) or (P, 2) array
+        :param angles: (A,) or (P, A) angles in radian
+        :return: (A,) or (P, A) distances
+        """
+        if isinstance(origin, Point):
+            origin = origin.to_array()
+        return self.ray_caster.cast(origin, angles)
 
     def see_obstacles(self, point: Point, angle: float) -> Optional[Point]:
         """
         Returns the distance at which the first obstacle visible from {self.items} at {angle} angle.
 
+        Only the items of the cells of the grid crossed by the ray are tested, from the closest cell to the farthest
+        one, and the search stops at the first cell which contains a collision.
+
         :param point:
         :param angle:
         :return:
         """
         line = LineByPointAndAngle(point, angle)
-        collisions = []
-        for item in self.items:
-            intersections = item.get_collision(point, angle)
-            if intersections:
-                collisions.extend(intersections)
+        grid = self.grid
+        items = self._grid_items
+        tested = set()
         collision = None
-        for c in collisions:
-            # measure_vector = point.from_angle_to_vector(angle)
-            # collision_vector = point.from_other_point_to_vector(c)
-            # scalar_product = measure_vector.scalar_product(collision_vector)
-            if line.is_in_same_sense(c):
-                if collision:
-                    if point.distance(c) < point.distance(collision):
-                        collision = c
+        collision_distance = math.inf
+
+        def test(keys):
+            nonlocal collision, collision_distance
+            for key in keys:
+                if key in tested:
+                    continue
+                tested.add(key)
+                for c in items[key].get_collision(point, angle) or []:
+                    if line.is_in_same_sense(c):
+                        distance = point.distance(c)
+                        if distance < collision_distance:
+                            collision, collision_distance = c, distance
+
+        with profiling.span("raycast.see_obstacles"):
+            if grid.contains_point(point.to_tuple()):
+                for keys, t_enter, t_exit in grid.traverse(point.to_tuple(), (math.cos(angle), math.sin(angle))):
+                    test(keys)
+                    if collision_distance <= t_exit:
+                        break
                 else:
-                    collision = c
+                    # the ray left the grid
+                    test(self._items_outside_grid)
+            else:
+                # the ray may hit items before entering the grid
+                test(items)
+        profiling.count("raycast.see_obstacles.tested_items", len(tested))
         return collision
         # if collisions:
         #     if len(collisions) > 1:
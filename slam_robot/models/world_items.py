@@ -1,17 +1,27 @@
 import math
-from typing import List, Any, Optional
+from typing import List, Any, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from slam_robot.utils import profiling
 from slam_robot.utils.geometry import Point
 
+# relative tolerance on the ends of a LineSegment, so that two segments sharing an end leave no gap
+SEGMENT_TOLERANCE = 1e-9
+
 
 class WorldItem:
 
     def get_collision(self, origin: Point, angle: float) -> List[Point]:
         raise NotImplementedError
 
+    def get_bounding_box(self) -> Optional[Tuple[float, float, float, float]]:
+        """
+        :return: (x_min, y_min, x_max, y_max), None if the item is unbounded
+        """
+        return None
+
     def draw(self, ax: Any, limit_inf_x=0, limit_sup_x=100, limit_inf_y=0, limit_sup_y=100, description=""):
         raise NotImplementedError
 
@@ -99,14 +109,11 @@ class Circle(WorldItem):
         :return:
         """
         line = LineByPointAndAngle(origin, angle).line_by_two_points
-        print(f"origin: {origin}, angle: {angle}")
-        print(f"line point_1: {line.point_1}, line point_2: {line.point_2}")
         cartesian_line = line.cartesian_line
-        print(f"line: {line.cartesian_line.a}, {line.cartesian_line.b}, {line.cartesian_line.c}")
 
         distance = (math.fabs(cartesian_line.a * self.center.x + cartesian_line.b * self.center.y + cartesian_line.c)
                     / math.sqrt(cartesian_line.a ** 2 + cartesian_line.b ** 2))
-        print(f"distance: {distance}, radius: {self.radius}")
+        profiling.log_event("circle_collision", origin=origin, angle=angle, distance=distance, radius=self.radius)
         # Translate the center on the origin
         centered_point_1 = line.point_1 - self.center
         centered_point_2 = line.point_2 - self.center
@@ -119,7 +126,6 @@ class Circle(WorldItem):
         discriminant = self.radius ** 2 * d_r_squared - determinant ** 2
 
         if discriminant < 0:
-            print("The line does not intersect the circle.")
             return None
             # raise ValueError("The line does not intersect the circle.")
 
@@ -140,6 +146,10 @@ class Circle(WorldItem):
 
         return [point_a, point_b]
 
+    def get_bounding_box(self) -> Tuple[float, float, float, float]:
+        return (self.center.x - self.radius, self.center.y - self.radius,
+                self.center.x + self.radius, self.center.y + self.radius)
+
     def draw(self, ax, limit_inf_x=0, limit_sup_x=100, limit_inf_y=0, limit_sup_y=100, description=""):
         circle = plt.Circle(self.center.to_tuple(), self.radius, edgecolor="green", facecolor="none")
         ax.add_patch(circle)
@@ -266,6 +276,40 @@ class LineByTwoPoints(WorldItem):
         self.cartesian_line.draw(ax, limit_inf_x, limit_sup_x, limit_inf_y, limit_sup_y)
 
 
+class LineSegment(LineByTwoPoints):
+    """
+    Segment between its two points, unlike LineByTwoPoints which is the whole line through them.
+    """
+    def get_collision(self, origin: Point, angle: float) -> List[Point]:
+        """
+        >>> segment = LineSegment(Point(10, 0), Point(10, 10))
+        >>> segment.get_collision(Point(0, 5), 0)
+        [Point(10.0, 5.0)]
+        >>> segment.get_collision(Point(0, 20), 0)
+        []
+
+        :param origin:
+        :param angle:
+        :return:
+        """
+        direction = self.point_2 - self.point_1
+        squared_length = direction.x ** 2 + direction.y ** 2
+        collisions = []
+        for collision in super().get_collision(origin, angle):
+            offset = collision - self.point_1
+            u = (offset.x * direction.x + offset.y * direction.y) / squared_length
+            if -SEGMENT_TOLERANCE <= u <= 1 + SEGMENT_TOLERANCE:
+                collisions.append(collision)
+        return collisions
+
+    def get_bounding_box(self) -> Tuple[float, float, float, float]:
+        return (min(self.point_1.x, self.point_2.x), min(self.point_1.y, self.point_2.y),
+                max(self.point_1.x, self.point_2.x), max(self.point_1.y, self.point_2.y))
+
+    def draw(self, ax: Any, limit_inf_x=0, limit_sup_x=100, limit_inf_y=0, limit_sup_y=100, description=""):
+        ax.plot([self.point_1.x, self.point_2.x], [self.point_1.y, self.point_2.y], color="black")
+
+
 class LineByPointAndAngle:
     def __init__(self, point: Point, angle: float):
         self.point = point
@@ -0,0 +1,224 @@
+"""
+Batch simulation of scenarios in a process pool.
+
+A scenario is a start pose, an action script and a seed. The world is pickled once per worker, through the pool
+initializer, instead of once per scenario. A worker returns arrays only: the trajectory of the robot and one value of
+each metric per turn of the lidar, never the Robot with its measures.
+
+The seed of the noise of a scenario is derived from the base seed and the scenario name, so a scenario gives the same
+result whatever the worker which runs it and the order of the batch. With a results directory, each result is saved
+as soon as it is received, with its seed and a digest of its parameters. The scenarios already saved with the same
+seed and parameters are not run again, so an interrupted batch can be resumed.
+"""
+
+import hashlib
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from slam_robot.models.action import Action, Sense
+from slam_robot.models.perception import RobotPerception
+from slam_robot.models.robot import Robot
+from slam_robot.models.world import World
+from slam_robot.utils.geometry import Point
+
+TRAJECTORY_COLUMNS = ("time", "x", "y", "theta")
+
+
+class Scenario:
+    def __init__(self, name: str, initial_pose: Sequence[float], actions: List[Action], seed: Optional[int] = None):
+        """
+
+        :param name: unique in a batch, used as file name in the results directory
+        :param initial_pose: (x, y, theta)
+        :param actions: script applied with Robot.apply_action
+        :param seed: seed of the noise, derived from the base seed of the batch and {name} if None
+        """
+        self.name = name
+        self.initial_pose = tuple(float(value) for value in initial_pose)
+        self.actions = actions
+        self.seed = seed
+
+
+class ScenarioResult:
+    def __init__(self, name: str, trajectory: np.ndarray, turn_times: np.ndarray, metrics: Dict[str, np.ndarray],
+                 seed: Optional[int] = None, parameters: Optional[str] = None):
+        """
+
+        :param name:
+        :param trajectory: (A + 1, 4) (time, x, y, theta) at the start and after each action
+        :param turn_times: (K,) time of each turn of the lidar
+        :param metrics: (K,) value of each metric at each turn
+        :param seed: seed of the noise of the run
+        :param parameters: digest given by scenario_parameters
+        """
+        self.name = name
+        self.trajectory = trajectory
+        self.turn_times = turn_times
+        self.metrics = metrics
+        self.seed = seed
+        self.parameters = parameters
+
+    def __str__(self):
+        return f"ScenarioResult({self.name}, {len(self.trajectory)} poses, {len(self.turn_times)} turns)"
+
+    def save(self, path: str):
+        temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+        provenance = {} if self.seed is None else {"seed": np.array(str(self.seed))}
+        if self.parameters is not None:
+            provenance["parameters"] = np.array(self.parameters)
+        np.savez(temporary_path, trajectory=self.trajectory, turn_times=self.turn_times, **provenance,
+                 **{f"metric_{name}": values for name, values in self.metrics.items()})
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, name: str, path: str) -> "ScenarioResult":
+        with np.load(path) as saved:
+            metrics = {key[len("metric_"):]: saved[key] for key in saved.files if key.startswith("metric_")}
+            seed = int(saved["seed"].item()) if "seed" in saved.files else None
+            parameters = str(saved["parameters"].item()) if "parameters" in saved.files else None
+            return cls(name, saved["trajectory"], saved["turn_times"], metrics, seed, parameters)
+
+
+# region metrics
+def number_of_obstacles(perception: RobotPerception) -> float:
+    return len(perception.obstacles)
+
+
+def number_of_clusters(perception: RobotPerception) -> float:
+    return len(perception.clusterize())
+
+
+DEFAULT_METRICS = {"number_of_obstacles": number_of_obstacles, "number_of_clusters": number_of_clusters}
+# endregion
+
+
+def scenario_seed(base_seed: int, name: str) -> int:
+    """
+    >>> scenario_seed(0, "a") == scenario_seed(0, "a") != scenario_seed(1, "a")
+    True
+    """
+    return int(np.random.SeedSequence([base_seed, zlib.crc32(name.encode())]).generate_state(1)[0])
+
+
+def scenario_parameters(scenario: Scenario, metric_names) -> str:
+    """
+    Digest of the initial pose, the actions and the metric names of {scenario}. Actions are described by their class
+    and attributes, so it is computed before they are applied: Move and Turn set their duration when applied.
+
+    >>> digest = scenario_parameters(Scenario("a", (0, 0, 0), [Sense()]), ["count"])
+    >>> digest == scenario_parameters(Scenario("b", (0., 0., 0.), [Sense()]), ["count"])
+    True
+    """
+    description = repr((scenario.initial_pose,
+                        [(type(action).__name__, sorted(vars(action).items())) for action in scenario.actions],
+                        sorted(metric_names)))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def run_scenario(world: World, scenario: Scenario, seed: int,
+                 metrics: Dict[str, Callable[[RobotPerception], float]]) -> ScenarioResult:
+    """
+    Runs {scenario} in the current process. The measures of a turn are dropped once its metrics are computed.
+    """
+    x, y, theta = scenario.initial_pose
+    robot = Robot(Point(x, y), theta, rng=np.random.default_rng(seed))
+    trajectory = np.empty((len(scenario.actions) + 1, len(TRAJECTORY_COLUMNS)))
+    trajectory[0] = robot.lifetime, x, y, theta
+    turn_times = []
+    values = {name: [] for name in metrics}
+    for i, action in enumerate(scenario.actions):
+        robot.apply_action(action, world)
+        if isinstance(action, Sense):
+            perception = robot.measures[-1]
+            turn_times.append(perception.timestamp)
+            for name, metric in metrics.items():
+                values[name].append(metric(perception))
+            robot.measures.clear()
+        trajectory[i + 1] = robot.lifetime, robot.position.x, robot.position.y, robot.orientation
+    return ScenarioResult(scenario.name, trajectory, np.array(turn_times, dtype=float),
+                          {name: np.array(metric_values, dtype=float) for name, metric_values in values.items()})
+
+
+# region workers
+_worker_world: Optional[World] = None
+_worker_metrics: Dict[str, Callable[[RobotPerception], float]] = {}
+
+
+def _initialize_worker(world: World, metrics: Dict[str, Callable[[RobotPerception], float]]):
+    global _worker_world, _worker_metrics
+    _worker_world = world
+    _worker_metrics = metrics
+
+
+def _run_in_worker(scenario: Scenario, seed: int):
+    result = run_scenario(_worker_world, scenario, seed, _worker_metrics)
+    return result.name, result.trajectory, result.turn_times, result.metrics
+# endregion
+
+
+def run_scenarios(world: World,
+                  scenarios: List[Scenario],
+                  results_directory: Optional[str] = None,
+                  base_seed: int = 0,
+                  max_workers: Optional[int] = None,
+                  metrics: Optional[Dict[str, Callable[[RobotPerception], float]]] = None,
+                  on_result: Optional[Callable[[ScenarioResult], None]] = None) -> Dict[str, ScenarioResult]:
+    """
+    Runs {scenarios} in a pool of processes.
+
+    :param world: sent once to each worker
+    :param scenarios:
+    :param results_directory: results are saved there as {name}.npz, and the scenarios already saved with the same
+    seed and parameters are skipped, the world is not checked, so use another directory for another world
+    :param base_seed: seed of the scenarios without a seed
+    :param max_workers: number of processes, os.cpu_count() if None
+    :param metrics: name -> function of a RobotPerception, it must be picklable, so defined at module level,
+    DEFAULT_METRICS if None
+    :param on_result: called with each result received from a worker, in completion order
+    :return: name -> result, for all the scenarios, loaded or run
+    """
+    metrics = DEFAULT_METRICS if metrics is None else metrics
+    names = [scenario.name for scenario in scenarios]
+    if len(set(names)) != len(names):
+        raise ValueError("Scenario names must be unique")
+
+    results = {}
+    pending = []
+    for scenario in scenarios:
+        seed = scenario.seed if scenario.seed is not None else scenario_seed(base_seed, scenario.name)
+        parameters = scenario_parameters(scenario, metrics)
+        path = _result_path(results_directory, scenario.name)
+        if path is not None and os.path.exists(path):
+            saved = ScenarioResult.load(scenario.name, path)
+            # a result saved for another seed or other parameters is run again
+            if saved.seed == seed and saved.parameters == parameters:
+                results[scenario.name] = saved
+                continue
+        pending.append((scenario, seed, parameters))
+
+    if pending:
+        if results_directory is not None:
+            os.makedirs(results_directory, exist_ok=True)
+        provenance = {scenario.name: (seed, parameters) for scenario, seed, parameters in pending}
+        with ProcessPoolExecutor(max_workers, initializer=_initialize_worker, initargs=(world, metrics)) as executor:
+            futures = [executor.submit(_run_in_worker, scenario, seed) for scenario, seed, _ in pending]
+            for future in as_completed(futures):
+                result = ScenarioResult(*future.result())
+                result.seed, result.parameters = provenance[result.name]
+                path = _result_path(results_directory, result.name)
+                if path is not None:
+                    result.save(path)
+                results[result.name] = result
+                if on_result is not None:
+                    on_result(result)
+    return {name: results[name] for name in names}
+
+
+def _result_path(results_directory: Optional[str], name: str) -> Optional[str]:
+    if results_directory is None:
+        return None
+    return os.path.join(results_directory, f"{name}.npz")
@@ -10,6 +10,8 @@ import sys
 import enum
 import logging
 
+from slam_robot import PACKDIR
+
 __author__ = "Clément Besnier"
 
 PROJECT_NAME = "lidar-processor"
@@ -55,6 +57,10 @@ maximum_points_in_cluster = 50
 
 TOLERANCE_FOR_CIRCLE_COHERENCE = 100
 
+RANSAC_TOLERANCE = 10  # in mm
+RANSAC_HYPOTHESES = 64
+RANSAC_MINIMUM_INLIER_RATIO = 0.8
+
 FIX_BEACON_RADIUS = 50  # in mm
 OPPONENT_ROBOT_BEACON_RADIUS = 80
 
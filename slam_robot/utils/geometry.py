@@ -10,6 +10,8 @@ __author__ = ["Clément Besnier", ]
 
 import numpy as np
 
+from slam_robot.utils import profiling
+
 
 class Point:
     def __init__(self, x: float, y: float):
@@ -92,21 +94,13 @@ class Point:
         return cls(distance*np.cos(angle), distance*np.sin(angle))
 
     def to_angle(self):
-        if self.x != 0:
-            if self.x > 0 and self.y >= 0:
-                return math.atan(self.y / self.x)
-            elif self.x > 0 > self.y:
-                return math.atan(self.y / self.x) + 2 * math.pi
-            elif self.x < 0:
-                return math.atan(self.y / self.x) + math.pi
-            elif self.x == 0 and self.y > 0:
-                return math.pi / 2
-            elif self.x == 0 and self.y < 0:
-                return 3 * math.pi / 2
-            else:
-                return 0
-        else:
-            return math.pi / 2
+        """
+        >>> Point(0., -1.).to_angle() == 3 * math.pi / 2
+        True
+
+        :return: angle to the (Ox) axis, in [0, 2 pi)
+        """
+        return math.atan2(self.y, self.x) % (2 * math.pi)
 
     def to_distance(self):
         return np.sqrt(self.x**2 + self.y**2)
@@ -295,8 +289,8 @@ class Segment:
         t = numerator / denominator
         # print("t", t)
         if 0 <= t <= 1:
-            print("x: ", self.p1.x + t * (self.p2.x - self.p1.x))
-            print("y: ", self.p1.y + t * (self.p2.y - self.p1.y))
+            profiling.log_event("segment_collision", x=self.p1.x + t * (self.p2.x - self.p1.x),
+                                y=self.p1.y + t * (self.p2.y - self.p1.y))
 
         # px = (self.get_determinant() * other.get_x_difference() - self.get_x_difference() * other.get_determinant())
         # / \ denominator
@@ -311,37 +305,148 @@ class Segment:
         #     return False
 
 
-def from_lidar_to_table(point: Point, robot_position: Point, robot_orientation: float) -> Point:
+class Pose2D:
+    __slots__ = ("_x", "_y", "_theta", "_cos", "_sin", "_rotation")
+
+    def __init__(self, x: float, y: float, theta: float):
+        """
+        Immutable rigid transform of the plane: a rotation by {theta} followed by a translation by (x, y). It is also
+        the pose of a frame in another one, apply maps coordinates in the frame to coordinates in the other one.
+
+        >>> pose = Pose2D(1., 2., np.pi / 2)
+        >>> pose.apply(Point(1., 0.))
+        Point(1.0, 3.0)
+        >>> np.round(pose.apply(np.array([[1., 0.], [0., 1.]])), 12).tolist()
+        [[1.0, 3.0], [0.0, 2.0]]
+        >>> np.round(pose.compose(pose.inverse()).to_tuple(), 12).tolist()
+        [0.0, 0.0, 0.0]
+
+        :param x:
+        :param y:
+        :param theta: in radian
+        """
+        self._x = float(x)
+        self._y = float(y)
+        self._theta = float(theta)
+        self._cos = math.cos(self._theta)
+        self._sin = math.sin(self._theta)
+        self._rotation = np.array([[self._cos, -self._sin], [self._sin, self._cos]])
+        self._rotation.flags.writeable = False
+
+    @property
+    def x(self) -> float:
+        return self._x
+
+    @property
+    def y(self) -> float:
+        return self._y
+
+    @property
+    def theta(self) -> float:
+        return self._theta
+
+    @property
+    def rotation(self) -> np.ndarray:
+        """
+        Read-only 2x2 rotation matrix.
+        """
+        return self._rotation
+
+    def __repr__(self):
+        return f"Pose2D({self._x}, {self._y}, {self._theta})"
+
+    def to_tuple(self):
+        return self._x, self._y, self._theta
+
+    def to_matrix(self) -> np.ndarray:
+        """
+        :return: 3x3 homogeneous matrix
+        """
+        return np.array([[self._cos, -self._sin, self._x], [self._sin, self._cos, self._y], [0., 0., 1.]])
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray) -> "Pose2D":
+        return cls(matrix[0, 2], matrix[1, 2], math.atan2(matrix[1, 0], matrix[0, 0]))
+
+    def compose(self, other: "Pose2D") -> "Pose2D":
+        """
+        self.compose(other).apply(p) is self.apply(other.apply(p)).
+
+        >>> np.round(Pose2D(1., 0., np.pi).compose(Pose2D(1., 0., 0.)).to_tuple(), 6).tolist()
+        [0.0, 0.0, 3.141593]
+        """
+        return Pose2D(self._x + self._cos * other._x - self._sin * other._y,
+                      self._y + self._sin * other._x + self._cos * other._y,
+                      self._theta + other._theta)
+
+    def inverse(self) -> "Pose2D":
+        return Pose2D(-self._cos * self._x - self._sin * self._y, self._sin * self._x - self._cos * self._y,
+                      -self._theta)
+
+    def interpolate(self, other: "Pose2D", t: float) -> "Pose2D":
+        """
+        Linear interpolation of the position, and of the angle along the shortest way.
+
+        >>> np.round(Pose2D(0., 0., 0.1).interpolate(Pose2D(2., 0., 2 * np.pi - 0.1), 0.5).to_tuple(), 12).tolist()
+        [1.0, 0.0, 0.0]
+
+        :param other: pose at t = 1
+        :param t: between 0 and 1
+        :return:
+        """
+        difference = (other._theta - self._theta + math.pi) % (2 * math.pi) - math.pi
+        return Pose2D(self._x + t * (other._x - self._x), self._y + t * (other._y - self._y),
+                      self._theta + t * difference)
+
+    def apply(self, points):
+        """
+        :param points: a Point, a (2,) or (N, 2) array or a PointCloud, whose other columns are kept
+        :return: the transformed points, of the same type as {points}, {points} is not modified
+        """
+        if isinstance(points, Point):
+            return Point(self._cos * points.x - self._sin * points.y + self._x,
+                         self._sin * points.x + self._cos * points.y + self._y)
+        xy = getattr(points, "xy", None)
+        if xy is not None:
+            from slam_robot.utils.point_cloud import PointCloud
+            return PointCloud(self._apply_to_array(xy), points.angles, points.ranges, points.timestamps)
+        return self._apply_to_array(np.asarray(points, dtype=float))
+
+    def _apply_to_array(self, xy: np.ndarray) -> np.ndarray:
+        return xy @ self._rotation.T + np.array([self._x, self._y])
+
+
+def from_lidar_to_table(point, robot_position: Point, robot_orientation: float):
     """
 
-    :param point: cartesian coordinates
+    :param point: cartesian coordinates, a Point, an (N, 2) array or a PointCloud
     :param robot_position: cartesian coordinates
     :param robot_orientation:
     :return:
     """
-    return point.rotate(robot_orientation) + robot_position
+    return Pose2D(robot_position.x, robot_position.y, robot_orientation).apply(point)
 
 
-def from_theoretical_table_to_lidar(point: Point, robot_position: Point, robot_orientation: float) -> Point:
+def from_theoretical_table_to_lidar(point, robot_position: Point, robot_orientation: float):
     """
 
-    :param point:
+    :param point: a Point, an (N, 2) array or a PointCloud
     :param robot_position:
     :param robot_orientation:
     :return:
     """
-    return (point - robot_position).rotate(np.pi/2 - robot_orientation)
+    return Pose2D(robot_position.x, robot_position.y, robot_orientation - np.pi / 2).inverse().apply(point)
 
 
-def from_real_table_to_lidar(point: Point, robot_position: Point, robot_orientation: float) -> Point:
+def from_real_table_to_lidar(point, robot_position: Point, robot_orientation: float):
     """
 
-    :param point:
+    :param point: a Point, an (N, 2) array or a PointCloud
     :param robot_position:
     :param robot_orientation:
     :return:
     """
-    return (point - robot_position).rotate(robot_orientation)
+    return Pose2D(0., 0., robot_orientation).compose(Pose2D(-robot_position.x, -robot_position.y, 0.)).apply(point)
 
 
 def from_measured_and_expected_beacon_position_to_actual_robot_position(measured_position: Point,
@@ -353,7 +458,7 @@ def from_measured_and_expected_beacon_position_to_actual_robot_position(measured
     :return:
     """
     angle = np.arctan(measured_position.y / measured_position.x)
-    robot_position = expected_position - measured_position.rotate(angle)
+    robot_position = expected_position - Pose2D(0., 0., angle).apply(measured_position)
     return robot_position.x, robot_position.y, angle
 
 
@@ -0,0 +1,271 @@
+"""
+Ingestion of the scan stream of an RPLidar-like sensor.
+
+In standard scan mode, after a 7 bytes response descriptor, the sensor sends one 5 bytes packet per measure:
+
+    byte 0  bit 0: S, start of a new turn, bit 1: not S, bits 2-7: quality
+    byte 1  bit 0: check bit, always 1, bits 1-7: bits 0-6 of angle_q6
+    byte 2  bits 7-14 of angle_q6
+    byte 3  distance_q2, low byte
+    byte 4  distance_q2, high byte
+
+the angle is angle_q6 / 64 in degrees and the distance distance_q2 / 4 in mm, 0 if the measure is invalid.
+
+ScanParser is fed with chunks of bytes of any size. Whole packets are decoded at once with numpy; if a packet fails
+the checks, the parser drops bytes until it finds valid packets again. Measures are written into preallocated turn
+buffers, and a turn is complete when the start flag of the next one arrives. LidarReader wraps a parser around an
+asyncio stream and is an async iterator of turns: it only awaits the stream, so the event loop running the control
+loop is never blocked.
+"""
+
+import asyncio
+import os
+import termios
+import time
+import tty
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+
+DESCRIPTOR = bytes([0xA5, 0x5A, 0x05, 0x00, 0x00, 0x40, 0x81])
+PACKET_SIZE = 5
+PACKETS_PER_BATCH = 1024
+
+
+class LidarTurn:
+    def __init__(self, timestamp: float, angles: np.ndarray, ranges: np.ndarray, qualities: np.ndarray):
+        """
+
+        :param timestamp: time at which the turn was complete, time.monotonic() by default
+        :param angles: (N,) in radian, in the lidar frame
+        :param ranges: (N,) in mm
+        :param qualities: (N,)
+        """
+        self.timestamp = timestamp
+        self.angles = angles
+        self.ranges = ranges
+        self.qualities = qualities
+
+    def __len__(self):
+        return len(self.angles)
+
+    def __str__(self):
+        return f"LidarTurn({self.timestamp}, {len(self)} measures)"
+
+    def copy(self) -> "LidarTurn":
+        return LidarTurn(self.timestamp, self.angles.copy(), self.ranges.copy(), self.qualities.copy())
+
+    def to_polar(self) -> np.ndarray:
+        """
+        :return: (N, 2) (theta, rho), like the turns of one_turn_to_cartesian_points
+        """
+        return np.column_stack([self.angles, self.ranges])
+
+
+def encode_packets(angles: np.ndarray, ranges: np.ndarray, qualities: np.ndarray, start: bool = True) -> bytes:
+    """
+    Packets of one turn, the first one has the start flag if {start}.
+
+    >>> data = encode_packets(np.deg2rad([0., 90.]), np.array([1000., 250.5]), np.array([47, 20]))
+    >>> len(data), data[:5].hex()
+    (10, 'bd0100a00f')
+
+    :param angles: (N,) in radian, taken modulo 2 pi
+    :param ranges: (N,) in mm
+    :param qualities: (N,) between 0 and 63
+    :param start:
+    :return:
+    """
+    angles_q6 = np.round(np.rad2deg(np.mod(angles, 2 * np.pi)) * 64).astype(np.int64) % (360 * 64)
+    distances_q2 = np.clip(np.round(np.asarray(ranges) * 4), 0, 0xFFFF).astype(np.int64)
+    packets = np.empty((len(angles_q6), PACKET_SIZE), dtype=np.uint8)
+    starts = np.zeros(len(angles_q6), dtype=np.int64)
+    if start and len(starts) > 0:
+        starts[0] = 1
+    packets[:, 0] = (np.clip(qualities, 0, 63).astype(np.int64) << 2) | ((1 - starts) << 1) | starts
+    packets[:, 1] = ((angles_q6 & 0x7F) << 1) | 1
+    packets[:, 2] = angles_q6 >> 7
+    packets[:, 3] = distances_q2 & 0xFF
+    packets[:, 4] = distances_q2 >> 8
+    return packets.tobytes()
+
+
+def decode_packets(packets: np.ndarray):
+    """
+    :param packets: (N, 5) uint8
+    :return: valid (N,), start (N,), qualities (N,), angles (N,) in radian and ranges (N,) in mm
+    """
+    first = packets[:, 0]
+    second = packets[:, 1]
+    start = (first & 1).astype(bool)
+    valid = (start != ((first >> 1) & 1).astype(bool)) & ((second & 1) == 1)
+    qualities = first >> 2
+    angles_q6 = (second.astype(np.int64) >> 1) | (packets[:, 2].astype(np.int64) << 7)
+    distances_q2 = packets[:, 3].astype(np.int64) | (packets[:, 4].astype(np.int64) << 8)
+    return valid, start, qualities, np.deg2rad(angles_q6 / 64.), distances_q2 / 4.
+
+
+class ScanParser:
+    def __init__(self, maximum_points: int = 8192, number_of_buffers: int = 4, skip_invalid_measures: bool = True,
+                 clock=time.monotonic):
+        """
+        >>> angles = np.deg2rad(np.arange(0, 360, 90.))
+        >>> data = DESCRIPTOR + encode_packets(angles, np.full(4, 500.), np.full(4, 47)) * 3
+        >>> parser = ScanParser()
+        >>> turns = parser.feed(data[:9]) + parser.feed(data[9:])
+        >>> [len(turn) for turn in turns], turns[0].ranges.tolist()
+        ([4, 4], [500.0, 500.0, 500.0, 500.0])
+
+        The third turn is complete only when the next start flag arrives. A chunk may complete more turns than there
+        are buffers, the oldest ones are then copied before their buffer is reused:
+
+        >>> data = b"".join(encode_packets(np.linspace(0, 6, 10), np.full(10, 100. * (i + 1)), np.full(10, 47))
+        ...                 for i in range(7))
+        >>> [float(turn.ranges[0]) for turn in ScanParser().feed(data)]
+        [100.0, 200.0, 300.0, 400.0, 500.0, 600.0]
+
+        :param maximum_points: capacity of a turn buffer, the measures beyond it are dropped
+        :param number_of_buffers: turns are views of a ring of buffers, so a turn is overwritten after
+        {number_of_buffers} - 1 other turns, copy it to keep it longer
+        :param skip_invalid_measures: whether the measures with a zero distance are left out
+        :param clock: gives the timestamps of the turns
+        """
+        self.maximum_points = maximum_points
+        self.skip_invalid_measures = skip_invalid_measures
+        self.clock = clock
+        self._angles = np.empty((number_of_buffers, maximum_points))
+        self._ranges = np.empty((number_of_buffers, maximum_points))
+        self._qualities = np.empty((number_of_buffers, maximum_points), dtype=np.uint8)
+        self._buffer = 0
+        self._count = 0
+        self._started = False
+        self._pending = b""
+        self._descriptor_checked = False
+        self.dropped_bytes = 0
+        self.dropped_measures = 0
+
+    def feed(self, data: bytes) -> List[LidarTurn]:
+        """
+        :param data: next bytes of the stream
+        :return: turns completed by {data}
+        """
+        data = self._pending + data
+        if not self._descriptor_checked:
+            if len(data) < len(DESCRIPTOR) and DESCRIPTOR.startswith(data):
+                self._pending = data
+                return []
+            if data.startswith(DESCRIPTOR):
+                data = data[len(DESCRIPTOR):]
+            self._descriptor_checked = True
+
+        turns = []
+        offset = 0
+        while len(data) - offset >= PACKET_SIZE:
+            # bounded, so that searching for valid packets in a corrupted stream does not decode it again and again
+            number_of_packets = min((len(data) - offset) // PACKET_SIZE, PACKETS_PER_BATCH)
+            packets = np.frombuffer(data, dtype=np.uint8, count=number_of_packets * PACKET_SIZE, offset=offset)
+            valid, start, qualities, angles, ranges = decode_packets(packets.reshape(-1, PACKET_SIZE))
+            # packets up to the first invalid one are used, then the stream is searched for the next valid packet
+            number_of_valid = number_of_packets if np.all(valid) else int(np.argmin(valid))
+            self._add(start[:number_of_valid], qualities[:number_of_valid], angles[:number_of_valid],
+                      ranges[:number_of_valid], turns)
+            offset += number_of_valid * PACKET_SIZE
+            if number_of_valid < number_of_packets:
+                offset += 1
+                self.dropped_bytes += 1
+        self._pending = data[offset:]
+        return turns
+
+    def _add(self, start: np.ndarray, qualities: np.ndarray, angles: np.ndarray, ranges: np.ndarray,
+             turns: List[LidarTurn]):
+        # the measures are split at each start flag, the first segment continues the current turn
+        segment_starts = np.union1d([0], np.flatnonzero(start))
+        segment_ends = np.append(segment_starts[1:], len(start))
+        for segment_start, segment_end in zip(segment_starts, segment_ends):
+            if segment_end == segment_start:
+                continue
+            if start[segment_start]:
+                if self._started:
+                    self._emit(turns)
+                self._started = True
+            if not self._started:
+                self.dropped_measures += segment_end - segment_start
+                continue
+            selected = slice(segment_start, segment_end)
+            segment_angles, segment_ranges, segment_qualities = angles[selected], ranges[selected], qualities[selected]
+            if self.skip_invalid_measures:
+                measured = segment_ranges > 0
+                segment_angles = segment_angles[measured]
+                segment_ranges = segment_ranges[measured]
+                segment_qualities = segment_qualities[measured]
+            number = min(len(segment_angles), self.maximum_points - self._count)
+            self.dropped_measures += len(segment_angles) - number
+            end = self._count + number
+            self._angles[self._buffer, self._count:end] = segment_angles[:number]
+            self._ranges[self._buffer, self._count:end] = segment_ranges[:number]
+            self._qualities[self._buffer, self._count:end] = segment_qualities[:number]
+            self._count = end
+
+    def _emit(self, turns: List[LidarTurn]):
+        """
+        Appends the current turn to {turns}, the turns completed by the current feed.
+        """
+        turns.append(LidarTurn(self.clock(), self._angles[self._buffer, :self._count],
+                               self._ranges[self._buffer, :self._count], self._qualities[self._buffer, :self._count]))
+        number_of_buffers = len(self._angles)
+        self._buffer = (self._buffer + 1) % number_of_buffers
+        self._count = 0
+        if len(turns) >= number_of_buffers:
+            # the next buffer holds a turn of this feed, which is not returned yet
+            reused = turns[-number_of_buffers]
+            reused.angles, reused.ranges, reused.qualities = \
+                reused.angles.copy(), reused.ranges.copy(), reused.qualities.copy()
+
+
+class LidarReader:
+    def __init__(self, stream: asyncio.StreamReader, parser: Optional[ScanParser] = None, chunk_size: int = 4096):
+        """
+        Async iterator of the turns read from {stream}.
+
+        :param stream:
+        :param parser: ScanParser() if None
+        :param chunk_size: maximum number of bytes read at once
+        """
+        self.stream = stream
+        self.parser = ScanParser() if parser is None else parser
+        self.chunk_size = chunk_size
+        self._turns: List[LidarTurn] = []
+
+    def __aiter__(self) -> AsyncIterator[LidarTurn]:
+        return self
+
+    async def __anext__(self) -> LidarTurn:
+        while not self._turns:
+            data = await self.stream.read(self.chunk_size)
+            if not data:
+                raise StopAsyncIteration
+            self._turns.extend(self.parser.feed(data))
+        return self._turns.pop(0)
+
+
+async def open_lidar(path: str, baudrate: Optional[int] = None, parser: Optional[ScanParser] = None) -> LidarReader:
+    """
+    Reads the scan stream of the serial device, or pseudo-terminal, at {path}.
+
+    :param path:
+    :param baudrate: like 115200 or 256000, left as is if None
+    :param parser:
+    :return:
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    if os.isatty(fd):
+        tty.setraw(fd)
+        if baudrate is not None:
+            attributes = termios.tcgetattr(fd)
+            speed = getattr(termios, f"B{baudrate}")
+            attributes[4] = attributes[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    loop = asyncio.get_running_loop()
+    stream = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stream), os.fdopen(fd, "rb", buffering=0))
+    return LidarReader(stream, parser)
@@ -0,0 +1,131 @@
+"""
+Emulated lidar, to run the ingestion layer without the sensor.
+
+The emulator casts the rays of each turn in a World from the pose of a Robot, encodes them as standard scan packets
+and writes them to a stream: one end of a socket pair, or the master side of a pseudo-terminal whose slave path can
+be opened like a serial device.
+"""
+
+import array
+import asyncio
+import fcntl
+import os
+import pty
+import socket
+import termios
+import tty
+from typing import Optional, Tuple
+
+import numpy as np
+
+from slam_robot.models.robot import Robot
+from slam_robot.models.world import World
+from slam_robot.utils.lidar import DESCRIPTOR, LidarReader, ScanParser, encode_packets
+
+
+class LidarEmulator:
+    def __init__(self, world: World, robot: Robot, rotation_frequency: float = 10., measures_per_turn: int = 360,
+                 quality: int = 47, speed: float = 1.):
+        """
+
+        :param world:
+        :param robot: the rays are cast from its current pose, so it may move between turns
+        :param rotation_frequency: turns per second
+        :param measures_per_turn:
+        :param quality: quality of the measures which hit an item
+        :param speed: the emulator runs {speed} times faster than the sensor
+        """
+        self.world = world
+        self.robot = robot
+        self.rotation_frequency = rotation_frequency
+        self.measures_per_turn = measures_per_turn
+        self.quality = quality
+        self.speed = speed
+        self.angles = np.linspace(0, 2 * np.pi, measures_per_turn, endpoint=False)
+
+    def turn_packets(self) -> bytes:
+        """
+        :return: packets of one turn seen from the current pose of the robot, angles in the lidar frame
+        """
+        ranges = self.world.cast_rays(self.robot.position, self.robot.orientation + self.angles)
+        if self.robot.rng is not None:
+            ranges = ranges + self.robot.range_noise * self.robot.rng.standard_normal(len(ranges))
+        seen = ranges < self.robot.measure_max_distance
+        ranges = np.where(seen, ranges, 0.)
+        qualities = np.where(seen, self.quality, 0)
+        return encode_packets(self.angles, ranges, qualities)
+
+    async def serve(self, writer: asyncio.StreamWriter, number_of_turns: Optional[int] = None):
+        """
+        Writes the descriptor and then one turn per period, forever if {number_of_turns} is None.
+        A last start packet, without measure, follows the last turn, so that the reader sees it complete.
+        """
+        period = 1 / (self.rotation_frequency * self.speed)
+        loop = asyncio.get_running_loop()
+        writer.write(DESCRIPTOR)
+        next_time = loop.time()
+        turn = 0
+        while number_of_turns is None or turn < number_of_turns:
+            writer.write(self.turn_packets())
+            await writer.drain()
+            turn += 1
+            next_time += period
+            await asyncio.sleep(max(0., next_time - loop.time()))
+        writer.write(encode_packets(self.angles[:1], np.zeros(1), np.zeros(1)))
+        await writer.drain()
+
+
+async def open_socket_pair(emulator: LidarEmulator, number_of_turns: Optional[int] = None,
+                           parser: Optional[ScanParser] = None) -> Tuple[LidarReader, asyncio.Task]:
+    """
+    Connects a LidarReader to {emulator} through a socket pair.
+
+    :return: the reader and the task of the emulator, cancel it to stop the emulator
+    """
+    reader_socket, emulator_socket = socket.socketpair()
+    loop = asyncio.get_running_loop()
+    stream = asyncio.StreamReader()
+    # no StreamWriter on the reader side: it would close the socket when garbage collected
+    await loop.create_connection(lambda: asyncio.StreamReaderProtocol(stream), sock=reader_socket)
+    _, writer = await asyncio.open_connection(sock=emulator_socket)
+
+    async def serve():
+        try:
+            await emulator.serve(writer, number_of_turns)
+        finally:
+            writer.close()
+
+    return LidarReader(stream, parser), asyncio.create_task(serve())
+
+
+async def open_pty(emulator: LidarEmulator, number_of_turns: Optional[int] = None) -> Tuple[str, asyncio.Task]:
+    """
+    Serves {emulator} on the master side of a pseudo-terminal.
+
+    :return: the path of the slave side, to be opened with open_lidar, and the task of the emulator
+    """
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        os.fdopen(master, "wb", buffering=0))
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def serve():
+        try:
+            await emulator.serve(writer, number_of_turns)
+            # closing the master discards what the slave has not read yet
+            while _unread_bytes(slave) > 0:
+                await asyncio.sleep(0.01)
+        finally:
+            writer.close()
+            os.close(slave)
+
+    return path, asyncio.create_task(serve())
+
+
+def _unread_bytes(fd: int) -> int:
+    count = array.array("i", [0])
+    fcntl.ioctl(fd, termios.FIONREAD, count)
+    return count[0]
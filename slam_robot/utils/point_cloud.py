@@ -0,0 +1,150 @@
+"""
+Array-backed point cloud.
+
+A turn of measures is stored as one (N, 2) array of cartesian coordinates, with optional per-point columns
+(angle, range and timestamp of each measure) instead of a list of Point objects.
+"""
+
+from typing import Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+
+from slam_robot.utils.geometry import Point
+
+
+class PointCloud:
+    columns = ("angles", "ranges", "timestamps")
+
+    def __init__(self,
+                 xy: Union[np.ndarray, Sequence],
+                 angles: Optional[np.ndarray] = None,
+                 ranges: Optional[np.ndarray] = None,
+                 timestamps: Optional[np.ndarray] = None):
+        """
+        >>> cloud = PointCloud([[1., 2.], [3., 4.], [5., 6.]], ranges=[1., 2., 3.])
+        >>> len(cloud)
+        3
+        >>> cloud[0]
+        Point(1.0, 2.0)
+        >>> cloud[1:].xy.tolist()
+        [[3.0, 4.0], [5.0, 6.0]]
+        >>> cloud[cloud.ranges > 1.5].ranges.tolist()
+        [2.0, 3.0]
+
+        :param xy: (N, 2) cartesian coordinates
+        :param angles: (N,) angle of each measure, in radian
+        :param ranges: (N,) distance of each measure
+        :param timestamps: (N,) time of each measure
+        """
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.angles = self._check_column(angles)
+        self.ranges = self._check_column(ranges)
+        self.timestamps = self._check_column(timestamps)
+
+    def _check_column(self, column) -> Optional[np.ndarray]:
+        if column is None:
+            return None
+        column = np.asarray(column, dtype=float)
+        if column.shape != (len(self.xy),):
+            raise ValueError(f"Column of shape {column.shape} does not match {len(self.xy)} points")
+        return column
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __iter__(self) -> Iterator[Point]:
+        return iter(self.to_points())
+
+    def __getitem__(self, item) -> Union[Point, 'PointCloud']:
+        """
+        An integer gives a Point, a slice, a boolean mask or an array of indices gives a PointCloud.
+        :param item:
+        :return:
+        """
+        if isinstance(item, (int, np.integer)):
+            return Point(float(self.xy[item, 0]), float(self.xy[item, 1]))
+        return PointCloud(self.xy[item], *[None if column is None else column[item]
+                                           for column in self._get_columns()])
+
+    def _get_columns(self) -> List[Optional[np.ndarray]]:
+        return [self.angles, self.ranges, self.timestamps]
+
+    def __str__(self):
+        return f"PointCloud of {len(self)} points"
+
+    def __repr__(self):
+        return f"PointCloud({self.xy.tolist()})"
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.xy[:, 0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.xy[:, 1]
+
+    def copy(self) -> 'PointCloud':
+        return PointCloud(self.xy.copy(), *[None if column is None else column.copy()
+                                            for column in self._get_columns()])
+
+    @classmethod
+    def empty(cls) -> 'PointCloud':
+        return cls(np.empty((0, 2)))
+
+    @classmethod
+    def concatenate(cls, clouds: Sequence['PointCloud']) -> 'PointCloud':
+        """
+        A column is kept only if every cloud has it.
+
+        >>> cloud = PointCloud.concatenate([PointCloud([[0., 0.]], ranges=[0.]), PointCloud([[1., 1.]], ranges=[1.])])
+        >>> cloud.xy.tolist(), cloud.ranges.tolist(), cloud.angles
+        ([[0.0, 0.0], [1.0, 1.0]], [0.0, 1.0], None)
+
+        :param clouds:
+        :return:
+        """
+        if len(clouds) == 0:
+            return cls.empty()
+        columns = []
+        for name in cls.columns:
+            values = [getattr(cloud, name) for cloud in clouds]
+            columns.append(None if any(value is None for value in values) else np.concatenate(values))
+        return cls(np.concatenate([cloud.xy for cloud in clouds]), *columns)
+
+    # region legacy points
+    def to_points(self) -> List[Point]:
+        return [Point(x, y) for x, y in self.xy.tolist()]
+
+    @classmethod
+    def from_points(cls, points: Sequence[Point]) -> 'PointCloud':
+        if len(points) == 0:
+            return cls.empty()
+        return cls([[point.x, point.y] for point in points])
+    # endregion
+
+    # region polar
+    @classmethod
+    def from_polar(cls,
+                   angles: np.ndarray,
+                   ranges: np.ndarray,
+                   origin: Optional[Point] = None,
+                   timestamps: Optional[np.ndarray] = None) -> 'PointCloud':
+        """
+        >>> PointCloud.from_polar(np.array([0., np.pi / 2]), np.array([2., 3.]), Point(1., 1.)).xy.round(6).tolist()
+        [[3.0, 1.0], [1.0, 4.0]]
+
+        :param angles: (N,) in radian
+        :param ranges: (N,)
+        :param origin: position of the sensor, (0, 0) if None
+        :param timestamps: (N,)
+        :return:
+        """
+        angles = np.asarray(angles, dtype=float)
+        ranges = np.asarray(ranges, dtype=float)
+        xy = np.empty((len(angles), 2))
+        np.multiply(ranges, np.cos(angles), out=xy[:, 0])
+        np.multiply(ranges, np.sin(angles), out=xy[:, 1])
+        if origin is not None:
+            xy += [origin.x, origin.y]
+        return cls(xy, angles, ranges, timestamps)
+    # endregion
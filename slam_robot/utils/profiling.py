@@ -0,0 +1,225 @@
+"""
+Timing instrumentation of the processing stages.
+
+Stages are wrapped in named spans, with the span context manager or the profiled decorator. When profiling is
+disabled, which is the default, span returns a shared no-op context manager and profiled calls the function after one
+flag check, so the spans can stay in hot paths. When it is enabled, each span name gets a counter, its total, minimum
+and maximum durations and a latency histogram with logarithmic buckets.
+
+Debug messages go through log_event, to the "slam_robot" logger, either as plain text or as one JSON object per line.
+"""
+
+import bisect
+import functools
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger("slam_robot")
+
+# upper bounds of the histogram buckets, in seconds: 1, 2 and 5 for each decade from 1 µs to 10 s, then +inf
+HISTOGRAM_BOUNDS = [factor * 10. ** exponent for exponent in range(-6, 1) for factor in (1, 2, 5)] + [10., float("inf")]
+
+
+class SpanStatistics:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.minimum = float("inf")
+        self.maximum = 0.
+        self.histogram = [0] * len(HISTOGRAM_BOUNDS)
+
+    def record(self, duration: float):
+        self.count += 1
+        self.total += duration
+        if duration < self.minimum:
+            self.minimum = duration
+        if duration > self.maximum:
+            self.maximum = duration
+        self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, duration)] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket which holds the {q} quantile, capped by the maximum duration.
+
+        >>> statistics = SpanStatistics()
+        >>> for duration in [1e-4] * 9 + [3e-2]:
+        ...     statistics.record(duration)
+        >>> statistics.quantile(0.5), statistics.quantile(0.99)
+        (0.0001, 0.03)
+
+        :param q: between 0 and 1
+        :return: duration in seconds
+        """
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.histogram):
+            cumulative += count
+            if cumulative >= rank and count > 0:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "total": self.total, "mean": self.mean,
+                "minimum": self.minimum if self.count else 0., "maximum": self.maximum,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    def __init__(self, profiler: "Profiler", name: str, fields: Dict[str, Any]):
+        self.profiler = profiler
+        self.name = name
+        self.fields = fields
+        self.start = 0.
+        self.duration = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        self.profiler.record(self.name, self.duration)
+        if self.profiler.log_spans:
+            self.profiler.log_event("span", name=self.name, duration=self.duration, **self.fields)
+        return False
+
+
+class Profiler:
+    def __init__(self, enabled: bool = False, structured_logging: bool = False, log_spans: bool = False):
+        """
+        >>> profiler = Profiler(enabled=True)
+        >>> with profiler.span("sense"):
+        ...     pass
+        >>> profiler.count("rays", 300)
+        >>> profiler.statistics["sense"].count, profiler.counters["rays"]
+        (1, 300)
+
+        :param enabled: spans and counters are recorded only if True
+        :param structured_logging: log_event writes JSON objects instead of plain text
+        :param log_spans: each span is also logged with its duration, at debug level
+        """
+        self.enabled = enabled
+        self.structured_logging = structured_logging
+        self.log_spans = log_spans
+        self.statistics: Dict[str, SpanStatistics] = {}
+        self.counters: Dict[str, int] = {}
+
+    def configure(self, enabled: Optional[bool] = None, structured_logging: Optional[bool] = None,
+                  log_spans: Optional[bool] = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if structured_logging is not None:
+            self.structured_logging = structured_logging
+        if log_spans is not None:
+            self.log_spans = log_spans
+
+    def reset(self):
+        self.statistics = {}
+        self.counters = {}
+
+    # region recording
+    def span(self, name: str, **fields):
+        """
+        :param name: name of the stage
+        :param fields: logged with the span if log_spans
+        :return: context manager timing its block
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, fields)
+
+    def profiled(self, name: Optional[str] = None) -> Callable:
+        """
+        Decorator timing each call of a function in a span, named after the function if {name} is None.
+        """
+        def decorator(function: Callable) -> Callable:
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, span_name, {}):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, duration: float):
+        statistics = self.statistics.get(name)
+        if statistics is None:
+            statistics = self.statistics[name] = SpanStatistics()
+        statistics.record(duration)
+
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+    # endregion
+
+    def log_event(self, event: str, level: int = logging.DEBUG, **fields):
+        """
+        Logs {event} with {fields}, as "event key=value ..." or as a JSON object depending on structured_logging.
+        The message is only formatted if the logger accepts {level}.
+        """
+        if not logger.isEnabledFor(level):
+            return
+        if self.structured_logging:
+            logger.log(level, json.dumps({"event": event, **fields}, default=_to_json))
+        else:
+            logger.log(level, "%s %s", event, " ".join(f"{key}={value}" for key, value in fields.items()))
+
+    def report(self) -> Dict[str, Any]:
+        """
+        :return: statistics of each span, durations in seconds, and counters
+        """
+        return {"spans": {name: statistics.to_dict() for name, statistics in sorted(self.statistics.items())},
+                "counters": dict(sorted(self.counters.items()))}
+
+    def format_report(self) -> str:
+        width = max([len(name) + 2 for name in [*self.statistics, *self.counters]] + [24])
+        lines = [f"{'span':<{width}}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, statistics in sorted(self.statistics.items()):
+            lines.append(f"{name:<{width}}{statistics.count:>8}{1e3 * statistics.mean:>10.3f}"
+                         f"{1e3 * statistics.quantile(0.5):>10.3f}{1e3 * statistics.quantile(0.9):>10.3f}"
+                         f"{1e3 * statistics.quantile(0.99):>10.3f}{1e3 * statistics.maximum:>10.3f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<{width}}{value:>8}")
+        return "\n".join(lines)
+
+
+def _to_json(value: Any) -> Any:
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+# region default profiler
+PROFILER = Profiler()
+
+span = PROFILER.span
+profiled = PROFILER.profiled
+count = PROFILER.count
+log_event = PROFILER.log_event
+configure = PROFILER.configure
+reset = PROFILER.reset
+report = PROFILER.report
+format_report = PROFILER.format_report
+# endregion
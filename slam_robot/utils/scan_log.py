@@ -0,0 +1,271 @@
+"""
+Binary log of lidar turns.
+
+A log is a 32 bytes header followed by fixed-width records, one per turn:
+
+    timestamp  float64
+    pose       3 float64, (x, y, theta), theta is nan if unknown
+    count      uint32, number of measures of the turn
+    angles     maximum_points float32
+    ranges     maximum_points float32
+    qualities  maximum_points uint8
+
+padded to a multiple of 8 bytes. Only the first {count} measures of a record are meaningful. Angles are stored in the
+table frame, like the ones of Robot.sense: a measure taken at angle a in the lidar frame is stored at theta + a, see
+ScanLogWriter.write_turn. When theta is unknown, the lidar frame is taken as the table frame. Since records have the
+same size, the file is read with a memory map, turn i is at a known offset and its arrays are views of the map. The
+timestamps are non-decreasing, so seeking a time is a binary search on the timestamp column.
+
+The writer only appends, through a buffer of a bounded number of records. A record cut by a crash at the end of the
+file is ignored by the reader.
+"""
+
+import os
+import struct
+import time
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from slam_robot.models.perception import RobotPerception
+from slam_robot.utils.geometry import Point
+from slam_robot.utils.lidar import LidarTurn
+from slam_robot.utils.point_cloud import PointCloud
+
+MAGIC = b"SLAMSCAN"
+VERSION = 1
+# magic, version, maximum number of points per turn, record size
+HEADER = struct.Struct("<8sIII12x")
+
+
+def record_dtype(maximum_points: int) -> np.dtype:
+    """
+    >>> record_dtype(4).itemsize
+    72
+    """
+    names = ["timestamp", "pose", "count", "angles", "ranges", "qualities"]
+    formats = ["<f8", ("<f8", (3,)), "<u4", ("<f4", (maximum_points,)), ("<f4", (maximum_points,)),
+               ("u1", (maximum_points,))]
+    offsets = [0, 8, 32, 36, 36 + 4 * maximum_points, 36 + 8 * maximum_points]
+    size = 36 + 9 * maximum_points
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": (size + 7) // 8 * 8})
+
+
+def _read_header(path: str) -> Tuple[int, int]:
+    with open(path, "rb") as f:
+        data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is not a scan log: header too short")
+    magic, version, maximum_points, record_size = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a scan log")
+    if version != VERSION:
+        raise ValueError(f"{path} is a scan log of version {version}, only version {VERSION} is supported")
+    if record_size != record_dtype(maximum_points).itemsize:
+        raise ValueError(f"{path} has an inconsistent record size")
+    return maximum_points, record_size
+
+
+class ScanLogWriter:
+    def __init__(self, path: str, maximum_points: int = 1024, buffer_size: int = 64):
+        """
+        Opens {path} for appending, the header is written if the file is new.
+
+        :param path:
+        :param maximum_points: maximum number of measures in a turn, must match the one of an existing file
+        :param buffer_size: number of records kept in memory before they are written
+        """
+        self.path = path
+        self.maximum_points = maximum_points
+        self.dtype = record_dtype(maximum_points)
+        self.last_timestamp = -np.inf
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            existing_maximum_points, _ = _read_header(path)
+            if existing_maximum_points != maximum_points:
+                raise ValueError(f"{path} has {existing_maximum_points} points per record, not {maximum_points}")
+            # drop a record cut by a crash, so that the next ones stay aligned
+            number_of_records = (os.path.getsize(path) - HEADER.size) // self.dtype.itemsize
+            with open(path, "r+b") as f:
+                f.truncate(HEADER.size + number_of_records * self.dtype.itemsize)
+            if number_of_records > 0:
+                self.last_timestamp = ScanLog(path).timestamps[-1]
+            self._file = open(path, "ab")
+        else:
+            self._file = open(path, "wb")
+            self._file.write(HEADER.pack(MAGIC, VERSION, maximum_points, self.dtype.itemsize))
+        self._buffer = np.zeros(buffer_size, dtype=self.dtype)
+        self._buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, timestamp: float, pose: Sequence[float], angles: np.ndarray, ranges: np.ndarray,
+              qualities: Optional[np.ndarray] = None, lidar_frame: bool = False):
+        """
+        :param timestamp: not lower than the one of the previous turn
+        :param pose: (x, y, theta)
+        :param angles: (N,) in radian, in the table frame unless {lidar_frame}
+        :param ranges: (N,)
+        :param qualities: (N,) between 0 and 255, 0 if None
+        :param lidar_frame: whether {angles} are in the lidar frame, they are then rotated by theta when it is known
+        :return:
+        """
+        theta = pose[2]
+        if lidar_frame and not np.isnan(theta):
+            angles = np.mod(np.asarray(angles, dtype=float) + theta, 2 * np.pi)
+        count = len(angles)
+        if count > self.maximum_points:
+            raise ValueError(f"{count} measures in a turn, at most {self.maximum_points} fit in a record")
+        if timestamp < self.last_timestamp:
+            raise ValueError(f"Timestamp {timestamp} is before the previous one, {self.last_timestamp}")
+        record = self._buffer[self._buffered]
+        record["timestamp"] = timestamp
+        record["pose"] = pose
+        record["count"] = count
+        record["angles"][:count] = angles
+        record["ranges"][:count] = ranges
+        record["qualities"][:count] = 0 if qualities is None else qualities
+        # the tail of a reused buffer row is zeroed so that files do not depend on the previous turns
+        record["angles"][count:] = 0
+        record["ranges"][count:] = 0
+        record["qualities"][count:] = 0
+        self.last_timestamp = timestamp
+        self._buffered += 1
+        if self._buffered == len(self._buffer):
+            self.flush()
+
+    def write_perception(self, perception: RobotPerception, qualities: Optional[np.ndarray] = None):
+        """
+        :param perception: its obstacles must have angles and ranges, like the ones given by Robot.sense
+        :param qualities:
+        :return:
+        """
+        obstacles = perception.obstacles
+        if obstacles.angles is None or obstacles.ranges is None:
+            raise ValueError("The obstacles of the perception have no angles or no ranges")
+        orientation = np.nan if perception.orientation is None else perception.orientation
+        self.write(perception.timestamp, (perception.position.x, perception.position.y, orientation),
+                   obstacles.angles, obstacles.ranges, qualities)
+
+    def write_turn(self, turn: LidarTurn, pose: Sequence[float]):
+        """
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "turns.scans")
+        >>> turn = LidarTurn(0., np.array([0., np.pi / 2]), np.array([100., 200.]), np.array([47, 47]))
+        >>> with ScanLogWriter(path, maximum_points=4) as writer:
+        ...     writer.write_turn(turn, (10., 0., np.pi / 2))
+        >>> (ScanLog(path).perception(0).obstacles.xy.round(3) + 0.).tolist()
+        [[10.0, 100.0], [-190.0, 0.0]]
+
+        :param turn: angles in the lidar frame, as read by LidarReader
+        :param pose: (x, y, theta) of the lidar when the turn was taken, theta is nan if unknown
+        :return:
+        """
+        self.write(turn.timestamp, pose, turn.angles, turn.ranges, turn.qualities, lidar_frame=True)
+
+    def flush(self):
+        if self._buffered:
+            self._file.write(self._buffer[:self._buffered].tobytes())
+            self._buffered = 0
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+class ScanLog:
+    def __init__(self, path: str):
+        """
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "match.scans")
+        >>> with ScanLogWriter(path, maximum_points=8) as writer:
+        ...     for t in range(5):
+        ...         writer.write(float(t), (t, 0., 0.), np.linspace(0, 1, t + 1), np.full(t + 1, 100.))
+        >>> log = ScanLog(path)
+        >>> len(log), log.seek(2.5), log.arrays(3)[1].tolist()
+        (5, 3, [100.0, 100.0, 100.0, 100.0])
+
+        :param path:
+        """
+        self.path = path
+        self.maximum_points, self.record_size = _read_header(path)
+        self.dtype = record_dtype(self.maximum_points)
+        self.records = np.empty(0, dtype=self.dtype)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the records again, to see the ones appended since the log was opened.
+        """
+        number_of_records = (os.path.getsize(self.path) - HEADER.size) // self.record_size
+        if number_of_records == len(self.records):
+            return
+        if number_of_records == 0:
+            self.records = np.empty(0, dtype=self.dtype)
+        else:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode="r", offset=HEADER.size,
+                                     shape=(number_of_records,))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.records["timestamp"]
+
+    @property
+    def poses(self) -> np.ndarray:
+        return self.records["pose"]
+
+    def seek(self, timestamp: float) -> int:
+        """
+        :return: index of the first turn at or after {timestamp}, len(self) if there is none
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side="left"))
+
+    def arrays(self, index: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: angles, ranges and qualities of turn {index}, as views of the file
+        """
+        record = self.records[index]
+        count = int(record["count"])
+        return record["angles"][:count], record["ranges"][:count], record["qualities"][:count]
+
+    def perception(self, index: int) -> RobotPerception:
+        """
+        :return: obstacles in the table frame, with the orientation of the record if it is known
+        """
+        record = self.records[index]
+        angles, ranges, _ = self.arrays(index)
+        x, y, theta = record["pose"].tolist()
+        position = Point(x, y)
+        timestamp = float(record["timestamp"])
+        obstacles = PointCloud.from_polar(angles, ranges, position, np.full(len(angles), timestamp))
+        return RobotPerception(timestamp, obstacles, position, None if np.isnan(theta) else theta)
+
+
+def replay(log: ScanLog, start: Optional[float] = None, end: Optional[float] = None,
+           speed: Optional[float] = None) -> Iterator[RobotPerception]:
+    """
+    Turns of {log} between {start} and {end}, as perceptions ready for the perception pipeline.
+
+    :param log:
+    :param start: timestamp of the first turn, the beginning of the log if None
+    :param end: turns at or after {end} are not replayed, the end of the log if None
+    :param speed: replay {speed} times faster than the recording, as fast as possible if None
+    :return:
+    """
+    first = 0 if start is None else log.seek(start)
+    last = len(log) if end is None else log.seek(end)
+    clock_start = time.perf_counter()
+    for index in range(first, last):
+        if speed is not None:
+            delay = (log.timestamps[index] - log.timestamps[first]) / speed - (time.perf_counter() - clock_start)
+            if delay > 0:
+                time.sleep(delay)
+        yield log.perception(index)
@@ -0,0 +1,181 @@
+"""
+Spatial index for nearest-neighbour queries on 2D points.
+
+The index is backed by scipy.spatial.cKDTree, which is built once from a point array. Points added afterwards are kept
+in a small pending array searched by brute force, and removed points are masked, until there are enough changes to
+make rebuilding the tree worth it. The identifier of a point is its insertion rank and never changes.
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class SpatialIndex:
+    def __init__(self, points: Optional[np.ndarray] = None, rebuild_ratio: float = 0.25):
+        """
+        >>> index = SpatialIndex(np.array([[0., 0.], [10., 0.], [0., 10.]]))
+        >>> distances, ids = index.nearest(np.array([[1., 1.], [9., 1.]]))
+        >>> ids.tolist()
+        [0, 1]
+        >>> index.add(np.array([[8., 0.]])).tolist()
+        [3]
+        >>> index.nearest(np.array([8., 1.]))[1].tolist()
+        [3]
+        >>> index.remove([3])
+        >>> index.k_nearest(np.array([8., 1.]), 2)[1].tolist()
+        [[1, 0]]
+
+        :param points: (N, 2) initial points
+        :param rebuild_ratio: the tree is rebuilt when the pending or removed points exceed this ratio of its size
+        """
+        # the points are the first {self._size} rows of arrays whose capacity doubles when they are full
+        self._points = np.empty((8, 2))
+        self._alive = np.zeros(8, dtype=bool)
+        self._size = 0
+        self.rebuild_ratio = rebuild_ratio
+        self._tree: Optional[cKDTree] = None
+        self._tree_ids = np.empty(0, dtype=np.int64)
+        # points with an id greater or equal are not in the tree yet
+        self._tree_end = 0
+        self._removed_from_tree = 0
+        if points is not None:
+            self.add(points)
+            self.rebuild()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    @property
+    def points(self) -> np.ndarray:
+        """
+        (N, 2) points by id, removed ones included
+        """
+        return self._points[:self._size]
+
+    @property
+    def alive(self) -> np.ndarray:
+        """
+        (N,) whether each point is still in the index
+        """
+        return self._alive[:self._size]
+
+    # region updates
+    def add(self, points: np.ndarray) -> np.ndarray:
+        """
+        Amortized O(len(points)).
+
+        :param points: (N, 2)
+        :return: ids of the added points
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        end = self._size + len(points)
+        self._reserve(end)
+        ids = np.arange(self._size, end)
+        self._points[self._size:end] = points
+        self._alive[self._size:end] = True
+        self._size = end
+        return ids
+
+    def _reserve(self, size: int):
+        capacity = len(self._points)
+        if size <= capacity:
+            return
+        new_capacity = max(2 * capacity, size)
+        points = np.empty((new_capacity, 2))
+        alive = np.zeros(new_capacity, dtype=bool)
+        points[:self._size] = self._points[:self._size]
+        alive[:self._size] = self._alive[:self._size]
+        self._points = points
+        self._alive = alive
+
+    def remove(self, ids):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[self.alive[ids]]
+        self.alive[ids] = False
+        self._removed_from_tree += int(np.count_nonzero(ids < self._tree_end))
+
+    def rebuild(self):
+        self._tree_ids = np.flatnonzero(self.alive)
+        self._tree = cKDTree(self.points[self._tree_ids]) if len(self._tree_ids) > 0 else None
+        self._tree_end = len(self.points)
+        self._removed_from_tree = 0
+
+    def _rebuild_if_needed(self):
+        limit = self.rebuild_ratio * max(len(self._tree_ids), 1)
+        if len(self.points) - self._tree_end > limit or self._removed_from_tree > limit:
+            self.rebuild()
+
+    def _pending_ids(self) -> np.ndarray:
+        return self._tree_end + np.flatnonzero(self.alive[self._tree_end:])
+    # endregion
+
+    # region queries
+    def k_nearest(self, queries: np.ndarray, k: int, maximum_distance: float = np.inf) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param queries: (Q, 2) or (2,)
+        :param k:
+        :param maximum_distance: neighbours farther than it are not returned
+        :return: distances and ids, (Q, k) each, missing neighbours have an infinite distance and the id -1
+        """
+        self._rebuild_if_needed()
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        candidate_distances = [np.full((len(queries), k), np.inf)]
+        candidate_ids = [np.full((len(queries), k), -1, dtype=np.int64)]
+
+        if self._tree is not None:
+            tree_k = min(k + self._removed_from_tree, len(self._tree_ids))
+            distances, positions = self._tree.query(queries, tree_k, distance_upper_bound=maximum_distance)
+            distances = distances.reshape(len(queries), tree_k)
+            positions = positions.reshape(len(queries), tree_k)
+            found = positions < len(self._tree_ids)
+            ids = np.where(found, self._tree_ids[np.minimum(positions, len(self._tree_ids) - 1)], -1)
+            valid = found & self.alive[np.maximum(ids, 0)]
+            candidate_distances.append(np.where(valid, distances, np.inf))
+            candidate_ids.append(np.where(valid, ids, -1))
+
+        pending_ids = self._pending_ids()
+        if len(pending_ids) > 0:
+            differences = queries[:, np.newaxis, :] - self.points[pending_ids][np.newaxis, :, :]
+            distances = np.hypot(differences[..., 0], differences[..., 1])
+            distances[distances > maximum_distance] = np.inf
+            candidate_distances.append(distances)
+            candidate_ids.append(np.where(np.isfinite(distances), pending_ids, -1))
+
+        distances = np.concatenate(candidate_distances, axis=1)
+        ids = np.concatenate(candidate_ids, axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def nearest(self, queries: np.ndarray, maximum_distance: float = np.inf) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param queries: (Q, 2) or (2,)
+        :param maximum_distance:
+        :return: distances and ids, (Q,) each, infinite distance and id -1 if there is no neighbour
+        """
+        distances, ids = self.k_nearest(queries, 1, maximum_distance)
+        return distances[:, 0], ids[:, 0]
+
+    def within_radius(self, queries: np.ndarray, radius: float) -> List[np.ndarray]:
+        """
+        :param queries: (Q, 2) or (2,)
+        :param radius:
+        :return: for each query, the ids of the points at most {radius} away
+        """
+        self._rebuild_if_needed()
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        results = [np.empty(0, dtype=np.int64) for _ in range(len(queries))]
+        if self._tree is not None:
+            for i, positions in enumerate(self._tree.query_ball_point(queries, radius)):
+                ids = self._tree_ids[np.asarray(positions, dtype=np.int64)]
+                results[i] = ids[self.alive[ids]]
+        pending_ids = self._pending_ids()
+        if len(pending_ids) > 0:
+            differences = queries[:, np.newaxis, :] - self.points[pending_ids][np.newaxis, :, :]
+            close = np.hypot(differences[..., 0], differences[..., 1]) <= radius
+            for i in range(len(queries)):
+                results[i] = np.concatenate([results[i], pending_ids[close[i]]])
+        return results
+    # endregion
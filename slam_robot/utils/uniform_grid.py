@@ -0,0 +1,201 @@
+"""
+Uniform grid over a rectangle, used to find the items a ray may hit.
+
+Each cell keeps the keys of the items which overlap it. A ray visits the cells it crosses in order, with the
+Amanatides-Woo traversal, so only the items close to the ray are tested and the traversal can stop at the first cell
+where a hit is found. Inserting or removing an item only touches the cells of that item.
+"""
+
+import math
+from typing import Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+# a segment crossing a cell corner within this tolerance is put in the cells on both sides of the corner
+CORNER_TOLERANCE = 1e-9
+
+
+class UniformGrid:
+    def __init__(self, x_min: float, y_min: float, x_max: float, y_max: float, cell_size: float):
+        """
+        >>> grid = UniformGrid(0, 0, 100, 100, 10)
+        >>> grid.insert_segment("wall", (95, 0), (95, 100))
+        >>> grid.insert_box("pillar", (40, 40, 60, 60))
+        >>> [keys for keys, _, _ in grid.traverse((5, 50), (1, 0)) if keys]
+        [{'pillar'}, {'pillar'}, {'pillar'}, {'wall'}]
+        >>> grid.remove("pillar")
+        >>> [(keys, t_enter) for keys, t_enter, _ in grid.traverse((5, 50), (1, 0)) if keys]
+        [({'wall'}, 85.0)]
+
+        :param x_min:
+        :param y_min:
+        :param x_max:
+        :param y_max:
+        :param cell_size: side of a cell
+        """
+        self.x_min = x_min
+        self.y_min = y_min
+        self.x_max = x_max
+        self.y_max = y_max
+        self.cell_size = cell_size
+        self.shape = (max(1, int(math.ceil((x_max - x_min) / cell_size))),
+                      max(1, int(math.ceil((y_max - y_min) / cell_size))))
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self._item_cells: Dict[Hashable, List[Tuple[int, int]]] = {}
+
+    def __len__(self):
+        return len(self._item_cells)
+
+    def __contains__(self, key: Hashable):
+        return key in self._item_cells
+
+    def contains_point(self, point: Tuple[float, float]) -> bool:
+        return self.x_min <= point[0] <= self.x_max and self.y_min <= point[1] <= self.y_max
+
+    def contains_box(self, box: Tuple[float, float, float, float]) -> bool:
+        return self.contains_point(box[:2]) and self.contains_point(box[2:])
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        i = int(math.floor((x - self.x_min) / self.cell_size))
+        j = int(math.floor((y - self.y_min) / self.cell_size))
+        return min(max(i, 0), self.shape[0] - 1), min(max(j, 0), self.shape[1] - 1)
+
+    # region updates
+    def _insert(self, key: Hashable, cells: List[Tuple[int, int]]):
+        if key in self._item_cells:
+            self.remove(key)
+        self._item_cells[key] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(key)
+
+    def insert_box(self, key: Hashable, box: Tuple[float, float, float, float]):
+        """
+        :param key: identifier of the item
+        :param box: (x_min, y_min, x_max, y_max), the part outside the grid is ignored
+        :return:
+        """
+        if box[2] < self.x_min or box[0] > self.x_max or box[3] < self.y_min or box[1] > self.y_max:
+            self._insert(key, [])
+            return
+        i_min, j_min = self._cell(box[0], box[1])
+        i_max, j_max = self._cell(box[2], box[3])
+        self._insert(key, [(i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1)])
+
+    def insert_segment(self, key: Hashable, start: Tuple[float, float], end: Tuple[float, float]):
+        """
+        Only the cells crossed by the segment are used, which is much less than its bounding box for a diagonal.
+
+        :param key: identifier of the item
+        :param start:
+        :param end:
+        :return:
+        """
+        direction = (end[0] - start[0], end[1] - start[1])
+        if direction == (0, 0):
+            self.insert_box(key, (start[0], start[1], end[0], end[1]))
+            return
+        cells = []
+        for cell, _, _, corner_cells in self._walk(start, direction, 1.):
+            cells.append(cell)
+            cells.extend(corner_cells)
+        self._insert(key, list(dict.fromkeys(cells)))
+
+    def insert_line(self, key: Hashable, point: Tuple[float, float], direction: Tuple[float, float]):
+        """
+        Infinite line, clipped to the grid.
+        """
+        interval = self.clip(point, direction, -math.inf, math.inf)
+        if interval is None:
+            self._insert(key, [])
+            return
+        t_enter, t_exit = interval
+        self.insert_segment(key,
+                            (point[0] + t_enter * direction[0], point[1] + t_enter * direction[1]),
+                            (point[0] + t_exit * direction[0], point[1] + t_exit * direction[1]))
+
+    def remove(self, key: Hashable):
+        for cell in self._item_cells.pop(key, []):
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+    # endregion
+
+    # region traversal
+    def clip(self, origin: Tuple[float, float], direction: Tuple[float, float], t_min: float = 0.,
+             t_max: float = math.inf) -> Optional[Tuple[float, float]]:
+        """
+        Slab test of origin + t * direction against the grid rectangle.
+
+        :return: (t_enter, t_exit) within [t_min, t_max], None if the ray misses the rectangle
+        """
+        for o, d, low, high in [(origin[0], direction[0], self.x_min, self.x_max),
+                                (origin[1], direction[1], self.y_min, self.y_max)]:
+            if d == 0:
+                if o < low or o > high:
+                    return None
+                continue
+            t_0, t_1 = (low - o) / d, (high - o) / d
+            if t_0 > t_1:
+                t_0, t_1 = t_1, t_0
+            t_min, t_max = max(t_min, t_0), min(t_max, t_1)
+            if t_min > t_max:
+                return None
+        return t_min, t_max
+
+    def _walk(self, origin: Tuple[float, float], direction: Tuple[float, float], t_max: float = math.inf) \
+            -> Iterator[Tuple[Tuple[int, int], float, float, List[Tuple[int, int]]]]:
+        """
+        Cells crossed by origin + t * direction for t in [0, t_max], in order.
+
+        :return: iterator of (cell, t_enter, t_exit, cells touched at a corner crossed when leaving the cell)
+        """
+        interval = self.clip(origin, direction, 0., t_max)
+        if interval is None:
+            return
+        t, t_end = interval
+        i, j = self._cell(origin[0] + t * direction[0], origin[1] + t * direction[1])
+        steps = []
+        # for each axis: step of the cell index, t of the next cell border, t between two borders
+        for index, o, d, low in [(i, origin[0], direction[0], self.x_min), (j, origin[1], direction[1], self.y_min)]:
+            if d > 0:
+                steps.append((1, (low + (index + 1) * self.cell_size - o) / d, self.cell_size / d))
+            elif d < 0:
+                steps.append((-1, (low + index * self.cell_size - o) / d, -self.cell_size / d))
+            else:
+                steps.append((0, math.inf, math.inf))
+        (step_i, next_i, delta_i), (step_j, next_j, delta_j) = steps
+        while True:
+            t_exit = min(next_i, next_j, t_end)
+            corner_cells = []
+            if abs(next_i - next_j) <= CORNER_TOLERANCE * max(1., abs(t_exit)) and next_i <= t_end:
+                corner_cells = [cell for cell in [(i + step_i, j), (i, j + step_j)]
+                                if 0 <= cell[0] < self.shape[0] and 0 <= cell[1] < self.shape[1]]
+            yield (i, j), t, t_exit, corner_cells
+            if t_exit >= t_end:
+                return
+            if next_i < next_j:
+                i += step_i
+                next_i += delta_i
+            else:
+                j += step_j
+                next_j += delta_j
+            if not (0 <= i < self.shape[0] and 0 <= j < self.shape[1]):
+                return
+            t = t_exit
+
+    def traverse(self, origin: Tuple[float, float], direction: Tuple[float, float], t_max: float = math.inf) \
+            -> Iterator[Tuple[Set[Hashable], float, float]]:
+        """
+        Keys of the items of each cell crossed by a ray, from the closest cell to the farthest one.
+
+        :param origin:
+        :param direction: need not be unitary, t is then in units of its norm
+        :param t_max: the ray stops there
+        :return: iterator of (keys, t_enter, t_exit), keys may be empty and is shared with the grid, do not modify it
+        """
+        empty = set()
+        for cell, t_enter, t_exit, corner_cells in self._walk(origin, direction, t_max):
+            keys = self.cells.get(cell, empty)
+            if corner_cells:
+                keys = keys.union(*[self.cells.get(corner_cell, empty) for corner_cell in corner_cells])
+            yield keys, t_enter, t_exit
+    # endregion